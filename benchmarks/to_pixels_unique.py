@@ -0,0 +1,43 @@
+'''
+Benchmark of to_pixels methods depending on the fraction of unique colors in the image.
+
+Run from the root of the project with: python -m benchmarks.to_pixels_unique
+'''
+
+import timeit
+import numpy as np
+
+from pixelpictures.image_to_pixels import lut_nearest_colors, unique_nearest_colors, estimate_unique_ratio, pack_colors, get_lut
+
+HEIGHT = 300
+WIDTH = 300
+PALETTE_SIZES = [8, 32, 256]
+RATIOS = [0.0002, 0.01, 0.1, 0.25, 0.5, 0.75, 1]
+
+def best_time(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def main():
+    rng = np.random.default_rng(0)
+    n = HEIGHT * WIDTH
+
+    print(f'Image {WIDTH}x{HEIGHT}, times in ms')
+    print(f'{"palette":>8} {"unique":>8} {"estimate":>9} {"lut":>8} {"unique":>8}')
+    for palette_size in PALETTE_SIZES:
+        colors = rng.integers(0, 256, (palette_size, 3)).tolist()
+        # Lookup table is built before, as for a warm palette
+        get_lut(colors)
+
+        for ratio in RATIOS:
+            image_colors = rng.integers(0, 256, (max(1, int(n * ratio)), 3))
+            image = image_colors[rng.integers(0, len(image_colors), n)].reshape(HEIGHT, WIDTH, 3)
+
+            lut = best_time(lambda: lut_nearest_colors(image, colors))
+            unique = best_time(lambda: unique_nearest_colors(image, colors))
+            keys = pack_colors(image)
+            unique_ratio = len(np.unique(keys)) / n
+            estimate = estimate_unique_ratio(keys)
+            print(f'{palette_size:>8} {unique_ratio:>8.3f} {estimate:>9.3f} {lut * 1000:>8.2f} {unique * 1000:>8.2f}')
+
+if __name__ == '__main__':
+    main()
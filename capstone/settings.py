@@ -124,4 +124,39 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Messages storage
-MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
\ No newline at end of file
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# Uploaded images are streamed to temporary files instead of being kept in memory,
+# files bigger than MAX_UPLOAD_SIZE are rejected while they are received (see pixelpictures/uploads.py)
+FILE_UPLOAD_HANDLERS = ["pixelpictures.uploads.LimitedUploadHandler"]
+
+# Uploaded images bigger than these are rejected before being decoded
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+MAX_UPLOAD_PIXELS = 40_000_000
+# Images made from uploads and pixel grids sent by clients (see pixelpictures/grid_format.py) cannot have more pixels than this
+MAX_GRID_PIXELS = 1_000_000
+
+# Palettes with at least this many colors are matched through a coarse palette index (see pixelpictures/image_to_pixels.py)
+INDEX_MIN_PALETTE = 64
+
+# Views of pictures are counted in memory and written together when there are this many, or after this many seconds
+VIEWS_FLUSH_THRESHOLD = 100
+VIEWS_FLUSH_INTERVAL = 10
+
+# Storage of picture files (see pixelpictures/storage.py). To share them between app nodes use a bucket, e.g.
+# {"BACKEND": "pixelpictures.storage.S3Storage", "OPTIONS": {"bucket": "pictures", "endpoint_url": "http://minio:9000"}}
+PICTURES_STORAGE = {
+    "BACKEND": "pixelpictures.storage.PictureFileSystemStorage",
+    "OPTIONS": {
+        "location": BASE_DIR / "pixelpictures/static/pixelpictures/pictures",
+        "base_url": "/static/pixelpictures/pictures/",
+    },
+}
+
+# Grids drawn for downloads are cached on local disk, the least recently used are removed above this size in bytes
+GRID_CACHE_DIR = BASE_DIR / "grid_cache"
+GRID_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# Grids bigger than this are sent without being cached
+GRID_CACHE_MAX_FILE_SIZE = 32 * 1024 * 1024
+# Downloads of grids with more pixels than this (cells of the picture times size of cells) are rejected
+MAX_DOWNLOAD_PIXELS = 100_000_000
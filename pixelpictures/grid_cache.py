@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import atexit
+import shutil
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core.files import locks
+
+# Grids drawn for downloads are kept on local disk (settings.GRID_CACHE_DIR), using at most
+# settings.GRID_CACHE_MAX_SIZE bytes: the least recently used ones are removed first (files are touched when used).
+# Grids are in a directory for every stored image, removed when no picture uses its pixels anymore.
+#
+# Hits, misses and the total size of the grids are counted in a file of the cache, shared by all processes
+# (see command grid_cache). The size is updated when grids are written or removed, the cache is scanned only
+# when it is bigger than the maximum size, and the scan corrects the counted size.
+# Hits and misses are counted in memory by every process and added to the file every STATS_FLUSH_EVENTS events,
+# STATS_FLUSH_INTERVAL seconds and when the process exits, so requests do not lock the file.
+
+STATS_FILE = "stats.json"
+STATS = ('hits', 'misses', 'size')
+TEMPORARY_SUFFIX = ".tmp"
+STATS_FLUSH_EVENTS = 100
+STATS_FLUSH_INTERVAL = 10
+
+_pending = Counter()
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+def cache_path(content_hash, key, extension):
+    # File of the grid key of a stored image
+    return os.path.join(settings.GRID_CACHE_DIR, content_hash, f"{key}.{extension}")
+
+def update_stats(values=None, **changes):
+    '''
+    Adds changes to the counters of the stats file (hits, misses and size) and sets them to values (dictionary),
+    locking the file against other processes. A missing or damaged file is made again, with the size of the cached grids.
+
+    Returns
+    -------
+        dictionary with the updated counters
+    '''
+
+    os.makedirs(settings.GRID_CACHE_DIR, exist_ok=True)
+    with open(os.open(os.path.join(settings.GRID_CACHE_DIR, STATS_FILE), os.O_RDWR | os.O_CREAT), 'r+') as file:
+        locks.lock(file, locks.LOCK_EX)
+        try:
+            try:
+                stats = json.loads(file.read())
+                stats = {name: int(stats[name]) for name in STATS}
+            except (ValueError, TypeError, KeyError):
+                stats = {'hits': 0, 'misses': 0, 'size': sum(file_size for _, file_size, _ in cached_files())}
+            for name, value in changes.items():
+                stats[name] += value
+            stats.update(values or {})
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(stats))
+        finally:
+            locks.unlock(file)
+    return stats
+
+def record(event):
+    # Counts a hit or a miss, added to the stats file with the other ones of the process
+    with _lock:
+        _pending[event] += 1
+        due = (sum(_pending.values()) >= STATS_FLUSH_EVENTS
+               or time.monotonic() - _last_flush >= STATS_FLUSH_INTERVAL)
+    if due:
+        flush_stats()
+
+def flush_stats():
+    # Adds hits and misses counted by this process to the stats file
+    global _last_flush
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+    try:
+        update_stats(**pending)
+    except Exception:
+        # Counted again at the next flush
+        with _lock:
+            _pending.update(pending)
+        raise
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush_stats()
+    except Exception:
+        pass
+
+def open_cached(content_hash, key, extension):
+    '''
+    Opens a cached grid and marks it as recently used. Returns the file opened in binary mode, None if it is not cached.
+    '''
+
+    path = cache_path(content_hash, key, extension)
+    try:
+        file = open(path, 'rb')
+        os.utime(path)
+    except FileNotFoundError:
+        record('misses')
+        return None
+    record('hits')
+    return file
+
+def cache_stream(chunks, content_hash, key, extension):
+    '''
+    Yields chunks of a grid while writing them to the cache. The grid is cached only if all chunks are written,
+    then the least recently used grids are removed if the cache is too big. Grids bigger than
+    settings.GRID_CACHE_MAX_FILE_SIZE (or than the whole cache) are only sent, writing stops when they reach it.
+    '''
+
+    path = cache_path(content_hash, key, extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}_{threading.get_ident()}{TEMPORARY_SUFFIX}"
+    max_file_size = min(settings.GRID_CACHE_MAX_FILE_SIZE, settings.GRID_CACHE_MAX_SIZE)
+    written = 0
+    file = open(temporary_path, 'wb')
+    try:
+        for chunk in chunks:
+            if file is not None:
+                written += len(chunk)
+                if written > max_file_size:
+                    # Too big to be cached, the rest of the grid is only sent
+                    file.close()
+                    file = None
+                    os.remove(temporary_path)
+                else:
+                    file.write(chunk)
+            yield chunk
+        if file is None:
+            return
+        file.close()
+        # Counted before the grid is in the cache, so a scan making the stats file does not count it twice
+        size = update_stats(size=written)['size']
+        try:
+            os.replace(temporary_path, path)
+        except FileNotFoundError:
+            # Grids of the stored image were removed in the meantime
+            update_stats(size=-written)
+            return
+    finally:
+        if file is not None:
+            file.close()
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    if size > settings.GRID_CACHE_MAX_SIZE:
+        evict()
+
+def cached_files():
+    # Returns (last use, size, path) of every cached grid
+    files = []
+    if not os.path.isdir(settings.GRID_CACHE_DIR):
+        return files
+    for directory in os.scandir(settings.GRID_CACHE_DIR):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            if entry.name.endswith(TEMPORARY_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    return files
+
+def evict(max_size=None):
+    '''
+    Removes the least recently used grids until the cache uses at most max_size bytes (settings.GRID_CACHE_MAX_SIZE if None).
+    '''
+
+    max_size = settings.GRID_CACHE_MAX_SIZE if max_size is None else max_size
+    files = cached_files()
+    size = sum(file_size for _, file_size, _ in files)
+    for _, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= file_size
+    update_stats({'size': size})
+
+def invalidate(content_hash):
+    # Removes the grids of a stored image
+    directory = os.path.join(settings.GRID_CACHE_DIR, content_hash)
+    try:
+        removed = sum(entry.stat().st_size for entry in os.scandir(directory) if not entry.name.endswith(TEMPORARY_SUFFIX))
+    except FileNotFoundError:
+        return
+    shutil.rmtree(directory, ignore_errors=True)
+    update_stats(size=-removed)
+
+def cache_stats():
+    '''
+    Returns dictionary with hits, misses, hit_rate (None if there were no requests), number of files and size in bytes.
+    Hits and misses of other processes not yet added to the stats file are not counted.
+    '''
+
+    flush_stats()
+    stats = update_stats()
+    hits, misses = stats['hits'], stats['misses']
+    files = cached_files()
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else None,
+        'files': len(files),
+        'size': sum(file_size for _, file_size, _ in files),
+    }
+
+def reset_stats():
+    with _lock:
+        _pending.clear()
+    update_stats({'hits': 0, 'misses': 0})
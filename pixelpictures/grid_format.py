@@ -0,0 +1,234 @@
+import json
+import struct
+import zlib
+import numpy as np
+
+from django.conf import settings
+
+# Binary format of pixel grids, used by endpoints when requested with Content-Type or Accept headers.
+#
+# All numbers are little-endian. The header is followed by the palette (n_colors * channels bytes),
+# the indices of the palette for every pixel (row by row) and the metadata (UTF-8 JSON).
+# If flag RLE is set, indices are stored as n_runs run lengths (uint16) followed by n_runs indices.
+GRID_CONTENT_TYPE = "application/x-pixel-grid"
+MAGIC = b"PXGR"
+# magic, flags, channels, height, width, n_colors, index size in bytes, n_runs, length of metadata
+HEADER = struct.Struct("<4sBBHHIBII")
+FLAG_RLE = 1
+MAX_RUN = 2 ** 16 - 1
+# Height and width are stored in 16 bits
+MAX_SIDE = 2 ** 16 - 1
+
+INDEX_TYPES = {1: np.dtype("<u1"), 2: np.dtype("<u2"), 4: np.dtype("<u4")}
+
+def index_size(n_colors):
+    '''
+    Returns the number of bytes needed to store indices of a palette of n_colors.
+    '''
+
+    for size in INDEX_TYPES:
+        if n_colors <= 2 ** (8 * size):
+            return size
+    raise ValueError("Too many colors.")
+
+def check_size(height, width, max_pixels=None):
+    '''
+    Raises ValueError if a grid of height x width pixels cannot be encoded, or has more than max_pixels pixels
+    (settings.MAX_GRID_PIXELS if None). Grids are checked before they are allocated.
+    '''
+
+    max_pixels = settings.MAX_GRID_PIXELS if max_pixels is None else max_pixels
+    if height > MAX_SIDE or width > MAX_SIDE:
+        raise ValueError(f"Height and width cannot be greater than {MAX_SIDE}.")
+    if height * width > max_pixels:
+        raise ValueError(f"Image cannot have more than {max_pixels} pixels.")
+
+def run_lengths(indices):
+    '''
+    Run-length encodes a 1D np.array.
+
+    Returns
+    -------
+        lengths : np.array of uint16, lengths of runs (runs longer than MAX_RUN are split)
+        values : np.array, value of each run
+    '''
+
+    if indices.size == 0:
+        return np.zeros(0, dtype=np.uint16), indices
+
+    starts = np.flatnonzero(np.diff(indices)) + 1
+    starts = np.concatenate([[0], starts])
+    lengths = np.diff(starts, append=indices.size)
+    values = indices[starts]
+
+    # Split long runs in pieces of MAX_RUN, the last piece has the remaining length
+    pieces = (lengths + MAX_RUN - 1) // MAX_RUN
+    if (pieces > 1).any():
+        last = np.cumsum(pieces) - 1
+        split_lengths = np.full(pieces.sum(), MAX_RUN)
+        split_lengths[last] = lengths - MAX_RUN * (pieces - 1)
+        lengths = split_lengths
+        values = np.repeat(values, pieces)
+
+    return lengths.astype(np.uint16), values
+
+def encode_indexed(palette, indices, metadata=None, rle=None, max_pixels=None):
+    '''
+    Encodes a palette-indexed grid in binary format.
+
+    Parameters
+    ----------
+        palette : array-like of shape (n_colors, channels), containing colors with ints between 0 and 255
+        indices : array-like of shape (height, width), containing indices of palette
+        metadata : optional JSON serializable object, sent together with the grid
+        rle : bool, if indices are run-length encoded. If None the smaller encoding is chosen.
+        max_pixels : int, see check_size
+
+    Returns
+    -------
+        bytes
+
+    Raises ValueError if the grid is too big.
+    '''
+
+    palette = np.asarray(palette, dtype=np.uint8).reshape(len(palette), -1)
+    indices = np.asarray(indices)
+    height, width = indices.shape
+    check_size(height, width, max_pixels)
+    size = index_size(len(palette))
+    index_type = INDEX_TYPES[size]
+    flat = indices.ravel().astype(index_type)
+
+    lengths, values = run_lengths(flat)
+    if rle is None:
+        rle = lengths.nbytes + values.nbytes < flat.nbytes
+
+    metadata = json.dumps(metadata).encode() if metadata is not None else b""
+    header = HEADER.pack(MAGIC, FLAG_RLE if rle else 0, palette.shape[1], height, width, len(palette), size,
+                         len(lengths) if rle else 0, len(metadata))
+    body = [lengths.tobytes(), values.tobytes()] if rle else [flat.tobytes()]
+
+    return b"".join([header, palette.tobytes(), *body, metadata])
+
+def encode_grid(image_arr, metadata=None, rle=None, max_pixels=None):
+    '''
+    Encodes an image (array of colors) in binary format, the palette contains the unique colors of the image.
+
+    Parameters
+    ----------
+        image_arr : array-like of shape (height, width, channels), containing colors with ints between 0 and 255
+        metadata : optional JSON serializable object, sent together with the grid
+        rle : bool, if indices are run-length encoded. If None the smaller encoding is chosen.
+        max_pixels : int, see check_size
+
+    Returns
+    -------
+        bytes
+
+    Raises ValueError if the grid is too big.
+    '''
+
+    image_arr = np.asarray(image_arr, dtype=np.uint8)
+    height, width, channels = image_arr.shape
+    check_size(height, width, max_pixels)
+
+    # Colors packed in one int, to find unique colors
+    keys = np.zeros((height, width), dtype=np.uint32)
+    for channel in range(channels):
+        keys = (keys << 8) | image_arr[..., channel]
+    unique, inverse = np.unique(keys, return_inverse=True)
+
+    palette = np.stack([(unique >> (8 * (channels - 1 - channel))) & 255 for channel in range(channels)], axis=-1)
+    return encode_indexed(palette.reshape(-1, channels), inverse.reshape(height, width), metadata, rle, max_pixels)
+
+def decode_indexed(data, max_pixels=None):
+    '''
+    Decodes a grid in binary format, arrays are read directly from data.
+
+    Parameters
+    ----------
+        data : bytes
+        max_pixels : int, grids with more pixels are rejected before they are expanded (see check_size)
+
+    Returns
+    -------
+        palette : np.array of shape (n_colors, channels) of uint8
+        indices : np.array of shape (height, width)
+        metadata : object decoded from JSON, None if there is no metadata
+
+    Raises ValueError if data is not a valid grid or it is too big.
+    '''
+
+    if len(data) < HEADER.size:
+        raise ValueError("Not a pixel grid.")
+
+    magic, flags, channels, height, width, n_colors, size, n_runs, metadata_length = HEADER.unpack_from(data)
+    if magic != MAGIC or size not in INDEX_TYPES:
+        raise ValueError("Not a pixel grid.")
+    check_size(height, width, max_pixels)
+
+    index_type = INDEX_TYPES[size]
+    offset = HEADER.size
+    palette_length = n_colors * channels
+    if flags & FLAG_RLE:
+        indices_length = n_runs * (2 + size)
+    else:
+        indices_length = height * width * size
+    if len(data) != offset + palette_length + indices_length + metadata_length:
+        raise ValueError("Pixel grid has wrong length.")
+
+    palette = np.frombuffer(data, dtype=np.uint8, count=palette_length, offset=offset).reshape(n_colors, channels)
+    offset += palette_length
+
+    if flags & FLAG_RLE:
+        lengths = np.frombuffer(data, dtype="<u2", count=n_runs, offset=offset)
+        values = np.frombuffer(data, dtype=index_type, count=n_runs, offset=offset + 2 * n_runs)
+        if lengths.sum() != height * width:
+            raise ValueError("Pixel grid has wrong length.")
+        indices = np.repeat(values, lengths)
+    else:
+        indices = np.frombuffer(data, dtype=index_type, count=height * width, offset=offset)
+    offset += indices_length
+
+    if indices.size and indices.max() >= n_colors:
+        raise ValueError("Pixel grid has indices out of palette.")
+
+    metadata = json.loads(data[offset:].decode()) if metadata_length else None
+
+    return palette, indices.reshape(height, width), metadata
+
+def decode_grid(data, max_pixels=None):
+    '''
+    Decodes a grid in binary format as an image (see decode_indexed).
+
+    Returns
+    -------
+        image_arr : np.array of shape (height, width, channels) of uint8, colors of every pixel
+        metadata : object decoded from JSON, None if there is no metadata
+    '''
+
+    palette, indices, metadata = decode_indexed(data, max_pixels)
+    return palette[indices], metadata
+
+def compress_grid(image_arr):
+    '''
+    Encodes an image in binary format (indices are not run-length encoded) compressed with zlib, used to store pictures.
+    '''
+
+    return zlib.compress(encode_grid(image_arr, rle=False))
+
+def decompress_indexed(data):
+    '''
+    Returns palette and indices of an image compressed with compress_grid (see decode_indexed).
+    '''
+
+    palette, indices, _ = decode_indexed(zlib.decompress(data))
+    return palette, indices
+
+def decompress_grid(data):
+    '''
+    Inverse of compress_grid, returns np.array of shape (height, width, channels) of uint8.
+    '''
+
+    image_arr, _ = decode_grid(zlib.decompress(data))
+    return image_arr
@@ -0,0 +1,175 @@
+import struct
+import zlib
+import numpy as np
+
+from .image_to_pixels import grid_size, grid_tile, render_grid
+
+# Big grids are written while they are drawn, in bands of rows (PNG) or one tile per page (PDF),
+# so memory used does not depend on the height of the picture. Bands have at least one row, so PNGs wider than
+# BAND_PIXELS use memory proportional to their width (bounded by the limits of downloads in views.py).
+
+# Pixels drawn at once in PNGs, in bands of whole rows
+BAND_PIXELS = 2 ** 20
+# Largest width and height of PNGs
+PNG_MAX_SIDE = 2 ** 31 - 1
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COMPRESSION = 6
+# Cells in a page of PDFs
+TILE_ROWS = 60
+TILE_COLS = 40
+# A4 page and its margin, in points
+PAGE_SIZE = (595, 842)
+PAGE_MARGIN = 36
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+def filter_rows(rows, previous):
+    '''
+    Filters rows of pixels of a PNG: rows equal to the previous one (most rows in a cell) are filtered with Up,
+    that makes them zeros, the others with Sub.
+
+    Parameters
+    ----------
+        rows : np.array of shape (n, width * 3) of uint8
+        previous : np.array of shape (width * 3,), row before rows (zeros for the first row of the image)
+
+    Returns
+    -------
+        bytes, every row preceded by the type of its filter
+    '''
+
+    up = rows.copy()
+    up[0] -= previous
+    up[1:] -= rows[:-1]
+    sub = rows.copy()
+    sub[:, 3:] -= rows[:, :-3]
+
+    use_up = ~up.any(axis=1)
+    filtered = np.where(use_up[:, None], up, sub)
+    filter_types = np.where(use_up, 2, 1).astype(np.uint8)[:, None]
+    return np.hstack([filter_types, filtered]).tobytes()
+
+def png_bands(width, height, draw_band, band_pixels=BAND_PIXELS):
+    '''
+    Writes a PNG of width x height pixels, drawn in bands of rows with about band_pixels pixels
+    (at least one row, so max(band_pixels, width) pixels are drawn at once).
+    Raises ValueError if the size is not valid for PNGs, when called and not while writing.
+
+    Parameters
+    ----------
+        width, height : ints
+        draw_band : function of the first row of a band and the row after the last one, returning its pixels
+                    as np.array or PIL.Image in mode "RGB"
+        band_pixels : int
+
+    Returns
+    -------
+        generator of bytes of the PNG
+    '''
+
+    if not (0 < width <= PNG_MAX_SIDE and 0 < height <= PNG_MAX_SIDE):
+        raise ValueError(f"Width and height of PNGs must be between 1 and {PNG_MAX_SIDE} pixels.")
+    return _png_bands(width, height, draw_band, band_pixels)
+
+def _png_bands(width, height, draw_band, band_pixels):
+    band_height = max(1, band_pixels // width)
+    yield PNG_SIGNATURE + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    compressor = zlib.compressobj(PNG_COMPRESSION)
+    previous = np.zeros(width * 3, dtype=np.uint8)
+    for top in range(0, height, band_height):
+        rows = np.asarray(draw_band(top, min(top + band_height, height))).reshape(-1, width * 3)
+        data = compressor.compress(filter_rows(rows, previous))
+        previous = rows[-1]
+        if data:
+            yield png_chunk(b"IDAT", data)
+
+    yield png_chunk(b"IDAT", compressor.flush()) + png_chunk(b"IEND", b"")
+
+def png_stream(layout, band_pixels=BAND_PIXELS):
+    # Image of a grid as a PNG (see image_to_pixels.render_grid)
+    width, height = grid_size(layout)
+    return png_bands(width, height, lambda top, bottom: render_grid(layout, top, bottom), band_pixels)
+
+def plain_png_stream(layout, band_pixels=BAND_PIXELS):
+    # Cells of a grid as a PNG, size_cell x size_cell pixels for every cell, without lines, numbers and border
+    rows, cols = layout.cells.shape[:2]
+    size_cell = layout.size_cell
+
+    def draw_band(top, bottom):
+        return layout.cells[np.arange(top, bottom) // size_cell].repeat(size_cell, axis=1)
+
+    return png_bands(cols * size_cell, rows * size_cell, draw_band, band_pixels)
+
+def grid_tiles(layout, tile_rows=TILE_ROWS, tile_cols=TILE_COLS):
+    # Tiles of a grid of at most tile_rows x tile_cols cells, row by row. Numbers are the same of the whole grid
+    rows, cols = layout.cells.shape[:2]
+    return [grid_tile(layout, slice(row, row + tile_rows), slice(col, col + tile_cols))
+            for row in range(0, max(rows, 1), tile_rows) for col in range(0, max(cols, 1), tile_cols)]
+
+def pdf_stream(layout, tile_rows=TILE_ROWS, tile_cols=TILE_COLS):
+    '''
+    Writes a grid as a printable PDF, one page for every tile of tile_rows x tile_cols cells (see grid_tiles).
+    Tiles are drawn one at a time, each one scaled to fit an A4 page.
+
+    Parameters
+    ----------
+        layout : image_to_pixels.GridLayout
+        tile_rows, tile_cols : ints
+
+    Yields
+    ------
+        bytes of the PDF
+    '''
+
+    tiles = grid_tiles(layout, tile_rows, tile_cols)
+    offsets = []
+    written = 0
+
+    def write_object(body, stream=None):
+        # Objects are numbered in the order they are written, from 1
+        nonlocal written
+        offsets.append(written)
+        data = f"{len(offsets)} 0 obj\n".encode() + body
+        if stream is not None:
+            data += b"\nstream\n" + stream + b"\nendstream"
+        data += b"\nendobj\n"
+        written += len(data)
+        return data
+
+    header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    written = len(header)
+    yield header
+
+    # Objects of page i are 3 + 3 * i (page), 4 + 3 * i (content) and 5 + 3 * i (image)
+    kids = " ".join(f"{3 + 3 * i} 0 R" for i in range(len(tiles)))
+    yield write_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+    yield write_object(f"<< /Type /Pages /Kids [{kids}] /Count {len(tiles)} >>".encode())
+
+    page_width, page_height = PAGE_SIZE
+    for i, tile in enumerate(tiles):
+        image = render_grid(tile)
+        scale = min((page_width - 2 * PAGE_MARGIN) / image.width, (page_height - 2 * PAGE_MARGIN) / image.height)
+        width, height = image.width * scale, image.height * scale
+        x, y = (page_width - width) / 2, (page_height - height) / 2
+        pixels = zlib.compress(image.tobytes(), PNG_COMPRESSION)
+        content = f"q {width:.2f} 0 0 {height:.2f} {x:.2f} {y:.2f} cm /Im0 Do Q".encode()
+
+        yield write_object(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width} {page_height}] "
+                           f"/Resources << /XObject << /Im0 {5 + 3 * i} 0 R >> >> /Contents {4 + 3 * i} 0 R >>".encode())
+        yield write_object(f"<< /Length {len(content)} >>".encode(), content)
+        yield write_object(f"<< /Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} "
+                           f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length {len(pixels)} >>".encode(), pixels)
+
+    xref = [f"xref\n0 {len(offsets) + 1}\n", "0000000000 65535 f \n"] + [f"{offset:010d} 00000 n \n" for offset in offsets]
+    trailer = f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{written}\n%%EOF\n"
+    yield ("".join(xref) + trailer).encode()
+
+# Formats of downloads of grids: function writing them, content type and extension of files
+GRID_STREAMS = {
+    'png': (png_stream, "image/png", "png"),
+    'pdf': (pdf_stream, "application/pdf", "pdf"),
+    # Picture upscaled without grid, drawn by the server so it can be downloaded from any storage
+    'plain': (plain_png_stream, "image/png", "png"),
+}
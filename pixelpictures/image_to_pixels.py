@@ -1,6 +1,8 @@
 import numpy as np 
 from PIL import Image, ImageDraw, ImageFont
 import math
+import functools
+from collections import namedtuple
 
 def distance_colors(color1, color2):
     '''
@@ -40,7 +42,75 @@ def get_color(prev_color, colors):
             closer_color = color
     return closer_color
 
-def resize(grid_width, grid_height, image):
+# Resampling modes of resize
+RESIZE_MODES = ('nearest', 'area')
+
+def block_sums(arr, height, width):
+    '''
+    Splits an image array in height x width blocks and sums the pixels of each block.
+
+    Parameters
+    ----------
+        arr : np.array of shape (H, W, c), with H >= height and W >= width
+        height, width : ints, number of blocks in each direction
+    
+    Returns
+    -------
+        sums : np.array of shape (height, width, c), sum of the pixels of every block
+        counts : np.array of shape (height, width, 1), number of pixels of every block
+    '''
+
+    arr_height, arr_width, channels = arr.shape
+    # Edges of blocks, if ratio is not an integer blocks have different sizes
+    rows = np.arange(height + 1) * arr_height // height
+    cols = np.arange(width + 1) * arr_width // width
+
+    # Rows are summed first, so that the big array is read in contiguous blocks
+    if arr_height % height == 0:
+        row_sums = arr.reshape(height, arr_height // height, arr_width, channels).sum(axis=1, dtype=np.uint64)
+    else:
+        row_sums = np.stack([arr[start:end].sum(axis=0, dtype=np.uint64) for start, end in zip(rows[:-1], rows[1:])])
+
+    if arr_width % width == 0:
+        sums = row_sums.reshape(height, width, arr_width // width, channels).sum(axis=2)
+    else:
+        sums = np.add.reduceat(row_sums, cols[:-1], axis=1)
+
+    counts = np.diff(rows)[:, np.newaxis] * np.diff(cols)[np.newaxis, :]
+    return sums, counts[..., np.newaxis]
+
+def area_resize(image, size):
+    '''
+    Resizes an image averaging blocks of pixels, transparent pixels do not change the color of a block.
+
+    Parameters
+    ----------
+        image : PIL.Image, not smaller than size
+        size : 2-tuple of ints, width and height of the resized image
+    
+    Returns
+    -------
+        PIL.Image in RGBA mode.
+    '''
+
+    width, height = size
+
+    if image.mode not in ('RGBA', 'LA', 'PA') and 'transparency' not in image.info:
+        color_sums, counts = block_sums(np.array(image.convert("RGB")), height, width)
+        color = color_sums / counts
+        alpha = np.full(counts.shape, 255)
+    else:
+        # Colors weighted by alpha
+        pixels = np.array(image.convert("RGBA"))
+        alpha = pixels[..., 3:].astype(np.uint16)
+        color_sums, counts = block_sums(pixels[..., :3] * alpha, height, width)
+        alpha_sums, _ = block_sums(alpha, height, width)
+        color = color_sums / np.maximum(alpha_sums, 1)
+        alpha = alpha_sums / counts
+
+    return Image.fromarray(np.rint(np.concatenate([color, alpha], axis=-1)).astype(np.uint8), "RGBA")
+
+def resize(grid_width, grid_height, image, mode='nearest'):
     '''
     Resizes an image.
 
@@ -49,6 +119,7 @@ def resize(grid_width, grid_height, image):
         grid_width : int, desired width
         grid_height : int, desired height
         image : PIL.Image
+        mode : str, 'nearest' to take one pixel for each cell, 'area' to average the pixels of each cell
     
     Returns
     -------
@@ -58,21 +129,544 @@ def resize(grid_width, grid_height, image):
     image_width = image.width
     image_height = image.height
 
-    image = image.convert("RGBA")
-
     a = min(grid_height / image_height, grid_width / image_width)
+    size = (math.ceil(image_width * a), math.ceil(image_height * a))
 
-    resized = image.resize((math.ceil(image_width * a), math.ceil(image_height * a)), Image.NEAREST)
+    # JPEG images are decoded at reduced scale, not smaller than size. Image is converted after
+    # resizing (same result with nearest resampling), so that the full image is never converted to RGBA.
+    image.draft(image.mode, size)
+    if mode == 'area' and image.width >= size[0] and image.height >= size[1]:
+        resized = area_resize(image, size)
+    else:
+        resized = image.resize(size, Image.NEAREST).convert("RGBA")
     
     background = Image.new("RGBA", (grid_width, grid_height), (255, 255, 255))
     background.paste(resized, ((grid_width - int(image_width * a))//2, (grid_height - int(image_height * a))//2), mask=resized)
 
     return background
 
-def to_pixels(image_arr, colors):
+# Side of the thumbnail of an image whose pixels are used to extract palettes
+PALETTE_THUMBNAIL = 256
+# Maximum number of pixels sampled to extract palettes
+PALETTE_SAMPLE = 8192
+
+def median_cut(pixels, n_colors):
+    '''
+    Finds a palette of colors representing pixels with median cut: the set of pixels with largest range
+    in a channel is split in two at the median of that channel, until there are n_colors sets.
+
+    Parameters
+    ----------
+        pixels : np.array of shape (n, 3), containing colors
+        n_colors : int, maximum number of colors of the palette
+    
+    Returns
+    -------
+        np.array of shape (m, 3) of ints, mean color of each set, m <= n_colors (less if pixels have less colors).
+    '''
+
+    def new_box(box):
+        ranges = np.ptp(box, axis=0)
+        return ranges.max(), ranges.argmax(), box
+
+    boxes = [new_box(pixels)]
+    while len(boxes) < n_colors:
+        i = max(range(len(boxes)), key=lambda j: boxes[j][0])
+        max_range, channel, box = boxes[i]
+        if max_range == 0:
+            break
+
+        box = box[box[:, channel].argsort(kind='stable')]
+        # Split at the median, between different values, so that equal colors stay in the same set
+        values = box[:, channel]
+        half = np.searchsorted(values, values[len(box) // 2])
+        if half == 0:
+            half = np.searchsorted(values, values[len(box) // 2], side='right')
+        boxes[i] = new_box(box[:half])
+        boxes.append(new_box(box[half:]))
+
+    return np.array([box.mean(axis=0) for _, _, box in boxes]).round().astype(int)
+
+def extract_palette(image, n_colors):
+    '''
+    Proposes a palette for an image. Only a sample of pixels of a thumbnail is used, so cost does not depend on image size.
+
+    Parameters
+    ----------
+        image : PIL.Image
+        n_colors : int, maximum number of colors of the palette
+    
+    Returns
+    -------
+        list of lists of 3 ints, representing colors. Transparent pixels are ignored.
+    '''
+
+    # For JPEG images thumbnail decodes directly a reduced image
+    image.thumbnail((PALETTE_THUMBNAIL, PALETTE_THUMBNAIL), Image.NEAREST)
+    pixels = np.array(image.convert("RGBA")).reshape(-1, 4)
+    pixels = pixels[pixels[:, 3] > 0, :3].astype(np.int64)
+
+    if len(pixels) == 0:
+        return [[255, 255, 255]]
+    if len(pixels) > PALETTE_SAMPLE:
+        pixels = pixels[np.random.default_rng(0).choice(len(pixels), PALETTE_SAMPLE, replace=False)]
+
+    return median_cut(pixels, n_colors).tolist()
+
+# Maximum number of pixel-color distances computed at once, bounds memory used by nearest_colors.
+CHUNK_SIZE = 2 ** 20
+
+def color_array(colors):
+    '''
+    Converts colors to a numpy array that can be used in vectorized distance computations.
+
+    Parameters
+    ----------
+        colors : array-like, containing lists or tuples representing colors (extra channels, like alpha, are ignored)
+
+    Returns
+    -------
+        np.array with last dimension 3, integer colors are converted to int64 so that operations do not overflow.
+    '''
+
+    colors = np.asarray(colors)[..., :3]
+    if colors.dtype.kind in 'iub':
+        return colors.astype(np.int64)
+    return colors.astype(np.float64)
+
+def distances_to_palette(pixels, palette):
+    '''
+    Computes the square distance (same formula as distance_colors) between every pixel and every color in palette.
+
+    Parameters
+    ----------
+        pixels : np.array of shape (n, 3), colors of the pixels
+        palette : np.array of shape (k, 3), colors of the palette
+
+    Returns
+    -------
+        np.array of shape (n, k), element [i, j] is distance_colors(pixels[i], palette[j]).
+    '''
+
+    return distance_colors_arrays(pixels[:, np.newaxis, :], palette)
+
+def distance_colors_arrays(colors1, colors2):
+    '''
+    Vectorized distance_colors, computes the distances between colors in two arrays (broadcasted).
+
+    Parameters
+    ----------
+        colors1, colors2 : np.arrays with last dimension 3, representing colors
+    
+    Returns
+    -------
+        np.array, distance_colors of corresponding colors in colors1 and colors2.
+    '''
+
+    # Operations are done in the same order as distance_colors, so that results are exactly the same.
+    r = (colors1[..., 0] + colors2[..., 0]) / 2
+    diff = colors1 - colors2
+    return (2 + r / 256) * diff[..., 0] ** 2 + 4 * diff[..., 1] ** 2 + (2 + (255 - r) / 256) * diff[..., 2] ** 2
+
+def nearest_colors(image_arr, colors, chunk_size=CHUNK_SIZE):
+    '''
+    Finds, for every pixel of an image, the index of the closer color in colors.
+
+    Parameters
+    ----------
+        image_arr : array-like of shape (height, width, 3 or 4), representing an image
+        colors : list, containing tuples representing colors
+        chunk_size : int, maximum number of distances computed at once, the image is processed in chunks of rows
+
+    Returns
+    -------
+        np.array of shape (height, width), containing indices of colors. When two colors have the same distance
+        the first one is chosen, as in get_color.
+    '''
+
+    image_arr = color_array(image_arr)
+    palette = color_array(colors)
+    pixels = image_arr.reshape(-1, 3)
+
+    # Pixels are flattened row by row, so chunks are consecutive rows (or parts of a row for very wide images)
+    indices = np.empty(len(pixels), dtype=np.intp)
+    step = max(1, chunk_size // max(1, len(palette)))
+    for start in range(0, len(pixels), step):
+        indices[start:start + step] = distances_to_palette(pixels[start:start + step], palette).argmin(axis=1)
+
+    return indices.reshape(image_arr.shape[:-1])
+
+# Levels per channel of the color lookup tables, every cell of a table contains (256 // LUT_LEVELS) ** 3 colors.
+LUT_LEVELS = 32
+# Maximum number of palettes whose lookup table is kept in memory.
+LUT_CACHE_SIZE = 64
+# Levels per channel of the palette index, coarser than lookup tables.
+INDEX_LEVELS = 8
+# Palettes with at least this number of colors use the palette index to find closer colors and to build lookup tables.
+# Default of the index_min_palette parameters (the app uses settings.INDEX_MIN_PALETTE).
+INDEX_MIN_PALETTE = 64
+# Maximum number of palettes whose index is kept in memory.
+INDEX_CACHE_SIZE = 64
+
+def _square_bounds(low, high, value):
+    '''
+    Returns minimum and maximum of (x - value) ** 2 for x between low and high (np.arrays, broadcasted).
+    '''
+
+    below = (low - value) ** 2
+    above = (high - value) ** 2
+    inside = (low <= value) & (value <= high)
+    return np.where(inside, 0, np.minimum(below, above)), np.maximum(below, above)
+
+def refine_candidates(palette, candidates, levels):
+    '''
+    Finds, for every cell of the RGB cube, the palette colors that can be the closer color of some color in the cell.
+
+    Parameters
+    ----------
+        palette : np.array of shape (k, 3), containing integer colors
+        candidates : np.array of shape (coarse, coarse, coarse, c), candidates of cells of a coarser grid
+            (sorted indices of palette, padded with -1). Every cell of the coarser grid is split in smaller cells.
+        levels : int, number of cells per channel of the new grid, must divide 256 and be a multiple of coarse
+
+    Returns
+    -------
+        np.array of shape (levels, levels, levels, c') with candidates of every cell, sorted and padded with -1.
+    '''
+
+    side = 256 // levels
+    low = (np.arange(levels) * side)[:, np.newaxis]
+    high = low + side - 1
+
+    # Bounds of each term of distance_colors, for every cell of a channel and every palette color: arrays (levels, k).
+    # Weights of red and blue depend on red channel only.
+    red_low = (low + palette[:, 0]) / 2
+    red_high = (high + palette[:, 0]) / 2
+    dr_min, dr_max = _square_bounds(low, high, palette[:, 0])
+    dg_min, dg_max = _square_bounds(low, high, palette[:, 1])
+    db_min, db_max = _square_bounds(low, high, palette[:, 2])
+    r_term_min = (2 + red_low / 256) * dr_min
+    r_term_max = (2 + red_high / 256) * dr_max
+    g_term_min = 4 * dg_min
+    g_term_max = 4 * dg_max
+    b_weight_min = 2 + (255 - red_high) / 256
+    b_weight_max = 2 + (255 - red_low) / 256
+
+    coarse = np.arange(levels) // (levels // len(candidates))
+    cells = np.arange(levels)
+    g = cells[:, np.newaxis, np.newaxis]
+    b = cells[np.newaxis, :, np.newaxis]
+
+    refined = []
+    for r in range(levels):
+        # Candidates of the coarser cell of every cell with red r: array (levels, levels, c),
+        # or (c,) broadcasted to all cells if the coarser grid has only one cell
+        if len(candidates) == 1:
+            cell_candidates = candidates[0, 0, 0]
+        else:
+            cell_candidates = candidates[coarse[r]][coarse[:, np.newaxis], coarse[np.newaxis, :]]
+        padding = cell_candidates < 0
+        k = np.where(padding, 0, cell_candidates)
+
+        lower = r_term_min[r][k] + g_term_min[g, k] + b_weight_min[r][k] * db_min[b, k]
+        upper = r_term_max[r][k] + g_term_max[g, k] + b_weight_max[r][k] * db_max[b, k]
+        lower = np.where(padding, np.inf, lower)
+        upper = np.where(padding, np.inf, upper)
+
+        # A color can be the closer one for some color in the cell only if its lower bound is smaller than
+        # the upper bound of every other color. Margin is much bigger than floating point errors of distances.
+        keep = lower <= upper.min(axis=-1, keepdims=True) + 1e-6
+        kept = np.where(keep, cell_candidates, -1)
+
+        # Kept candidates first, in the same (increasing) order. Most cells keep only one candidate.
+        first = np.take_along_axis(kept, keep.argmax(axis=-1)[..., np.newaxis], axis=-1)
+        cells_refined = np.where(np.arange(kept.shape[-1]) == 0, first, -1)
+        several = keep.sum(axis=-1) > 1
+        order = np.argsort(~keep[several], axis=-1, kind='stable')
+        cells_refined[several] = np.take_along_axis(kept[several], order, axis=-1)
+        refined.append(cells_refined)
+
+    refined = np.stack(refined)
+    return refined[..., :max(1, (refined >= 0).sum(axis=-1).max())]
+
+def build_palette_index(palette, levels=INDEX_LEVELS):
+    '''
+    Builds a grid index of palette: the RGB cube is split in cells, every cell contains the palette colors that can be
+    the closer color (using distance_colors) of some color in the cell.
+
+    Parameters
+    ----------
+        palette : np.array of shape (k, 3), containing integer colors
+        levels : int, number of cells per channel, must divide 256
+
+    Returns
+    -------
+        np.array of shape (levels, levels, levels, c), candidates of every cell (sorted indices of palette, padded with -1).
+    '''
+
+    return refine_candidates(palette, np.arange(len(palette)).reshape(1, 1, 1, -1), levels)
+
+@functools.lru_cache(maxsize=INDEX_CACHE_SIZE)
+def _cached_index(palette_bytes, levels):
+    palette = np.frombuffer(palette_bytes, dtype=np.int64).reshape(-1, 3)
+    index = build_palette_index(palette, levels)
+    index.flags.writeable = False
+    return index
+
+def get_palette_index(colors, levels=INDEX_LEVELS):
+    '''
+    Returns the index of colors (see build_palette_index), built once per palette and kept in a LRU cache.
+    '''
+
+    return _cached_index(color_array(colors).astype(np.int64).tobytes(), levels)
+
+def _nearest_candidates(pixels, palette, candidates, chunk_size=CHUNK_SIZE):
+    '''
+    Returns np.array with the index of the closer color to every pixel, choosing only between its candidates.
+
+    Parameters
+    ----------
+        pixels : np.array of shape (n, 3), colors of the pixels
+        palette : np.array of shape (k, 3), colors of the palette
+        candidates : np.array of shape (n, c), sorted indices of palette for each pixel, padded with -1
+        chunk_size : int, maximum number of distances computed at once
+    '''
+
+    indices = np.empty(len(pixels), dtype=np.intp)
+    step = max(1, chunk_size // max(1, candidates.shape[1]))
+    for start in range(0, len(pixels), step):
+        chunk = candidates[start:start + step]
+        distances = distance_colors_arrays(pixels[start:start + step, np.newaxis], palette[chunk])
+        distances[chunk < 0] = np.inf
+        indices[start:start + step] = np.take_along_axis(chunk, distances.argmin(axis=-1)[:, np.newaxis], axis=-1)[:, 0]
+
+    return indices
+
+def indexed_nearest_colors(image_arr, colors, levels=INDEX_LEVELS, chunk_size=CHUNK_SIZE):
+    '''
+    Same as nearest_colors, compares every pixel only with the candidates of its cell in the palette index of colors.
+
+    Parameters
+    ----------
+        image_arr : array-like of shape (height, width, 3 or 4), representing an image with ints between 0 and 255
+        colors : list, containing tuples of ints representing colors
+        levels : int, number of cells per channel of the index, must divide 256
+        chunk_size : int, maximum number of distances computed at once
+
+    Returns
+    -------
+        np.array of shape (height, width), containing indices of colors.
+    '''
+
+    image_arr = color_array(image_arr)
+    palette = color_array(colors)
+    index = get_palette_index(palette, levels)
+
+    pixels = image_arr.reshape(-1, 3)
+    cells = pixels // (256 // levels)
+    candidates = index[cells[:, 0], cells[:, 1], cells[:, 2]]
+    return _nearest_candidates(pixels, palette, candidates, chunk_size).reshape(image_arr.shape[:-1])
+
+def build_lut(palette, levels=LUT_LEVELS, index_min_palette=INDEX_MIN_PALETTE):
+    '''
+    Builds a lookup table of the closer color in palette for every cell of the RGB cube.
+    Large palettes start from the candidates of the palette index.
+
+    Parameters
+    ----------
+        palette : np.array of shape (k, 3), containing integer colors
+        levels : int, number of cells per channel, must divide 256
+        index_min_palette : int, palettes with at least this number of colors use the palette index
+
+    Returns
+    -------
+        lut : np.array of shape (levels, levels, levels). Element [r, g, b] is the index of the palette color closer to
+            every color in the cell. If the cell is near a decision boundary, it is -1 - i, where i is a row of candidates.
+        candidates : np.array of shape (n, c), row i contains indices (sorted, padded with -1) of palette colors that can be
+            the closer color of some color in a cell near decision boundaries.
+    '''
+
+    if len(palette) >= index_min_palette and levels % INDEX_LEVELS == 0:
+        cell_candidates = refine_candidates(palette, get_palette_index(palette), levels)
+    else:
+        cell_candidates = refine_candidates(palette, np.arange(len(palette)).reshape(1, 1, 1, -1), levels)
+
+    exact = (cell_candidates >= 0).sum(axis=-1) == 1
+    candidates = cell_candidates[~exact]
+    candidates = candidates[:, :(candidates >= 0).sum(axis=-1).max(initial=0)]
+
+    lut = np.where(exact, cell_candidates[..., 0], 0).astype(np.int32)
+    lut[~exact] = -1 - np.arange(len(candidates))
+
+    return lut, candidates.astype(np.int32)
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def _cached_lut(palette_bytes, levels, index_min_palette):
+    palette = np.frombuffer(palette_bytes, dtype=np.int64).reshape(-1, 3)
+    lut, candidates = build_lut(palette, levels, index_min_palette)
+    lut.flags.writeable = False
+    candidates.flags.writeable = False
+    return lut, candidates
+
+def get_lut(colors, levels=LUT_LEVELS, index_min_palette=INDEX_MIN_PALETTE):
+    '''
+    Returns the lookup table of colors (see build_lut), built once per palette and kept in a LRU cache.
+
+    Parameters
+    ----------
+        colors : list, containing tuples of ints representing colors
+        levels : int, number of cells per channel, must divide 256
+        index_min_palette : int, see build_lut
+    
+    Returns
+    -------
+        lut, candidates : read only np.arrays, see build_lut.
+    '''
+
+    # Palettes are hashed by the bytes of their array
+    return _cached_lut(color_array(colors).astype(np.int64).tobytes(), levels, index_min_palette)
+
+def lut_cache_info():
+    '''
+    Returns hits, misses, maxsize and currsize of the cache of lookup tables.
+    '''
+
+    return _cached_lut.cache_info()
+
+def lut_nearest_colors(image_arr, colors, levels=LUT_LEVELS, chunk_size=CHUNK_SIZE, index_min_palette=INDEX_MIN_PALETTE):
+    '''
+    Same as nearest_colors, using the lookup table of colors. Pixels in cells near decision boundaries are compared
+    only with the candidates of their cell.
+
+    Parameters
+    ----------
+        image_arr : array-like of shape (height, width, 3 or 4), representing an image with ints between 0 and 255
+        colors : list, containing tuples of ints representing colors
+        levels : int, number of cells per channel, must divide 256
+        chunk_size : int, maximum number of distances computed at once
+        index_min_palette : int, see build_lut
+
+    Returns
+    -------
+        np.array of shape (height, width), containing indices of colors.
+    '''
+
+    image_arr = color_array(image_arr)
+    palette = color_array(colors)
+    lut, candidates = get_lut(palette, levels, index_min_palette)
+
+    cells = image_arr // (256 // levels)
+    indices = lut[cells[..., 0], cells[..., 1], cells[..., 2]].astype(np.intp)
+
+    boundary = indices < 0
+    if boundary.any():
+        indices[boundary] = _nearest_candidates(image_arr[boundary], palette, candidates[-1 - indices[boundary]], chunk_size)
+
+    return indices
+
+# Only unique colors of an image are quantized when their estimated fraction of the pixels is smaller than this,
+# crossover measured with benchmarks/to_pixels_unique.py
+UNIQUE_RATIO = 0.4
+# Number of pixels sampled to estimate the number of unique colors of an image
+UNIQUE_SAMPLE = 4096
+
+def pack_colors(image_arr):
+    '''
+    Returns np.array of ints, one for each color of image_arr (ints between 0 and 255), as 0xRRGGBB.
+    '''
+
+    return (image_arr[..., 0] << 16) | (image_arr[..., 1] << 8) | image_arr[..., 2]
+
+def unpack_colors(keys):
+    '''
+    Inverse of pack_colors.
+    '''
+
+    return np.stack([keys >> 16, (keys >> 8) & 255, keys & 255], axis=-1)
+
+def estimate_unique_ratio(keys, sample=UNIQUE_SAMPLE):
+    '''
+    Estimates the number of unique values in keys divided by the size of keys.
+
+    Parameters
+    ----------
+        keys : np.array of ints, for example packed colors of an image
+        sample : int, number of values sampled, if keys is not bigger the ratio is exact
+    
+    Returns
+    -------
+        float between 0 and 1.
+    '''
+
+    keys = keys.ravel()
+    if keys.size <= sample:
+        return len(np.unique(keys)) / max(1, keys.size)
+
+    # Chao1 estimator from the number of values seen once and twice in the sample
+    _, counts = np.unique(keys[np.random.default_rng(0).integers(0, keys.size, sample)], return_counts=True)
+    once = (counts == 1).sum()
+    twice = (counts == 2).sum()
+    estimate = len(counts) + once * (once - 1) / (2 * (twice + 1))
+    return min(1, estimate / keys.size)
+
+def unique_nearest_colors(image_arr, colors, method=lut_nearest_colors):
+    '''
+    Same as nearest_colors, finds the closer color only for unique colors of the image, then scatters them back.
+
+    Parameters
+    ----------
+        image_arr : array-like of shape (height, width, 3 or 4), representing an image with ints between 0 and 255
+        colors : list, containing tuples of ints representing colors
+        method : function used to find closer colors of unique colors, like nearest_colors or lut_nearest_colors
+
+    Returns
+    -------
+        np.array of shape (height, width), containing indices of colors.
+    '''
+
+    keys = pack_colors(color_array(image_arr))
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return method(unpack_colors(unique), colors)[inverse].reshape(keys.shape)
+
+def quantize(image_arr, colors, index_min_palette=INDEX_MIN_PALETTE):
+    '''
+    Same as nearest_colors, chooses the fastest method depending on image and colors.
+    Palettes with at least index_min_palette colors use the palette index (see indexed_nearest_colors and build_lut).
+    '''
+
+    image_arr = color_array(image_arr)
+    palette = color_array(colors)
+    if image_arr.size and image_arr.dtype.kind == 'i' and palette.dtype.kind == 'i' \
+            and image_arr.min() >= 0 and image_arr.max() <= 255:
+        if estimate_unique_ratio(pack_colors(image_arr)) < UNIQUE_RATIO:
+            # Few colors do not need the lookup table, that is slower to build for large palettes
+            method = indexed_nearest_colors if len(palette) >= index_min_palette else lut_nearest_colors
+            return unique_nearest_colors(image_arr, palette, method)
+        return lut_nearest_colors(image_arr, palette, index_min_palette=index_min_palette)
+    return nearest_colors(image_arr, palette)
+
+def to_pixels(image_arr, colors, index_min_palette=INDEX_MIN_PALETTE):
     '''
     Return image in form of array in which every color is in colors.
 
+    Parameters
+    ----------
+        image_arr : np.array, containing tuples representing colors
+        colors : list, containing tuples representing colors
+        index_min_palette : int, see quantize
+    
+    Returns
+    -------
+        list of same dimension as image_arr representing an image containing only colors in colors.
+    '''
+
+    indices = quantize(image_arr, colors, index_min_palette)
+    return [[colors[k] for k in row] for row in indices.tolist()]
+
+def to_pixels_reference(image_arr, colors):
+    '''
+    Reference implementation of to_pixels, calls get_color on every pixel. Slow, used to test to_pixels.
+
     Parameters
     ----------
         image_arr : np.array, containing tuples representing colors
@@ -93,68 +687,202 @@ def to_pixels(image_arr, colors):
 
     return new_image
 
-def add_grid(image, start_row=1, start_col=1, dir_rows='tb', dir_cols='lr', grid_color=(0,0,0), size_cell=20, step=1):
+# Font of the numbers of rows and columns of grids
+GRID_FONT = "pixelpictures/static/pixelpictures/arial_unicode.ttf"
+GRID_FONT_SIZE = 10
+# Characters of numbers of rows and columns, rendered once in the glyph atlas
+GRID_CHARS = "-0123456789"
+# Margin around the cells of grids, in pixels
+GRID_BORDER = 40
+
+@functools.lru_cache(maxsize=None)
+def grid_font(size):
+    # Font of grid numbers, parsed once per size. Pillow's default bitmap font is used if GRID_FONT is not installed
+    try:
+        return ImageFont.truetype(GRID_FONT, size)
+    except OSError:
+        return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=None)
+def glyph_atlas(size):
     '''
-    Adds a personalized grid over a pillow Image.
+    Renders the characters of grid numbers (GRID_CHARS) with grid_font(size), once per size.
+    Masks do not depend on the color, that is applied when they are pasted (see draw_number).
 
-    Parameters
-    ----------
-        image : PIL.Image, 18 pixels form one colored pixel.
-        start_row : int, starting number to count the rows grid
-        start_col : int, starting number to count the columns of the gris
-        dir_rows : str, if equal to 'bt' the count of the rows starts from bottom, else it starts from top
-        dir_cols : str, if equal to 'rl' the count of the columns starts from right, else it starts from left
-        grid_color : 3-tuple of ints that represents desired color of the grid
-        size_cell : int, size in pixels of the side of each cell in the grid
-        step : int, desired step of displayed numbers of the rows and columns
-    
     Returns
     -------
-        Resized image with grid on it and count of rows and cols.
+        glyphs : dict of character -> (mask, advance, top), mask is a PIL.Image in mode "L" with the character drawn
+                 with its ascender line at (padding, padding), advance is its width and top the first row of the
+                 character below the ascender line
+        ascent, descent : ints, pixels of the line above and below the baseline
+        padding : int, space around characters in masks, for parts drawn outside their advance
+    '''
+
+    font = grid_font(size)
+    if hasattr(font, 'getmetrics'):
+        ascent, descent = font.getmetrics()
+    else:
+        ascent, descent = font.getbbox(GRID_CHARS)[3], 0
+    padding = size // 2 + 1
+
+    glyphs = {}
+    for char in GRID_CHARS:
+        advance = font.getlength(char)
+        mask = Image.new("L", (math.ceil(advance) + 2 * padding, ascent + descent + 2 * padding), 0)
+        ImageDraw.Draw(mask).text((padding, padding), char, fill=255, font=font)
+        glyphs[char] = (mask, advance, mask.getbbox()[1] - padding)
+
+    return glyphs, ascent, descent, padding
+
+def draw_number(image, number, position, anchor, color, size=GRID_FONT_SIZE):
+    '''
+    Draws number on image composing the glyphs of glyph_atlas(size), without shaping the text.
+
+    Parameters
+    ----------
+        image : PIL.Image in mode "RGB"
+        number : int
+        position : 2-tuple of ints, point of the text given by anchor
+        anchor : str, horizontal ('l' left, 'm' middle, 'r' right) and vertical ('t' top, 'm' middle, 's' baseline)
+                 alignment of the text, as anchors of ImageDraw.text
+        color : 3-tuple of ints
+        size : int, size of the font
+    '''
+
+    glyphs, ascent, descent, padding = glyph_atlas(size)
+    text = str(number)
+    width = sum(glyphs[char][1] for char in text)
+
+    x, y = position
+    x -= {'l': 0, 'm': width / 2, 'r': width}[anchor[0]]
+    if anchor[1] == 't':
+        y -= min(glyphs[char][2] for char in text)
+    else:
+        y -= {'m': (ascent + descent) // 2, 's': ascent}[anchor[1]]
+    for char in text:
+        mask, advance, _ = glyphs[char]
+        image.paste(color, (math.floor(x) - padding, y - padding), mask)
+        x += advance
+
+# Grid drawn over a picture: one color for every cell (np.array of shape (rows, cols, 3)), numbers shown next
+# to every row and column (None where they are not shown), color of lines and numbers, pixels of cells and margin
+GridLayout = namedtuple('GridLayout', ['cells', 'row_numbers', 'col_numbers', 'grid_color', 'size_cell', 'border'])
+
+def grid_numbers(count, start, reverse, step):
+    # Numbers of count rows or columns counted from start, from the last one if reverse. Only multiples of step are shown
+    numbers = [start + count - 1 - i if reverse else start + i for i in range(count)]
+    return [number if number % step == 0 else None for number in numbers]
+
+def grid_layout(image, start_row=1, start_col=1, dir_rows='tb', dir_cols='lr', grid_color=(0,0,0), size_cell=20, step=1, scale=1):
+    '''
+    Returns the GridLayout of a grid over a pillow Image, parameters are the same of add_grid.
     '''
 
     if step <= 0:
         step = 1
 
-    border = 40
-    font_size = 10
-    resized = image.resize((image.width // 18 * size_cell, image.height // 18 * size_cell ), Image.NEAREST)
-    width = resized.width + border * 2
-    height = resized.height + border * 2
+    # One pixel for every cell
+    cells = np.asarray(image.convert("RGB"))[scale // 2::scale, scale // 2::scale][:image.height // scale, :image.width // scale]
+    rows, cols = cells.shape[:2]
 
-    background = Image.new("RGB", (width, height), (255, 255, 255))
+    return GridLayout(
+        cells=cells,
+        row_numbers=grid_numbers(rows, start_row, dir_rows.lower() == 'bt', step),
+        col_numbers=grid_numbers(cols, start_col, dir_cols.lower() == 'rl', step),
+        grid_color=tuple(grid_color),
+        size_cell=size_cell,
+        border=GRID_BORDER,
+    )
 
-    background.paste(resized, (border, border))
+def grid_size(layout):
+    # Width and height in pixels of the image of a grid
+    rows, cols = layout.cells.shape[:2]
+    return cols * layout.size_cell + layout.border * 2, rows * layout.size_cell + layout.border * 2
 
-    # Draw grid with numbers
-    font = ImageFont.truetype("pixelpictures/static/pixelpictures/arial_unicode.ttf", font_size)
-    draw = ImageDraw.Draw(background)
+def grid_tile(layout, rows, cols):
+    # Part of a grid with cells in slices rows and cols, numbered as in the whole grid
+    return layout._replace(cells=layout.cells[rows, cols], row_numbers=layout.row_numbers[rows], col_numbers=layout.col_numbers[cols])
 
-    for l in range(resized.height // size_cell):
-        draw.line((border , border + l * size_cell) + (width - border, border + l * size_cell),fill=grid_color, width=1)
+def render_grid(layout, top=0, bottom=None):
+    '''
+    Draws rows of pixels from top to bottom of the image of a grid, so that big grids can be drawn in bands.
+    Bands put together are the same as the whole image.
 
-        if dir_rows.lower() == 'bt':
-            row_num = resized.height // size_cell - 1 + start_row - l 
-        else:
-            row_num = start_row + l
-        
-        if row_num % step == 0:
-            draw.text((border - size_cell // 2, border + l * size_cell + size_cell // 2), f'{row_num}', fill=grid_color, font=font, anchor='rm')
-            draw.text((width - border + size_cell // 2, border + l * size_cell + size_cell // 2), f'{row_num}', fill=grid_color, font=font, anchor='lm')
+    Parameters
+    ----------
+        layout : GridLayout
+        top : int, first row of pixels
+        bottom : int, row of pixels after the last one, if None the last row of the image
 
-    for l in range(resized.width // size_cell):
-        draw.line((border + l * size_cell, border) + (border + l * size_cell, height - border), fill=grid_color, width=1)
+    Returns
+    -------
+        PIL.Image in mode "RGB"
+    '''
 
-        if dir_cols.lower() == 'rl':
-            col_num = resized.width // size_cell - 1 + start_row - l 
-        else:
-            col_num = start_col + l
+    cells, row_numbers, col_numbers, grid_color, size_cell, border = layout
+    rows, cols = cells.shape[:2]
+    grid_width = cols * size_cell
+    grid_height = rows * size_cell
+    width, height = grid_size(layout)
+    bottom = height if bottom is None else min(bottom, height)
+
+    band = np.full((bottom - top, width, 3), 255, dtype=np.uint8)
+
+    # Cells are upscaled with slice assignments, all rows of pixels of a row of cells are the same
+    first_row = max(0, (top - border) // size_cell)
+    last_row = min(rows, (bottom - border - 1) // size_cell + 1)
+    for row in range(first_row, last_row):
+        y_start = max(top, border + row * size_cell)
+        y_end = min(bottom, border + (row + 1) * size_cell)
+        band[y_start - top:y_end - top, border:border + grid_width] = np.repeat(cells[row], size_cell, axis=0)
+
+    # Lines between cells and around the grid
+    first_line = border + max(0, -((border - top) // size_cell)) * size_cell
+    lines_end = min(bottom, border + grid_height + 1)
+    if first_line < lines_end:
+        band[first_line - top:lines_end - top:size_cell, border:border + grid_width + 1] = grid_color
+    if max(top, border) < lines_end:
+        band[max(top, border) - top:lines_end - top, border:border + grid_width + 1:size_cell] = grid_color
+
+    # Numbers of rows and columns in the margins, only those reaching the band are drawn
+    image = Image.fromarray(band)
+    _, ascent, descent, _ = glyph_atlas(GRID_FONT_SIZE)
+    reach = ascent + descent
 
-        if col_num % step == 0:
-            draw.text((border + l * size_cell + size_cell // 2, border - size_cell // 2), f'{col_num}', fill=grid_color, font=font, anchor='ms')
-            draw.text((border + l * size_cell + size_cell // 2, height - border +  size_cell // 2), f'{col_num}', fill=grid_color, font=font, anchor='mt')
+    for l in range(max(0, (top - border - reach) // size_cell), min(rows, (bottom - border + reach) // size_cell + 1)):
+        if row_numbers[l] is not None:
+            y = border + l * size_cell + size_cell // 2 - top
+            draw_number(image, row_numbers[l], (border - size_cell // 2, y), 'rm', grid_color)
+            draw_number(image, row_numbers[l], (width - border + size_cell // 2, y), 'lm', grid_color)
 
-    draw.line((border, border + resized.height) + (width - border, border + resized.height), fill=grid_color, width=1)
-    draw.line((border + resized.width, border) + (border + resized.width, height - border), fill=grid_color, width=1)
+    for y, anchor in ((border - size_cell // 2, 'ms'), (height - border + size_cell // 2, 'mt')):
+        if y + reach < top or y - reach >= bottom:
+            continue
+        for l in range(cols):
+            if col_numbers[l] is not None:
+                draw_number(image, col_numbers[l], (border + l * size_cell + size_cell // 2, y - top), anchor, grid_color)
+
+    return image
+
+def add_grid(image, start_row=1, start_col=1, dir_rows='tb', dir_cols='lr', grid_color=(0,0,0), size_cell=20, step=1, scale=1):
+    '''
+    Adds a personalized grid over a pillow Image.
+
+    Parameters
+    ----------
+        image : PIL.Image, scale x scale pixels form one colored pixel.
+        start_row : int, starting number to count the rows grid
+        start_col : int, starting number to count the columns of the gris
+        dir_rows : str, if equal to 'bt' the count of the rows starts from bottom, else it starts from top
+        dir_cols : str, if equal to 'rl' the count of the columns starts from right, else it starts from left
+        grid_color : 3-tuple of ints that represents desired color of the grid
+        size_cell : int, size in pixels of the side of each cell in the grid
+        step : int, desired step of displayed numbers of the rows and columns
+        scale : int, size in pixels of the side of each cell in image (1 for stored pictures)
+    
+    Returns
+    -------
+        Resized image with grid on it and count of rows and cols.
+    '''
 
-    return background
\ No newline at end of file
+    return render_grid(grid_layout(image, start_row, start_col, dir_rows, dir_cols, grid_color, size_cell, step, scale))
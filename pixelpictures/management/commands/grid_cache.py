@@ -0,0 +1,25 @@
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pixelpictures.grid_cache import cache_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = "Reports hits, misses and size of the cache of grids, or clears it with --clear."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clear", action="store_true", help="Remove all cached grids and reset hit counts.")
+
+    def handle(self, *args, **options):
+        if options["clear"]:
+            shutil.rmtree(settings.GRID_CACHE_DIR, ignore_errors=True)
+            reset_stats()
+            self.stdout.write("Cache of grids cleared.")
+            return
+
+        stats = cache_stats()
+        hit_rate = f"{stats['hit_rate']:.1%}" if stats['hit_rate'] is not None else "-"
+        self.stdout.write(f"Hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {hit_rate}")
+        self.stdout.write(f"Files: {stats['files']}, size: {stats['size']} bytes (max {settings.GRID_CACHE_MAX_SIZE})")
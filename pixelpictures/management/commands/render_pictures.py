@@ -0,0 +1,40 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from pixelpictures.render import run_render_jobs
+
+
+class Command(BaseCommand):
+    help = "Renders the PNGs of saved pictures, waiting for new jobs unless --once is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: number of CPUs).")
+        parser.add_argument("--batch", type=int, default=100, help="Maximum number of jobs claimed at once.")
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds between checks for new jobs.")
+        parser.add_argument("--once", action="store_true", help="Run pending jobs and exit.")
+
+    def handle(self, *args, **options):
+        # Workers do not use the database, connections are not shared with them
+        connections.close_all()
+        executor = ProcessPoolExecutor(max_workers=options["processes"])
+        try:
+            while True:
+                try:
+                    count = run_render_jobs(executor, options["batch"])
+                except BrokenExecutor:
+                    # A worker process died (e.g. out of memory), its jobs are back in the queue
+                    self.stderr.write("Worker processes stopped, starting new ones.")
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=options["processes"])
+                    continue
+                if count:
+                    self.stdout.write(f"Rendered {count} picture(s).")
+                elif options["once"]:
+                    break
+                else:
+                    time.sleep(options["interval"])
+        finally:
+            executor.shutdown()
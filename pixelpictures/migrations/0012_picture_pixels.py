@@ -0,0 +1,73 @@
+import struct
+import zlib
+
+from django.db import migrations, models
+import numpy as np
+
+# Format of stored pixels when this migration was written (grid_format.compress_grid): zlib compressed header,
+# palette of the unique colors and indices of the palette (not run-length encoded)
+HEADER = struct.Struct("<4sBBHHIBII")
+MAGIC = b"PXGR"
+INDEX_TYPES = {1: np.dtype("<u1"), 2: np.dtype("<u2"), 4: np.dtype("<u4")}
+
+
+def compress_grid(image_arr):
+    height, width, channels = image_arr.shape
+    keys = np.zeros((height, width), dtype=np.uint32)
+    for channel in range(channels):
+        keys = (keys << 8) | image_arr[..., channel]
+    unique, inverse = np.unique(keys, return_inverse=True)
+    palette = np.stack([(unique >> (8 * (channels - 1 - channel))) & 255 for channel in range(channels)], axis=-1)
+
+    size = next(size for size in INDEX_TYPES if len(unique) <= 2 ** (8 * size))
+    header = HEADER.pack(MAGIC, 0, channels, height, width, len(unique), size, 0, 0)
+    indices = inverse.astype(INDEX_TYPES[size])
+    return zlib.compress(header + palette.astype(np.uint8).tobytes() + indices.tobytes())
+
+
+def decompress_grid(pixels):
+    data = zlib.decompress(pixels)
+    _, _, channels, height, width, n_colors, size, _, _ = HEADER.unpack_from(data)
+    palette = np.frombuffer(data, dtype=np.uint8, count=n_colors * channels, offset=HEADER.size).reshape(n_colors, channels)
+    indices = np.frombuffer(data, dtype=INDEX_TYPES[size], count=height * width, offset=HEADER.size + n_colors * channels)
+    return palette[indices].reshape(height, width, channels)
+
+
+def image_to_pixels(apps, schema_editor):
+    Picture = apps.get_model("pixelpictures", "Picture")
+    for picture in Picture.objects.all().iterator():
+        image_arr = np.array(picture.image, dtype=np.uint8)
+        picture.pixels = compress_grid(image_arr)
+        picture.height, picture.width = image_arr.shape[:2]
+        picture.save(update_fields=["pixels", "height", "width"])
+
+
+def pixels_to_image(apps, schema_editor):
+    Picture = apps.get_model("pixelpictures", "Picture")
+    for picture in Picture.objects.all().iterator():
+        picture.image = decompress_grid(picture.pixels).tolist()
+        picture.save(update_fields=["image"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pixelpictures", "0011_alter_picture_timestamp"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="picture", name="pixels", field=models.BinaryField(default=bytes),
+        ),
+        migrations.AddField(
+            model_name="picture", name="width", field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="picture", name="height", field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="picture", name="image", field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(image_to_pixels, pixels_to_image),
+        migrations.RemoveField(model_name="picture", name="image",),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+def fill_palette_size(apps, schema_editor):
+    Picture = apps.get_model("pixelpictures", "Picture")
+    for picture in Picture.objects.only("palette").iterator():
+        picture.palette_size = len(picture.palette or [])
+        picture.save(update_fields=["palette_size"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pixelpictures", "0012_picture_pixels"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="picture", name="palette_size", field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_palette_size, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.4 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pixelpictures', '0013_picture_palette_size'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='picture',
+            index=models.Index(fields=['public', 'timestamp'], name='picture_public_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='picture',
+            index=models.Index(fields=['public', 'views', 'id'], name='picture_public_views_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations, models
+
+
+def link_tags(apps, schema_editor):
+    PictureTag = apps.get_model("pixelpictures", "PictureTag")
+    Tag = apps.get_model("pixelpictures", "Tag")
+    Through = Tag.pictures.through
+    tags = {}
+    links = set()
+    for picture_id, tag in PictureTag.objects.values_list("picture_id", "tag").iterator():
+        # Same as models.normalize_tag
+        tag = tag.strip().casefold()[:50]
+        if not tag:
+            continue
+        if tag not in tags:
+            tags[tag] = Tag.objects.create(tag=tag).pk
+        links.add((picture_id, tags[tag]))
+    Through.objects.bulk_create([Through(picture_id=picture_id, tag_id=tag_id) for picture_id, tag_id in links])
+
+
+def unlink_tags(apps, schema_editor):
+    PictureTag = apps.get_model("pixelpictures", "PictureTag")
+    Tag = apps.get_model("pixelpictures", "Tag")
+    PictureTag.objects.bulk_create([
+        PictureTag(picture_id=picture_id, tag=tag)
+        for picture_id, tag in Tag.pictures.through.objects.values_list("picture_id", "tag__tag")
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pixelpictures", "0014_picture_indexes"),
+    ]
+
+    operations = [
+        # Tags of the previous schema (one row for every picture and tag) are moved to the new tables and deleted
+        migrations.RenameModel("Tag", "PictureTag"),
+        migrations.AlterField(
+            model_name="picturetag",
+            name="picture",
+            field=models.ForeignKey(
+                on_delete=models.deletion.CASCADE, related_name="old_tags", to="pixelpictures.picture",
+            ),
+        ),
+        migrations.CreateModel(
+            name="Tag",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("tag", models.CharField(max_length=50, unique=True)),
+                ("pictures", models.ManyToManyField(related_name="tags", to="pixelpictures.picture")),
+            ],
+        ),
+        migrations.RunPython(link_tags, unlink_tags),
+        migrations.DeleteModel(name="PictureTag"),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.4 on 2026-10-18 13:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pixelpictures', '0015_tag_pictures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('picture', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='render_jobs', to='pixelpictures.picture')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='renderjob',
+            index=models.Index(fields=['status', 'id'], name='render_job_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='renderjob',
+            constraint=models.UniqueConstraint(fields=('picture', 'timestamp'), name='render_job_picture_timestamp'),
+        ),
+    ]
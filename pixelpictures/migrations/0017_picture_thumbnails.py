@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pixelpictures', '0016_renderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='picture',
+            name='thumbnails',
+            field=models.JSONField(default=list),
+        ),
+    ]
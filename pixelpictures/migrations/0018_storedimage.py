@@ -0,0 +1,88 @@
+import glob
+import hashlib
+import os
+import shutil
+
+from django.db import migrations, models
+import django.db.models.deletion
+from PIL import Image
+
+# Local directory of picture files when this migration was written
+PATH_PICTURES = "./pixelpictures/static/pixelpictures/pictures"
+
+
+def legacy_name(picture):
+    # Name of the files of a picture before content addressed storage
+    return f"{picture.pk}_{picture.timestamp.strftime('%Y%m%d_%H%M%S')}"
+
+
+def store_by_content(apps, schema_editor):
+    Picture = apps.get_model("pixelpictures", "Picture")
+    StoredImage = apps.get_model("pixelpictures", "StoredImage")
+    RenderJob = apps.get_model("pixelpictures", "RenderJob")
+    for picture in Picture.objects.all().iterator():
+        name = hashlib.sha256(bytes(picture.pixels)).hexdigest()
+        stored_image, created = StoredImage.objects.get_or_create(content_hash=name)
+        picture.stored_image = stored_image
+        picture.save(update_fields=["stored_image"])
+
+        # Files are renamed, or removed if the same pixels are already stored
+        old_name = legacy_name(picture)
+        for path in glob.glob(f"{PATH_PICTURES}/{glob.escape(old_name)}*"):
+            new_path = path.replace(old_name, name, 1)
+            if created:
+                os.replace(path, new_path)
+            else:
+                os.remove(path)
+
+        if created:
+            thumbnails = picture.thumbnails
+            if not thumbnails and os.path.isfile(f"{PATH_PICTURES}/{name}.png"):
+                # Pictures rendered before thumbnails
+                with Image.open(f"{PATH_PICTURES}/{name}.png") as image:
+                    thumbnails = [{"suffix": "", "width": image.width, "webp": False}]
+            stored_image.thumbnails = thumbnails
+            stored_image.save(update_fields=["thumbnails"])
+        if not stored_image.thumbnails:
+            RenderJob.objects.update_or_create(picture=picture, timestamp=picture.timestamp, defaults={"status": "pending"})
+
+
+def store_by_picture(apps, schema_editor):
+    Picture = apps.get_model("pixelpictures", "Picture")
+    for picture in Picture.objects.select_related("stored_image").iterator():
+        if picture.stored_image is None:
+            continue
+        name = picture.stored_image.content_hash
+        for path in glob.glob(f"{PATH_PICTURES}/{glob.escape(name)}*"):
+            shutil.copyfile(path, path.replace(name, legacy_name(picture), 1))
+        picture.thumbnails = picture.stored_image.thumbnails
+        picture.save(update_fields=["thumbnails"])
+    for path in glob.glob(f"{PATH_PICTURES}/" + "[0-9a-f]" * 64 + "*"):
+        os.remove(path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pixelpictures", "0017_picture_thumbnails"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StoredImage",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("content_hash", models.CharField(max_length=64, unique=True)),
+                ("thumbnails", models.JSONField(default=list)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="picture",
+            name="stored_image",
+            field=models.ForeignKey(
+                null=True, on_delete=django.db.models.deletion.PROTECT, related_name="pictures", to="pixelpictures.storedimage",
+            ),
+        ),
+        migrations.RunPython(store_by_content, store_by_picture),
+        migrations.RemoveField(model_name="picture", name="thumbnails",),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pixelpictures', '0018_storedimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
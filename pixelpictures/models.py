@@ -1,20 +1,139 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
+import numpy as np
+
+from .grid_format import compress_grid, decompress_grid
+from .storage import content_hash, remove_files
+from .grid_cache import invalidate
 
 class User(AbstractUser):
     email = models.EmailField(unique=True)
 
+class StoredImage(models.Model):
+    # Files of pictures with the same pixels (see storage.py), they are removed when no picture references them
+    content_hash = models.CharField(max_length=64, unique=True)
+    # Stored variants of the png, written by the render worker (see render.render_png), empty until rendered
+    thumbnails = models.JSONField(default=list)
+
+    @classmethod
+    def release(cls, pk):
+        # Removes stored image pk and its files if it is not used anymore, once the current transaction is committed
+        def remove():
+            stored_image = cls.objects.filter(pk=pk).first()
+            if stored_image is None:
+                return
+            try:
+                stored_image.delete()
+            except models.ProtectedError:
+                # Still used, or used again by a picture saved in the meantime
+                return
+            remove_files(stored_image.content_hash)
+            # Cached grids of these pixels are not used anymore
+            invalidate(stored_image.content_hash)
+        transaction.on_commit(remove)
+
 class Picture(models.Model):
-    image = models.JSONField()
+    # Image is stored as palette-indexed pixels compressed with zlib (see grid_format.compress_grid)
+    pixels = models.BinaryField(default=bytes)
+    width = models.PositiveIntegerField(default=0)
+    height = models.PositiveIntegerField(default=0)
     palette = models.JSONField(default=list)
+    # Filled on save, so lists do not need to load palette
+    palette_size = models.PositiveIntegerField(default=0)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="creator")
     public = models.BooleanField(default=False)
     timestamp = models.DateTimeField()
     views = models.IntegerField(default=0)
+    # Files of the picture, shared by pictures with the same pixels
+    stored_image = models.ForeignKey(StoredImage, null=True, on_delete=models.PROTECT, related_name="pictures")
+
+    class Meta:
+        # Used by the keyset pagination of public pictures
+        indexes = [
+            models.Index(fields=['public', 'timestamp'], name='picture_public_timestamp_idx'),
+            models.Index(fields=['public', 'views', 'id'], name='picture_public_views_idx'),
+        ]
 
     def __str__(self):
         return f"Picture {self.pk} by {self.user}"
 
+    def save(self, *args, **kwargs):
+        if 'palette' not in self.get_deferred_fields():
+            self.palette_size = len(self.palette or [])
+
+        previous = None
+        update_fields = kwargs.get('update_fields')
+        if 'pixels' not in self.get_deferred_fields() and (update_fields is None or 'pixels' in update_fields):
+            name = content_hash(self.pixels)
+            if self.stored_image_id is None or self.stored_image.content_hash != name:
+                previous = self.stored_image_id
+                self.stored_image, _ = StoredImage.objects.get_or_create(content_hash=name)
+
+        super().save(*args, **kwargs)
+        if previous is not None:
+            StoredImage.release(previous)
+
+    def delete(self, *args, **kwargs):
+        stored_image_id = self.stored_image_id
+        result = super().delete(*args, **kwargs)
+        if stored_image_id is not None:
+            StoredImage.release(stored_image_id)
+        return result
+
+    @property
+    def image_array(self):
+        # Pixels are decompressed only when used, once for every value of pixels
+        cache = getattr(self, '_image_cache', None)
+        if cache is None or cache[0] is not self.pixels:
+            if self.pixels:
+                image_arr = decompress_grid(self.pixels)
+            else:
+                image_arr = np.zeros((0, 0, 3), dtype=np.uint8)
+            image_arr.flags.writeable = False
+            self._image_cache = cache = (self.pixels, image_arr)
+        return cache[1]
+
+    @property
+    def image(self):
+        # Image as heightXwidth list of colors
+        return self.image_array.tolist()
+
+    @image.setter
+    def image(self, new_image):
+        image_arr = np.asarray(new_image, dtype=np.uint8)
+        self.pixels = compress_grid(image_arr)
+        self.height, self.width = image_arr.shape[:2]
+
 class Tag(models.Model):
-    picture = models.ForeignKey(Picture, on_delete=models.CASCADE, related_name="tags")
-    tag = models.CharField(max_length=50)
\ No newline at end of file
+    # Every tag is stored once (normalized with normalize_tag), the unique index is used for prefix search
+    tag = models.CharField(max_length=50, unique=True)
+    pictures = models.ManyToManyField(Picture, related_name="tags")
+
+def normalize_tag(tag):
+    # Tags are compared ignoring case and surrounding spaces
+    return tag.strip().casefold()[:50]
+
+
+class RenderJob(models.Model):
+    # PNG of a picture to render in background (see render.py), one for every saved version of the picture
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    picture = models.ForeignKey(Picture, on_delete=models.CASCADE, related_name="render_jobs")
+    timestamp = models.DateTimeField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    # When a worker claimed the job, running jobs claimed too long ago are claimed again (see render.claim_jobs)
+    claimed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['picture', 'timestamp'], name='render_job_picture_timestamp'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'id'], name='render_job_status_idx'),
+        ]
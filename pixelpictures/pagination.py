@@ -0,0 +1,92 @@
+import json
+import hashlib
+from collections import namedtuple
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db.models import Q
+
+# Keyset pagination: a page is found from the last picture of the previous page (the cursor),
+# so queries use the indexes of Picture and do not depend on how deep the page is.
+PAGE_SIZE = 20
+# Seconds a count of pictures is reused
+COUNT_TIMEOUT = 60
+
+# Field ordering pictures for every sort, pictures with the same value are ordered by id
+SORT_FIELDS = {'new': 'timestamp', 'views': 'views'}
+
+KeysetPage = namedtuple('KeysetPage', ['object_list', 'has_next', 'has_previous', 'next_cursor', 'previous_cursor'])
+
+def encode_cursor(picture, field):
+    '''
+    Returns a string identifying the position of picture in the ordering by field.
+    '''
+
+    value = getattr(picture, field)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return urlsafe_b64encode(json.dumps([value, picture.pk]).encode()).decode('ascii')
+
+def decode_cursor(cursor, field):
+    '''
+    Inverse of encode_cursor, returns value of field and primary key. Raises ValueError if cursor is not valid.
+    '''
+
+    try:
+        value, pk = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+        if field == 'timestamp':
+            value = datetime.fromisoformat(value)
+        return value, int(pk)
+    except (TypeError, ValueError, UnicodeError) as error:
+        raise ValueError("Not valid cursor.") from error
+
+def keyset_page(queryset, field, after=None, before=None, page_size=PAGE_SIZE):
+    '''
+    Returns a page of queryset ordered by field and id, both descending.
+
+    Parameters
+    ----------
+        queryset : QuerySet of Picture
+        field : str, field used for ordering (values of SORT_FIELDS)
+        after : optional cursor, the page starts after this picture
+        before : optional cursor, the page ends before this picture (used for previous pages)
+        page_size : int, maximum number of pictures in the page
+
+    Returns
+    -------
+        KeysetPage
+    '''
+
+    if before is not None:
+        value, pk = decode_cursor(before, field)
+        queryset = queryset.filter(**{f'{field}__gte': value}).filter(Q(**{f'{field}__gt': value}) | Q(id__gt=pk))
+        pictures = list(queryset.order_by(field, 'id')[:page_size + 1])
+        has_previous = len(pictures) > page_size
+        pictures = pictures[:page_size][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            value, pk = decode_cursor(after, field)
+            # Written with a range on field, so the index can be searched from the cursor
+            queryset = queryset.filter(**{f'{field}__lte': value}).filter(Q(**{f'{field}__lt': value}) | Q(id__lt=pk))
+        pictures = list(queryset.order_by(f'-{field}', '-id')[:page_size + 1])
+        has_next = len(pictures) > page_size
+        pictures = pictures[:page_size]
+        has_previous = after is not None
+
+    return KeysetPage(
+        object_list=pictures,
+        has_next=has_next and bool(pictures),
+        has_previous=has_previous and bool(pictures),
+        next_cursor=encode_cursor(pictures[-1], field) if pictures else None,
+        previous_cursor=encode_cursor(pictures[0], field) if pictures else None,
+    )
+
+def cached_count(queryset, key):
+    '''
+    Returns the number of elements of queryset, counted at most once every COUNT_TIMEOUT seconds for every key.
+    '''
+
+    cache_key = 'count:' + hashlib.md5(key.encode()).hexdigest()
+    return cache.get_or_set(cache_key, queryset.count, COUNT_TIMEOUT)
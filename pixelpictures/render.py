@@ -0,0 +1,180 @@
+from concurrent.futures import BrokenExecutor
+from datetime import timedelta
+import numpy as np
+from PIL import Image
+
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .grid_format import decompress_indexed
+from .models import Picture, RenderJob, StoredImage
+from .storage import THUMBNAIL_HEIGHTS, picture_name, encode_image, save_file
+
+# PNGs of saved pictures are rendered by a background worker (management command render_pictures),
+# jobs are stored in the database, one for every picture and timestamp.
+# Pictures with the same pixels share their files (see storage.py), they are rendered once.
+
+# A failed job is tried again until it has been run this many times
+MAX_ATTEMPTS = 3
+# Running jobs not finished after this time are claimed again (their worker was stopped)
+LEASE = timedelta(minutes=5)
+
+def picture_image(pixels):
+    '''
+    Returns PIL.Image with one pixel for every cell of a picture, in palette mode ("P") if it has at most 256 colors.
+    Pages scale stored pictures with image-rendering: pixelated.
+
+    Parameters
+    ----------
+        pixels : bytes, compressed pixels of the picture (Picture.pixels)
+    '''
+
+    palette, indices = decompress_indexed(bytes(pixels))
+    channels = palette.shape[1]
+    if len(palette) > 256 or channels not in (3, 4):
+        return Image.fromarray(palette[indices])
+
+    image = Image.fromarray(indices.astype(np.uint8), 'P')
+    image.putpalette(palette.tobytes(), rawmode='RGBA' if channels == 4 else 'RGB')
+    return image
+
+def render_png(name, pixels):
+    '''
+    Writes the PNG of a picture, its thumbnails and their WebP versions (kept only if smaller).
+    Runs in worker processes, so it does not use the database.
+
+    Parameters
+    ----------
+        name : str, name of the files (StoredImage.content_hash)
+        pixels : bytes, compressed pixels of the picture (Picture.pixels)
+
+    Returns
+    -------
+        list of variants (stored in StoredImage.thumbnails), dictionaries with suffix of the name, width and if there is a WebP
+    '''
+
+    image = picture_image(pixels)
+
+    variants = []
+    smallest = None
+    for height in [image.height] + [height for height in THUMBNAIL_HEIGHTS if height < image.height]:
+        # Nearest neighbour keeps the palette, it is how pages scale pictures (image-rendering: pixelated)
+        width = max(1, round(image.width * height / image.height))
+        suffix = f'_h{height}' if height != image.height else ''
+        variant = image.resize((width, height), Image.NEAREST)
+
+        # Encoded in memory, only kept files are written to the storage
+        png = encode_image(variant, 'PNG', optimize=True)
+        webp = encode_image(variant, 'WEBP', lossless=True, quality=100)
+        size = min(len(png), len(webp))
+
+        # Thumbnails are kept only if smaller than the full picture
+        if suffix and size >= smallest:
+            continue
+        smallest = size if smallest is None else smallest
+        save_file(picture_name(name, suffix), png)
+        if len(webp) < len(png):
+            save_file(picture_name(name, suffix, 'webp'), webp)
+        variants.append({'suffix': suffix, 'width': width, 'webp': len(webp) < len(png)})
+
+    return variants
+
+def enqueue_render(picture):
+    '''
+    Adds a job rendering the current version of picture, if there is not one already. Returns the RenderJob.
+    '''
+
+    # Files of the same pixels may already exist
+    status = RenderJob.DONE if picture.stored_image.thumbnails else RenderJob.PENDING
+    job, _ = RenderJob.objects.get_or_create(picture=picture, timestamp=picture.timestamp, defaults={'status': status})
+    return job
+
+def render_status(picture):
+    # Status of the render of the current version of picture
+    if picture.stored_image is not None and picture.stored_image.thumbnails:
+        return RenderJob.DONE
+    job = RenderJob.objects.filter(picture=picture, timestamp=picture.timestamp).only('status').first()
+    return job.status if job is not None else RenderJob.PENDING
+
+def claim_jobs(limit):
+    '''
+    Marks up to limit pending jobs, or running jobs claimed more than LEASE ago, as running and returns them.
+    A job is claimed by one worker only. Expired jobs already run MAX_ATTEMPTS times are marked as failed.
+    '''
+
+    now = timezone.now()
+    expired = Q(status=RenderJob.RUNNING, claimed_at__lt=now - LEASE)
+    RenderJob.objects.filter(expired, attempts__gte=MAX_ATTEMPTS).update(status=RenderJob.FAILED, error="Render did not finish.")
+
+    claimable = Q(status=RenderJob.PENDING) | expired
+    claimed = []
+    for pk in RenderJob.objects.filter(claimable).order_by('id').values_list('pk', flat=True)[:limit]:
+        # Same condition, so a job claimed by another worker in the meantime is skipped
+        if RenderJob.objects.filter(claimable, pk=pk).update(status=RenderJob.RUNNING, claimed_at=now, attempts=F('attempts') + 1):
+            claimed.append(pk)
+    return list(RenderJob.objects.filter(pk__in=claimed).order_by('id'))
+
+def finish_job(job, error=None):
+    # Failed jobs go back to the queue until MAX_ATTEMPTS
+    if error is None:
+        RenderJob.objects.filter(pk=job.pk).update(status=RenderJob.DONE, error='')
+    else:
+        status = RenderJob.FAILED if job.attempts >= MAX_ATTEMPTS else RenderJob.PENDING
+        RenderJob.objects.filter(pk=job.pk).update(status=status, error=str(error))
+
+def run_render_jobs(executor=None, limit=100):
+    '''
+    Runs pending render jobs.
+
+    Parameters
+    ----------
+        executor : optional concurrent.futures.Executor rendering the PNGs, if None they are rendered in this process
+        limit : int, maximum number of jobs run
+
+    Returns
+    -------
+        number of jobs run
+
+    Raises concurrent.futures.BrokenExecutor if executor cannot run jobs anymore, after all claimed jobs are finished
+    (jobs not rendered go back to the queue as failed renders).
+    '''
+
+    jobs = claim_jobs(limit)
+    pictures = Picture.objects.select_related('stored_image').only('pk', 'timestamp', 'pixels', 'stored_image') \
+                      .in_bulk([job.picture_id for job in jobs])
+
+    tasks = []
+    rendering = set()
+    broken = None
+    for job in jobs:
+        picture = pictures.get(job.picture_id)
+        if picture is None or picture.timestamp != job.timestamp:
+            # The picture was modified or deleted, a newer job renders it
+            finish_job(job)
+            continue
+        stored_image = picture.stored_image
+        if stored_image.thumbnails or stored_image.pk in rendering:
+            # Same pixels of another picture
+            finish_job(job)
+            continue
+        rendering.add(stored_image.pk)
+        args = (stored_image.content_hash, picture.pixels)
+        try:
+            tasks.append((job, stored_image, executor.submit(render_png, *args) if executor else args))
+        except Exception as error:
+            finish_job(job, error)
+            broken = error if isinstance(error, BrokenExecutor) else broken
+
+    for job, stored_image, task in tasks:
+        try:
+            variants = task.result() if executor else render_png(*task)
+        except Exception as error:
+            finish_job(job, error)
+            broken = error if isinstance(error, BrokenExecutor) else broken
+        else:
+            StoredImage.objects.filter(pk=stored_image.pk).update(thumbnails=variants)
+            finish_job(job)
+
+    if broken is not None:
+        raise broken
+    return len(jobs)
@@ -32,6 +32,13 @@ document.addEventListener("DOMContentLoaded", function() {
         }
     });
     
+    // Changing resampling mode
+    document.querySelector("select[name='resample']").addEventListener("change", () => {
+        if (document.querySelector("input[type='file']").value) {
+            resize_image();
+        }
+    });
+    
     // Start drawing:
     document.querySelector('#start-drawing').addEventListener('click', () => {
         document.querySelector('.options').style.display = 'none';
@@ -39,7 +46,7 @@ document.addEventListener("DOMContentLoaded", function() {
         document.querySelector('#save').style.display = 'block';
         if (document.querySelector('#sample-image table')) {
             document.querySelector('#sample-image').style.display = 'none';
-            image_to_pixels();
+            image_to_pattern();
         } else {
             draw_image(null, 'create-image');
         }
@@ -45,10 +45,9 @@ function save_image() {
     if (key) {
         fetch(`/save`, {
             method: 'PUT',
-            headers: {'X-CSRFToken': csrftoken},
+            headers: {'X-CSRFToken': csrftoken, 'Content-Type': GRID_CONTENT_TYPE},
             mode: 'same-origin',
-            body: JSON.stringify({
-                image: image,
+            body: encodeGrid(image, {
                 key: key,
                 public: public,
                 tags: tags,
@@ -72,10 +71,9 @@ function save_image() {
         // If it doesn't -> POST request, new image
         fetch(`/save`, {
             method: 'POST',
-            headers: {'X-CSRFToken': csrftoken},
+            headers: {'X-CSRFToken': csrftoken, 'Content-Type': GRID_CONTENT_TYPE},
             mode: 'same-origin',
-            body: JSON.stringify({
-                image: image,
+            body: encodeGrid(image, {
                 public: public,
                 tags: tags,
                 palette: palette_array
@@ -109,11 +107,17 @@ function resize_image() {
     if (document.querySelector("input[type='file']").value) {
         fetch(`/sample`, {
             method: 'POST',
-            headers: {'X-CSRFToken': csrftoken},
+            headers: {'X-CSRFToken': csrftoken, 'Accept': GRID_CONTENT_TYPE},
             mode: 'same-origin',
             body: data
         })
-        .then(response => response.json())
+        .then(response => {
+            // Errors are sent as JSON
+            if (response.headers.get('Content-Type') === GRID_CONTENT_TYPE) {
+                return response.arrayBuffer().then(buffer => ({sample_image: decodeGrid(buffer)}));
+            }
+            return response.json();
+        })
         .then(result => {
             draw_image(result.sample_image, 'sample-image');
             document.querySelector('input[type=range]').value = 15;
@@ -125,9 +129,44 @@ function resize_image() {
     }
 }
 
-function image_to_pixels() {
+function sample_palette() {
+
+    let n_colors = document.querySelector('#n-colors').value;
+    document.querySelector('#n-colors-value').innerHTML = n_colors;
+
+    if (!document.querySelector("input[type='file']").value) {
+        return;
+    }
+
+    const csrftoken = document.querySelector('[name=csrfmiddlewaretoken]').value;
+
+    let data = new FormData(document.querySelector("form"))
+    data.append('colors', n_colors);
+
+    fetch(`/palette`, {
+        method: 'POST',
+        headers: {'X-CSRFToken': csrftoken},
+        mode: 'same-origin',
+        body: data
+    })
+    .then(response => response.json())
+    .then(result => {
+        // Proposed palette replaces the current one
+        palette.clear();
+        document.querySelector("#colors-palette").innerHTML = '';
+        result.palette.forEach(color => {
+            add_remove_color(`rgb(${color[0]}, ${color[1]}, ${color[2]})`);
+        });
+    })
+    .catch(error => {
+        console.log(error);
+    });
+}
+
+function image_to_pattern() {
+    // Uploaded image is resized and converted to palette colors in a single request,
+    // only the indices of the palette are sent back
 
-    let image = get_image('sample-image');
     let colors_palette = []
 
     palette.forEach(color => {
@@ -136,17 +175,32 @@ function image_to_pixels() {
 
     const csrftoken = document.querySelector('[name=csrfmiddlewaretoken]').value;
 
-    fetch(`/image_to_pixels`, {
+    let data = new FormData(document.querySelector("form"))
+    data.append('height', height);
+    data.append('width', width);
+    data.append('palette', JSON.stringify(colors_palette));
+
+    fetch(`/pattern`, {
         method: 'POST',
-        headers: {'X-CSRFToken': csrftoken},
+        headers: {'X-CSRFToken': csrftoken, 'Accept': GRID_CONTENT_TYPE},
         mode: 'same-origin',
-        body: JSON.stringify({
-            image: image,
-            palette: colors_palette
-        })
+        body: data
+    })
+    .then(response => {
+        // Errors are sent as JSON
+        if (response.headers.get('Content-Type') === GRID_CONTENT_TYPE) {
+            return response.arrayBuffer().then(buffer => ({image: decodeGrid(buffer)}));
+        }
+        return response.json();
     })
-    .then(response => response.json())
     .then(result => {
-        draw_image(result.pixels_image, 'create-image');
+        if (result.error) {
+            console.log(result.error);
+            return;
+        }
+        draw_image(result.image, 'create-image');
     })
-}
\ No newline at end of file
+    .catch(error => {
+        console.log(error);
+    });
+}
@@ -11,3 +11,102 @@ function hexToRgb(hex) {
 
 // Function from RGB string to array
 const toRGBArray = rgbStr => rgbStr.match(/\d+/g).map(Number);
+
+
+// Binary format of pixel grids, see pixelpictures/grid_format.py
+const GRID_CONTENT_TYPE = 'application/x-pixel-grid';
+const GRID_HEADER_SIZE = 23;
+
+function decodeGrid(buffer) {
+    // returns image as heightXwidth array of colors
+    const view = new DataView(buffer);
+    const flags = view.getUint8(4);
+    const channels = view.getUint8(5);
+    const height = view.getUint16(6, true);
+    const width = view.getUint16(8, true);
+    const n_colors = view.getUint32(10, true);
+    const size = view.getUint8(14);
+    const n_runs = view.getUint32(15, true);
+
+    const readIndex = position => {
+        if (size === 1) return view.getUint8(position);
+        if (size === 2) return view.getUint16(position, true);
+        return view.getUint32(position, true);
+    };
+
+    let offset = GRID_HEADER_SIZE;
+    let palette = [];
+    for (let i = 0; i < n_colors; i++) {
+        palette.push(Array.from(new Uint8Array(buffer, offset + i * channels, channels)));
+    }
+    offset += n_colors * channels;
+
+    let indices = [];
+    if (flags & 1) {
+        // Run-length encoded: lengths, then indices
+        for (let run = 0; run < n_runs; run++) {
+            const length = view.getUint16(offset + 2 * run, true);
+            const index = readIndex(offset + 2 * n_runs + size * run);
+            for (let i = 0; i < length; i++) {
+                indices.push(index);
+            }
+        }
+    } else {
+        for (let i = 0; i < height * width; i++) {
+            indices.push(readIndex(offset + size * i));
+        }
+    }
+
+    let image = [];
+    for (let row = 0; row < height; row++) {
+        image.push(indices.slice(row * width, (row + 1) * width).map(index => palette[index]));
+    }
+    return image;
+}
+
+function encodeGrid(image, metadata) {
+    // image is a heightXwidth array of colors, metadata is sent as JSON together with the image
+    let colors = new Map();
+    let palette = [];
+    let indices = [];
+    image.forEach(row => {
+        row.forEach(color => {
+            const key = color.join(',');
+            if (!colors.has(key)) {
+                colors.set(key, palette.length);
+                palette.push(color);
+            }
+            indices.push(colors.get(key));
+        });
+    });
+
+    const channels = palette.length ? palette[0].length : 3;
+    const size = palette.length <= 256 ? 1 : (palette.length <= 65536 ? 2 : 4);
+    const encoded_metadata = new TextEncoder().encode(JSON.stringify(metadata));
+
+    const buffer = new ArrayBuffer(GRID_HEADER_SIZE + palette.length * channels + indices.length * size + encoded_metadata.length);
+    const view = new DataView(buffer);
+    'PXGR'.split('').forEach((char, i) => view.setUint8(i, char.charCodeAt(0)));
+    view.setUint8(4, 0);
+    view.setUint8(5, channels);
+    view.setUint16(6, image.length, true);
+    view.setUint16(8, image.length ? image[0].length : 0, true);
+    view.setUint32(10, palette.length, true);
+    view.setUint8(14, size);
+    view.setUint32(15, 0, true);
+    view.setUint32(19, encoded_metadata.length, true);
+
+    let offset = GRID_HEADER_SIZE;
+    palette.forEach(color => {
+        color.forEach(channel => view.setUint8(offset++, channel));
+    });
+    indices.forEach(index => {
+        if (size === 1) view.setUint8(offset, index);
+        else if (size === 2) view.setUint16(offset, index, true);
+        else view.setUint32(offset, index, true);
+        offset += size;
+    });
+    new Uint8Array(buffer, offset).set(encoded_metadata);
+
+    return buffer;
+}
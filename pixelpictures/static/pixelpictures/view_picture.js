@@ -1,3 +1,31 @@
+// Time between checks of the render of the picture, in milliseconds
+const RENDER_POLL_INTERVAL = 1000;
+
+document.addEventListener("DOMContentLoaded", function() {
+    // The png of a just saved picture is rendered in background
+    let image = document.querySelector("#plain-image");
+    if (image.dataset.render === 'pending' || image.dataset.render === 'running') {
+        wait_render(image);
+    }
+});
+
+function wait_render(image) {
+    fetch(`/render/${image.dataset.key}`)
+    .then(response => response.json())
+    .then(result => {
+        image.dataset.render = result.render;
+        if (result.render === 'done') {
+            // Load the png again, the first request failed
+            image.src = image.src.split('?')[0] + `?${Date.now()}`;
+        } else if (result.render !== 'failed') {
+            setTimeout(() => wait_render(image), RENDER_POLL_INTERVAL);
+        }
+    })
+    .catch(error => {
+        console.log(error);
+    });
+}
+
 function delete_picture(key) {
     let confirmation = confirm("Do you want to delete this picture? The action is irreversible!");
     if (confirmation){
@@ -22,45 +50,69 @@ function delete_picture(key) {
     }
 }
 
-function download_view(key){
-    const csrftoken = document.querySelector('[name=csrfmiddlewaretoken]').value;
+function grid_options(key) {
+    // Options of the grid chosen in the page
+    return {
+        key: key,
+        start_row: document.querySelector("#start-row").value,
+        start_col: document.querySelector("#start-col").value,
+        dir_rows: document.querySelector("input[name='row-direction']:checked").value,
+        dir_cols: document.querySelector("input[name='col-direction']:checked").value,
+        grid_color: toRGBArray(hexToRgb(document.querySelector("input[type='color']").value)),
+        size_cell: document.querySelector("input[type='range']").value,
+        step: document.querySelector("#step").value
+    };
+}
+
+function grid_url(key, format) {
+    // Grid drawn by the server, cached by the browser until the picture or the options change
+    let options = grid_options(key);
+    options.grid_color = options.grid_color.join(',');
+    options.format = format;
+    return `/download?${new URLSearchParams(options)}`;
+}
 
+function download_file(key, format) {
+    // Grid as a file (png, or pdf with one page for every part of the picture)
+    let download = document.createElement('a');
+    download.href = grid_url(key, format);
+    download.download = `${key}.${format}`;
+    download.click();
+}
+
+function download_view(key){
     let preview = document.querySelector("#view-image");
     preview.querySelector("img").remove()
-    
-    fetch(`/download`, {
-        method: 'POST',
-        headers: {'X-CSRFToken': csrftoken},
-        mode: 'same-origin',
-        body: JSON.stringify({
-            key: key,
-            start_row: document.querySelector("#start-row").value,
-            start_col: document.querySelector("#start-col").value,
-            dir_rows: document.querySelector("input[name='row-direction']:checked").value,
-            dir_cols: document.querySelector("input[name='col-direction']:checked").value,
-            grid_color: toRGBArray(hexToRgb(document.querySelector("input[type='color']").value)),
-            size_cell: document.querySelector("input[type='range']").value,
-            step: document.querySelector("#step").value
-        })
-    })
-    .then(response => response.json())
-    .then(result => {
-        image = document.createElement('img');
-        image.src = result.source;
-        preview.append(image);
-        document.querySelector("#download").href = result.source;
-        document.querySelector("#download").download = key;
-    })
-    .catch(error => {
-        console.log(error);
-    });
+
+    let image = document.createElement('img');
+    image.src = grid_url(key, 'png');
+    preview.append(image);
+    document.querySelector("#download").href = image.src;
+    document.querySelector("#download").download = key;
+}
+
+function download_plain(event) {
+    // Previews with grid are already scaled
+    let link = event.currentTarget;
+    if (link.href.includes('/download?')) {
+        return;
+    }
+
+    // The stored png is scaled to 18 pixels per cell by the server, images from other origins cannot be exported from a canvas
+    event.preventDefault();
+    let image = document.querySelector("#plain-image");
+    let download = document.createElement('a');
+    download.href = `/download?${new URLSearchParams({key: image.dataset.key, format: 'plain', size_cell: 18})}`;
+    download.download = link.download;
+    download.click();
 }
 
 function set_image_size(event, key){
     let new_size = event.target.value;
     if (document.querySelector('#view-image img').id === 'plain-image') {
-        let width_image = document.querySelector('#view-image img').naturalWidth;
-        document.querySelector("#view-image img").style.width = `${width_image / 18 * new_size}px`;
+        // Width of the picture in cells, the stored png is scaled by the browser
+        let width_image = document.querySelector('#view-image img').dataset.width;
+        document.querySelector("#view-image img").style.width = `${width_image * new_size}px`;
     }
     else {
         download_view(key)
@@ -0,0 +1,178 @@
+import io
+import os
+import hashlib
+import mimetypes
+import threading
+from functools import lru_cache
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage, FileSystemStorage
+from django.core.signals import setting_changed
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+# Files of pictures are named by the hash of their pixels, so identical pictures share them and a name
+# always has the same content (URLs can be cached forever). Files are removed when no picture uses them.
+#
+# Files are read and written through the storage configured by settings.PICTURES_STORAGE, local files
+# (PictureFileSystemStorage) or an S3-compatible bucket shared by all app nodes (S3Storage).
+
+# Heights of thumbnails, made for pictures taller than them (the gallery shows pictures 300px high)
+THUMBNAIL_HEIGHTS = (75, 150, 300, 600)
+EXTENSIONS = ('png', 'webp')
+# Content never changes for a name
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+@deconstructible
+class PictureFileSystemStorage(FileSystemStorage):
+    '''
+    Local storage of picture files. Names are overwritten (files with the same name have the same content)
+    and files are written to a temporary file and renamed, so they are never seen partially written.
+    '''
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}_{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, 'wb') as file:
+                for chunk in content.chunks():
+                    file.write(chunk)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return name
+
+@deconstructible
+class S3Storage(Storage):
+    '''
+    Storage of picture files in a bucket of an S3-compatible service (AWS S3, MinIO, ...), shared by all app nodes.
+    Objects are read as streams, they are not loaded in memory.
+
+    Parameters
+    ----------
+        bucket : str, name of the bucket
+        base_url : str, URL of the objects (e.g. of a CDN), if None they are served by the endpoint
+        client : optional client with the interface of boto3 S3 clients, if None one is made with boto3
+        cache_control : str, Cache-Control header of uploaded objects
+        client_options : arguments of boto3.client, e.g. endpoint_url, region_name, aws_access_key_id
+    '''
+
+    def __init__(self, bucket, base_url=None, client=None, cache_control=IMMUTABLE, **client_options):
+        self.bucket = bucket
+        self.base_url = base_url
+        self._client = client
+        self.cache_control = cache_control
+        self.client_options = client_options
+
+    @cached_property
+    def client(self):
+        if self._client is not None:
+            return self._client
+        try:
+            import boto3
+        except ImportError:
+            raise ImproperlyConfigured("S3Storage requires boto3.")
+        return boto3.client('s3', **self.client_options)
+
+    def _open(self, name, mode='rb'):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=name)
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(name)
+        # Body is read from the connection as it is consumed
+        return File(response['Body'], name)
+
+    def _save(self, name, content):
+        content.seek(0)
+        self.client.put_object(Bucket=self.bucket, Key=name, Body=content,
+                               ContentType=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                               CacheControl=self.cache_control)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def exists(self, name):
+        # Listing does not raise errors of missing objects, that are specific to boto3
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=name, MaxKeys=1)
+        return any(item['Key'] == name for item in response.get('Contents', []))
+
+    def size(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=name)['ContentLength']
+
+    def url(self, name):
+        if self.base_url is not None:
+            return self.base_url + quote(name)
+        endpoint_url = self.client_options.get('endpoint_url')
+        if endpoint_url:
+            return f"{endpoint_url.rstrip('/')}/{self.bucket}/{quote(name)}"
+        return f"https://{self.bucket}.s3.amazonaws.com/{quote(name)}"
+
+@lru_cache(maxsize=None)
+def picture_storage():
+    # Storage of picture files, configured by settings.PICTURES_STORAGE
+    config = settings.PICTURES_STORAGE
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+def reset_storage(*, setting, **kwargs):
+    # Tests can change the storage with override_settings
+    if setting == 'PICTURES_STORAGE':
+        picture_storage.cache_clear()
+
+setting_changed.connect(reset_storage)
+
+def content_hash(pixels):
+    # Name of the files of a picture with these pixels (Picture.pixels)
+    return hashlib.sha256(bytes(pixels)).hexdigest()
+
+def picture_name(name, suffix='', extension='png'):
+    # Name in the storage of the PNG of a picture, or of its variants (suffix of thumbnails, webp extension)
+    return f"{name}{suffix}.{extension}"
+
+def picture_url(name, suffix='', extension='png'):
+    # URL of a picture file
+    return picture_storage().url(picture_name(name, suffix, extension))
+
+def encode_image(image, image_format, **params):
+    # Returns the bytes of image saved in image_format
+    image_io = io.BytesIO()
+    image.save(image_io, image_format, **params)
+    return image_io.getvalue()
+
+def save_file(name, data):
+    # Writes bytes data to file name of the storage
+    picture_storage().save(name, ContentFile(data))
+
+def open_file(name):
+    '''
+    Opens file name of the storage for reading, in binary mode. The file is read as a stream (use File.chunks
+    or read it in pieces), it is not loaded in memory.
+
+    Raises FileNotFoundError if there is not such file.
+    '''
+
+    return picture_storage().open(name, 'rb')
+
+def file_exists(name):
+    # If file name is in the storage
+    return picture_storage().exists(name)
+
+def remove_files(name):
+    # Removes the PNG of a picture and all its possible variants, missing files are ignored
+    storage = picture_storage()
+    for suffix in [''] + [f'_h{height}' for height in THUMBNAIL_HEIGHTS]:
+        for extension in EXTENSIONS:
+            storage.delete(picture_name(name, suffix, extension))
@@ -1,11 +1,19 @@
 from django import template
 
+from pixelpictures.storage import picture_url as stored_picture_url
+
 register = template.Library()
 
-@register.filter(name='times')
-def times(number):
-    return range(1, number + 1)
+@register.filter(name='picture_url')
+def picture_url(picture, suffix=''):
+    # URL of the png of a picture in the storage (files are named by content, see storage.py)
+    return stored_picture_url(picture.stored_image.content_hash, suffix)
 
-@register.filter(name='timestamp')
-def timestamp(time):
-    return time.strftime('%Y%m%d_%H%M%S')
\ No newline at end of file
+@register.filter(name='srcset')
+def srcset(picture, image_format='png'):
+    # Stored variants of a picture as srcset candidates, in webp where it is smaller if image_format is 'webp'
+    name = picture.stored_image.content_hash
+    return ', '.join(
+        f"{stored_picture_url(name, variant['suffix'], 'webp' if image_format == 'webp' and variant['webp'] else 'png')} {variant['width']}w"
+        for variant in picture.stored_image.thumbnails
+    )
@@ -1,12 +1,26 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import io
+import tempfile
 import json
-import os
+from datetime import timedelta
+from unittest.mock import patch, Mock
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from PIL import Image
 from django.core.files.uploadedfile import SimpleUploadedFile
 
-from pixelpictures.models import User, Picture, Tag
-from pixelpictures.views import update_tags, PATH_PICTURES
+from pixelpictures.models import User, Picture, Tag, RenderJob, StoredImage
+from pixelpictures.views import update_tags
+from pixelpictures.render import run_render_jobs, enqueue_render, render_png, MAX_ATTEMPTS, LEASE
+from pixelpictures.storage import picture_name, picture_storage, file_exists, open_file, remove_files
+from pixelpictures.image_to_pixels import add_grid
+from pixelpictures.grid_cache import flush_stats
+from pixelpictures.grid_format import GRID_CONTENT_TYPE, encode_grid, decode_grid, decode_indexed, compress_grid
 
 class APITestCase(TestCase):
 
@@ -29,11 +43,18 @@ class APITestCase(TestCase):
             pk=1
         )
         self.picture.save()
-        Tag.objects.create(picture=self.picture, tag='tag1')
+        self.picture.tags.create(tag='tag1')
         self.sample_image = [[[0,0,0], [0,0,0], [255,255,255]], [[255,255,255], [1,2,3], [0,0,0]]]
         self.sample_palette = [[0,0,0], [255,255,255]]
         self.sample_tags = ['tag1', 'tag2']
         self.test_img = open('pixelpictures/tests/manda.jpg', 'rb')
+        # Grids drawn by downloads are cached in a temporary directory
+        grid_cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(grid_cache_dir.cleanup)
+        grid_cache_settings = override_settings(GRID_CACHE_DIR=grid_cache_dir.name)
+        grid_cache_settings.enable()
+        self.addCleanup(grid_cache_settings.disable)
+        self.addCleanup(flush_stats)
 
     # Tests update_tags
 
@@ -41,19 +62,74 @@ class APITestCase(TestCase):
         tags = ['tag1', 'tag2', 'tag3']
         picture = Picture.objects.get(pk=1)
         update_tags(picture, tags)
-        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=picture)]
+        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=picture).order_by('tag')]
         
         self.assertEqual(set(tags), set(new_tags))
         self.assertEqual(len(new_tags), 3)
 
+    def test_update_tags_normalized(self):
+        update_tags(self.picture, ['Tag1', ' tag2', 'TAG2', ''])
+        other_picture = Picture.objects.create(image=self.sample_image, user=self.creator, timestamp=timezone.now())
+        update_tags(other_picture, ['tag2'])
+
+        # Tags are stored once and shared by pictures
+        self.assertEqual([tag.tag for tag in self.picture.tags.order_by('tag')], ['tag1', 'tag2'])
+        self.assertEqual(Tag.objects.count(), 2)
+        self.assertEqual(Tag.objects.get(tag='tag2').pictures.count(), 2)
+
+    def test_update_tags_queries(self):
+        old_tags = [f'old{i}' for i in range(20)]
+        new_tags = [f'new{i}' for i in range(20)]
+        update_tags(self.picture, old_tags)
+
+        # Current tags, delete, delete unused tags, create tags, ids of tags, add tags
+        with self.assertNumQueries(6):
+            update_tags(self.picture, new_tags)
+        self.assertEqual(set(tag.tag for tag in self.picture.tags.all()), set(new_tags))
+
+        # Nothing to change
+        with self.assertNumQueries(1):
+            update_tags(self.picture, new_tags)
+
     def test_update_tags_delete(self):
         tags = ['tag3']
         picture = Picture.objects.get(pk=1)
         update_tags(picture, tags)
-        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=picture)]
+        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=picture).order_by('tag')]
         
         self.assertEqual(tags, new_tags)
 
+    def test_update_tags_delete_unused(self):
+        update_tags(self.picture, ['tag1', 'tag2'])
+        other_picture = Picture.objects.create(image=self.sample_image, user=self.creator, timestamp=timezone.now())
+        update_tags(other_picture, ['tag2'])
+        update_tags(self.picture, [])
+
+        # Tags still used by other pictures are kept
+        self.assertEqual(list(Tag.objects.values_list('tag', flat=True)), ['tag2'])
+        update_tags(other_picture, [])
+        self.assertFalse(Tag.objects.exists())
+
+    # Tests Picture image storage
+
+    def test_picture_image(self):
+        picture = Picture.objects.get(pk=1)
+        image = [
+            [[0,0,0], [0,0,0], [255,255,255]],
+            [[255,255,255], [1,2,3], [0,0,0]],
+            [[0,0,0], [123,123,123], [33,25,23]],
+            [[255,255,255], [123,123,123], [0,0,0]]]
+
+        self.assertEqual((picture.height, picture.width), (4, 3))
+        self.assertEqual(picture.palette_size, 5)
+        self.assertEqual(picture.image, image)
+        # Decompressed array is reused until pixels change
+        self.assertIs(picture.image_array, picture.image_array)
+
+        picture.image = self.sample_image
+        self.assertEqual((picture.height, picture.width), (2, 3))
+        self.assertEqual(picture.image, self.sample_image)
+
     # Tests save_image
 
     def test_save_image_anonymous_create_new_one(self):
@@ -65,7 +141,7 @@ class APITestCase(TestCase):
         }
         response = self.client.post(reverse('save'), json.dumps(body), content_type="application/json")
 
-        self.assertFalse(Picture.objects.filter(image=self.sample_image))
+        self.assertFalse(Picture.objects.filter(pixels=compress_grid(self.sample_image)))
         self.assertEqual(json.loads(response.content)['message'], 'You have to log in to save a picture.')
 
     def test_save_image_creator_create_new_one(self):
@@ -77,8 +153,12 @@ class APITestCase(TestCase):
             'palette': self.sample_palette
         }
         response = self.client.post(reverse('save'), json.dumps(body), content_type="application/json")
-        new_picture = Picture.objects.get(image=self.sample_image)
-        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=new_picture)]
+        new_picture = Picture.objects.get(pixels=compress_grid(self.sample_image))
+        self.assertEqual(json.loads(response.content)['render'], 'pending')
+        self.assertFalse(file_exists(picture_name(new_picture.stored_image.content_hash)))
+        # Png is rendered by the worker
+        self.assertEqual(run_render_jobs(), 1)
+        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=new_picture).order_by('tag')]
 
         self.assertEqual(json.loads(response.content)['message'], 'Picture saved correctly.')
         self.assertEqual(json.loads(response.content)['key'], new_picture.pk)
@@ -86,10 +166,277 @@ class APITestCase(TestCase):
         self.assertTrue(new_picture.public)
         self.assertEqual(new_picture.palette, self.sample_palette)
         self.assertEqual(new_tags, self.sample_tags)
-        self.assertTrue(os.path.isfile(f"{PATH_PICTURES}/{new_picture.pk}_{new_picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png"))
+        self.assertTrue(file_exists(picture_name(new_picture.stored_image.content_hash)))
 
         # Delete created file
-        os.remove(f"{PATH_PICTURES}/{new_picture.pk}_{new_picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png")
+        remove_files(new_picture.stored_image.content_hash)
+
+    def test_save_image_binary_grid(self):
+        self.client.login(username='creator', password='pssSre!1')
+        body = encode_grid(self.sample_image, {
+            'public': True,
+            'tags': self.sample_tags,
+            'palette': self.sample_palette
+        })
+        response = self.client.post(reverse('save'), body, content_type=GRID_CONTENT_TYPE)
+        new_picture = Picture.objects.get(pk=json.loads(response.content)['key'])
+        run_render_jobs()
+
+        self.assertEqual(json.loads(response.content)['message'], 'Picture saved correctly.')
+        self.assertEqual(new_picture.image, self.sample_image)
+        self.assertEqual(new_picture.palette, self.sample_palette)
+        self.assertEqual([tag.tag for tag in new_picture.tags.all()], self.sample_tags)
+
+        remove_files(new_picture.stored_image.content_hash)
+
+    def test_render_jobs(self):
+        self.client.login(username='creator', password='pssSre!1')
+        body = {'image': self.sample_image, 'public': False, 'tags': [], 'palette': self.sample_palette, 'key': 1}
+        self.client.put(reverse('save'), json.dumps(body), content_type="application/json")
+        first_picture = Picture.objects.get(pk=1)
+        response = self.client.get(reverse('render_status', args=[1]))
+        self.assertEqual(json.loads(response.content)['render'], 'pending')
+
+        # Jobs are keyed on picture and timestamp, enqueueing again does not add a job
+        enqueue_render(first_picture)
+        self.assertEqual(RenderJob.objects.filter(picture=first_picture).count(), 1)
+
+        # Jobs of older versions are not rendered
+        body['image'] = self.picture.image
+        with patch('pixelpictures.views.timezone.now', return_value=first_picture.timestamp + timedelta(seconds=1)):
+            self.client.put(reverse('save'), json.dumps(body), content_type="application/json")
+        with patch('pixelpictures.render.render_png', wraps=render_png) as render:
+            self.assertEqual(run_render_jobs(), 2)
+        self.assertEqual(render.call_count, 1)
+
+        picture = Picture.objects.get(pk=1)
+        # Stored png has one pixel for every cell, in palette mode
+        png = Image.open(open_file(picture_name(picture.stored_image.content_hash)))
+        self.assertEqual(png.mode, 'P')
+        self.assertEqual(np.array(png.convert('RGB')).tolist(), self.picture.image)
+        self.assertFalse(file_exists(picture_name(first_picture.stored_image.content_hash)))
+        response = self.client.get(reverse('render_status', args=[1]))
+        self.assertEqual(json.loads(response.content)['render'], 'done')
+        remove_files(picture.stored_image.content_hash)
+
+    def test_render_thumbnails(self):
+        image = np.random.default_rng(0).integers(0, 4, (400, 300, 1)) * [60, 30, 20]
+        picture = Picture.objects.create(image=image, user=self.creator, public=True, timestamp=timezone.now())
+        enqueue_render(picture)
+        run_render_jobs()
+        picture.refresh_from_db()
+
+        # Thumbnails are smaller than the picture and look like it scaled in the page
+        name = picture.stored_image.content_hash
+        self.assertEqual([variant['suffix'] for variant in picture.stored_image.thumbnails], ['', '_h75', '_h150', '_h300'])
+        full_size = picture_storage().size(picture_name(name))
+        for variant in picture.stored_image.thumbnails:
+            thumbnail = Image.open(open_file(picture_name(name, variant['suffix'])))
+            self.assertEqual(thumbnail.width, variant['width'])
+            self.assertLessEqual(picture_storage().size(picture_name(name, variant['suffix'])), full_size)
+            np.testing.assert_array_equal(np.array(thumbnail.convert('RGB')), np.array(Image.open(open_file(picture_name(name))).convert('RGB').resize(thumbnail.size, Image.NEAREST)))
+            self.assertEqual(file_exists(picture_name(name, variant['suffix'], 'webp')), variant['webp'])
+
+        # Gallery chooses among them
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, f"{name}_h75.")
+        self.assertContains(response, 'sizes="225px"')
+
+        remove_files(name)
+
+    def test_stored_image_shared(self):
+        # Pictures with the same pixels share their files, rendered once
+        image = [[[10, 20, 30], [40, 50, 60]]]
+        first = Picture.objects.create(image=image, user=self.creator, public=True, timestamp=timezone.now())
+        second = Picture.objects.create(image=image, user=self.notCreator, public=True, timestamp=timezone.now())
+        self.assertEqual(first.stored_image_id, second.stored_image_id)
+        enqueue_render(first)
+        enqueue_render(second)
+        with patch('pixelpictures.render.render_png', wraps=render_png) as render:
+            self.assertEqual(run_render_jobs(), 2)
+        self.assertEqual(render.call_count, 1)
+        name = picture_name(first.stored_image.content_hash)
+        self.assertTrue(file_exists(name))
+
+        # Files are removed with the last picture using them
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(file_exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(file_exists(name))
+        self.assertFalse(StoredImage.objects.filter(pk=first.stored_image_id).exists())
+
+    def test_render_jobs_retry(self):
+        job = enqueue_render(self.picture)
+        with patch('pixelpictures.render.render_png', side_effect=OSError('Disk full')):
+            for _ in range(MAX_ATTEMPTS):
+                run_render_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, MAX_ATTEMPTS)
+        self.assertEqual(job.error, 'Disk full')
+        self.assertEqual(run_render_jobs(), 0)
+
+    def test_render_jobs_lease(self):
+        # Jobs of a stopped worker are claimed again when their lease expires
+        job = enqueue_render(self.picture)
+        RenderJob.objects.filter(pk=job.pk).update(status='running', attempts=1, claimed_at=timezone.now())
+        self.assertEqual(run_render_jobs(), 0)
+
+        RenderJob.objects.filter(pk=job.pk).update(claimed_at=timezone.now() - LEASE - timedelta(seconds=1))
+        self.assertEqual(run_render_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+
+        # Unless they were already run too many times
+        job = enqueue_render(Picture.objects.create(image=[[[1, 1, 1]]], user=self.creator, timestamp=timezone.now()))
+        RenderJob.objects.filter(pk=job.pk).update(status='running', attempts=MAX_ATTEMPTS, claimed_at=timezone.now() - 2 * LEASE)
+        self.assertEqual(run_render_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('failed', 'Render did not finish.'))
+        remove_files(self.picture.stored_image.content_hash)
+
+    def test_render_jobs_broken_executor(self):
+        # Jobs not submitted to a broken pool go back to the queue, the error is raised to restart the pool
+        job = enqueue_render(self.picture)
+        executor = ThreadPoolExecutor()
+        executor.submit = Mock(side_effect=BrokenProcessPool('A process terminated abruptly'))
+        with self.assertRaises(BrokenProcessPool):
+            run_render_jobs(executor)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('pending', 'A process terminated abruptly'))
+
+        with ThreadPoolExecutor() as executor:
+            self.assertEqual(run_render_jobs(executor), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+        remove_files(self.picture.stored_image.content_hash)
+
+    def test_download_streamed(self):
+        options = {'key': 1, 'start_row': 1, 'start_col': 1, 'dir_rows': 'tb', 'dir_cols': 'lr',
+                   'grid_color': [0, 0, 255], 'size_cell': 20, 'step': 2}
+        enqueue_render(self.picture)
+        run_render_jobs()
+
+        # Big grids are streamed as files
+        response = self.client.post(reverse('download'), json.dumps({**options, 'format': 'png'}), content_type="application/json")
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        png = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+        expected = add_grid(Image.fromarray(np.array(self.picture.image, dtype=np.uint8)), grid_color=(0, 0, 255), size_cell=20, step=2)
+        np.testing.assert_array_equal(np.array(png), np.array(expected))
+
+        response = self.client.post(reverse('download'), json.dumps({**options, 'format': 'pdf'}), content_type="application/json")
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+        response = self.client.post(reverse('download'), json.dumps({**options, 'format': 'gif'}), content_type="application/json")
+        self.assertEqual(json.loads(response.content)['error'], 'Format must be one of: png, pdf, plain.')
+
+        # Picture without grid, upscaled by the server
+        response = self.client.get(reverse('download'), {'key': 1, 'format': 'plain', 'size_cell': 18})
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="1.png"')
+        png = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+        expected = np.array(self.picture.image, dtype=np.uint8).repeat(18, axis=0).repeat(18, axis=1)
+        np.testing.assert_array_equal(np.array(png), expected)
+
+        remove_files(self.picture.stored_image.content_hash)
+
+    def test_download_get_cached(self):
+        enqueue_render(self.picture)
+        run_render_jobs()
+        query = {'key': 1, 'grid_color': '0,0,255', 'size_cell': 20, 'step': 2}
+
+        response = self.client.get(reverse('download'), query)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Cache-Control'], 'max-age=60, public')
+        etag = response['ETag']
+        png = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+        expected = add_grid(Image.fromarray(np.array(self.picture.image, dtype=np.uint8)), grid_color=(0, 0, 255), size_cell=20, step=2)
+        np.testing.assert_array_equal(np.array(png), np.array(expected))
+
+        # Same grid is not drawn again
+        with patch('pixelpictures.views.open_file') as open_file_mock:
+            response = self.client.get(reverse('download'), query, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        open_file_mock.assert_not_called()
+
+        # Other options or pixels are other grids
+        response = self.client.get(reverse('download'), {**query, 'step': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        name = self.picture.stored_image.content_hash
+        self.picture.image = self.sample_image
+        self.picture.save()
+        response = self.client.get(reverse('download'), query, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(response.status_code, 304)
+
+        response = self.client.get(reverse('download'), {**query, 'grid_color': '0,0'})
+        self.assertEqual(json.loads(response.content)['error'], 'Color of the grid must have 3 values between 0 and 255.')
+
+        remove_files(name)
+
+    @override_settings(MAX_DOWNLOAD_PIXELS=140 * 160)
+    def test_download_too_big(self):
+        enqueue_render(self.picture)
+        run_render_jobs()
+
+        # Picture of 4 x 3 cells with a border of 40 pixels
+        response = self.client.get(reverse('download'), {'key': 1, 'size_cell': 20})
+        self.assertEqual(response.status_code, 200)
+        for size_cell, error in [(21, 'The grid is too big, choose smaller cells.'),
+                                 (10000000, 'Size of cells must be between 1 and 50.'),
+                                 (0, 'Size of cells must be between 1 and 50.')]:
+            for output_format in ['png', 'plain']:
+                response = self.client.get(reverse('download'), {'key': 1, 'size_cell': size_cell, 'format': output_format})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(json.loads(response.content)['error'], error)
+            response = self.client.post(reverse('download'), json.dumps({'key': 1, 'size_cell': size_cell}), content_type="application/json")
+            self.assertEqual(json.loads(response.content)['error'], error)
+
+        remove_files(self.picture.stored_image.content_hash)
+
+    def test_download_private(self):
+        # Grids of private pictures are sent only to their creator, conditional requests too
+        Picture.objects.filter(pk=1).update(public=False)
+        enqueue_render(self.picture)
+        run_render_jobs()
+        query = {'key': 1, 'size_cell': 20}
+
+        self.client.login(username='creator', password='pssSre!1')
+        response = self.client.get(reverse('download'), query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'max-age=60, private')
+        etag = response['ETag']
+
+        for username, password in [(None, None), ('notCreator', 'somePass123')]:
+            self.client.logout()
+            if username:
+                self.client.login(username=username, password=password)
+            for headers in [{}, {'HTTP_IF_NONE_MATCH': etag}]:
+                response = self.client.get(reverse('download'), query, **headers)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(json.loads(response.content)['error'], 'You do not have access to this picture.')
+            response = self.client.post(reverse('download'), json.dumps(query), content_type="application/json")
+            self.assertEqual(json.loads(response.content)['error'], 'You do not have access to this picture.')
+
+        remove_files(self.picture.stored_image.content_hash)
+
+    @override_settings(MAX_GRID_PIXELS=5)
+    def test_save_image_too_big(self):
+        self.client.login(username='creator', password='pssSre!1')
+        for body, content_type in [(encode_grid(np.zeros((2, 3, 3)), max_pixels=6), GRID_CONTENT_TYPE),
+                                   (json.dumps({'image': np.zeros((2, 3, 3), dtype=int).tolist()}), "application/json")]:
+            response = self.client.post(reverse('save'), body, content_type=content_type)
+            self.assertEqual(json.loads(response.content)['error'], 'Image cannot have more than 5 pixels.')
+
+    def test_save_image_wrong_binary_grid(self):
+        self.client.login(username='creator', password='pssSre!1')
+        response = self.client.post(reverse('save'), b'not a grid', content_type=GRID_CONTENT_TYPE)
+        self.assertEqual(json.loads(response.content)['error'], 'Not a pixel grid.')
 
     def test_save_image_anonymous_modify_existing_picture(self):
         body={
@@ -101,8 +448,8 @@ class APITestCase(TestCase):
         }
         response = self.client.put(reverse('save'), json.dumps(body), content_type="application/json")
         modified_picture = Picture.objects.get(pk=1)
-        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=modified_picture)]
-        old_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=self.picture)]
+        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=modified_picture).order_by('tag')]
+        old_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=self.picture).order_by('tag')]
 
         self.assertEqual(json.loads(response.content)['error'], 'Cannot modify a picture not created by you.')
         self.assertEqual(modified_picture.user, self.creator)
@@ -122,8 +469,8 @@ class APITestCase(TestCase):
         }
         response = self.client.put(reverse('save'), json.dumps(body), content_type="application/json")
         modified_picture = Picture.objects.get(pk=1)
-        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=modified_picture)]
-        old_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=self.picture)]
+        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=modified_picture).order_by('tag')]
+        old_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=self.picture).order_by('tag')]
 
         self.assertEqual(json.loads(response.content)['error'], 'Cannot modify a picture not created by you.')
         self.assertEqual(modified_picture.user, self.creator)
@@ -141,9 +488,14 @@ class APITestCase(TestCase):
             'palette': self.sample_palette,
             'key': 1
         }
-        response = self.client.put(reverse('save'), json.dumps(body), content_type="application/json")
+        old_stored_image = self.picture.stored_image_id
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(reverse('save'), json.dumps(body), content_type="application/json")
+        run_render_jobs()
         modified_picture = Picture.objects.get(pk=1)
-        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(picture=modified_picture)]
+        # Stored image of the previous pixels is not used anymore
+        self.assertFalse(StoredImage.objects.filter(pk=old_stored_image).exists())
+        new_tags = [tag_object.tag for tag_object in Tag.objects.filter(pictures=modified_picture).order_by('tag')]
        
         self.assertEqual(json.loads(response.content)['message'], 'Picture saved correctly.')
         self.assertEqual(json.loads(response.content)['key'], 1)
@@ -154,7 +506,20 @@ class APITestCase(TestCase):
         self.assertEqual(new_tags, self.sample_tags)
 
         # Delete create file
-        os.remove(f"{PATH_PICTURES}/{modified_picture.pk}_{modified_picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png")
+        remove_files(modified_picture.stored_image.content_hash)
+
+    def test_save_image_modify_keeps_views(self):
+        # Views counted while a picture is modified are not overwritten
+        self.client.login(username='creator', password='pssSre!1')
+        Picture.objects.filter(pk=1).update(views=7)
+        body = {'image': self.sample_image, 'public': True, 'tags': [], 'palette': self.sample_palette, 'key': 1}
+        with CaptureQueriesContext(connection) as queries:
+            self.client.put(reverse('save'), json.dumps(body), content_type="application/json")
+
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "pixelpictures_picture"')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"views"', updates[0])
+        self.assertEqual(Picture.objects.get(pk=1).views, 7)
 
     def test_save_image_anonymous_modify_non_existing_picture(self):
         body={
@@ -195,6 +560,7 @@ class APITestCase(TestCase):
             'key': 2
         }
         response = self.client.post(reverse('save'), json.dumps(body_new_picture), content_type="application/json")
+        run_render_jobs()
         new_picture = Picture.objects.get(pk=2)
         self.client.logout()
 
@@ -205,7 +571,7 @@ class APITestCase(TestCase):
 
         self.assertEqual(json.loads(response_anonymous.content)['message'], 'You cannot delete a picture that is not yours!')
         self.assertTrue(Picture.objects.filter(pk=2))
-        self.assertTrue(os.path.isfile(f"{PATH_PICTURES}/{new_picture.pk}_{new_picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png"))
+        self.assertTrue(file_exists(picture_name(new_picture.stored_image.content_hash)))
 
         # NotCreator User
         self.client.login(username='notCreator', password='somePass123')
@@ -213,15 +579,16 @@ class APITestCase(TestCase):
 
         self.assertEqual(json.loads(response_notCreator.content)['message'], 'You cannot delete a picture that is not yours!')
         self.assertTrue(Picture.objects.filter(pk=2))
-        self.assertTrue(os.path.isfile(f"{PATH_PICTURES}/{new_picture.pk}_{new_picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png"))
+        self.assertTrue(file_exists(picture_name(new_picture.stored_image.content_hash)))
 
         # Creator User
         self.client.login(username='creator', password='pssSre!1')
-        response_creator = self.client.post(reverse('delete_picture'), json.dumps(body), content_type="application/json")
+        with self.captureOnCommitCallbacks(execute=True):
+            response_creator = self.client.post(reverse('delete_picture'), json.dumps(body), content_type="application/json")
 
         self.assertEqual(json.loads(response_creator.content)['message'], 'Picture deleted successfully.')
         self.assertFalse(Picture.objects.filter(pk=2))
-        self.assertFalse(os.path.isfile(f"{PATH_PICTURES}/{new_picture.pk}_{new_picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png"))
+        self.assertFalse(file_exists(picture_name(new_picture.stored_image.content_hash)))
 
     def test_delete_anonymous_not_existing_picture(self):
         body={'key': 3}
@@ -252,18 +619,146 @@ class APITestCase(TestCase):
         response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 10, 'width': -10})
         self.assertEqual(json.loads(response.content)['error'], 'Height and width cannot be negative.')
 
+    def test_resize_wrong_size(self):
+        for data in [{'img': self.test_img, 'height': 30}, {'img': self.test_img, 'height': 30, 'width': 'ten'}]:
+            self.test_img.seek(0)
+            response = self.client.post(reverse('resize_image'), data=data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.content)['error'], 'Height and width must be integers.')
+
     def test_resize_error_with_file(self):
         img = open('pixelpictures/tests/manda.pdf', 'rb')
         response = self.client.post(reverse('resize_image'), data={'img': img, 'height': 30, 'width': 10})
 
         self.assertEqual(json.loads(response.content)['error'], 'Not supported file format.')
 
+    def test_resize_area_mode(self):
+        response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 30, 'width': 10, 'resample': 'area'})
+
+        self.assertEqual(len(json.loads(response.content)['sample_image']), 30)
+        self.assertEqual(len(json.loads(response.content)['sample_image'][0]), 10)
+
+    def test_resize_wrong_mode(self):
+        response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 30, 'width': 10, 'resample': 'cubic'})
+        self.assertEqual(json.loads(response.content)['error'], 'Resample mode must be one of: nearest, area.')
+
+    def test_resize_binary_grid(self):
+        response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 30, 'width': 10}, HTTP_ACCEPT=GRID_CONTENT_TYPE)
+        image, _ = decode_grid(response.content)
+
+        self.assertEqual(response['Content-Type'], GRID_CONTENT_TYPE)
+        self.assertEqual(image.shape, (30, 10, 4))
+
+    @override_settings(MAX_UPLOAD_SIZE=1000)
+    def test_resize_file_too_big(self):
+        response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 30, 'width': 10})
+        self.assertEqual(json.loads(response.content)['error'], 'Image file is too big.')
+
+    @override_settings(MAX_UPLOAD_SIZE=1000)
+    def test_upload_rejected_while_received(self):
+        # Files too big are not written to disk, other fields are still read
+        with patch('django.core.files.uploadhandler.TemporaryFileUploadHandler.receive_data_chunk') as receive:
+            response = self.client.post(reverse('sample_palette'), data={'img': self.test_img, 'colors': 8})
+        self.assertEqual(json.loads(response.content)['error'], 'Image file is too big.')
+        self.assertEqual(receive.call_count, 0)
+
+    @override_settings(MAX_GRID_PIXELS=1000)
+    def test_resize_too_big_size(self):
+        response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 100, 'width': 11})
+        self.assertEqual(json.loads(response.content)['error'], 'Image cannot have more than 1000 pixels.')
+
+    def test_resize_binary_grid_too_wide(self):
+        # Sides of binary grids are stored in 16 bits
+        response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 1, 'width': 70000}, HTTP_ACCEPT=GRID_CONTENT_TYPE)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['error'], 'Height and width cannot be greater than 65535.')
+
+    def test_resize_missing_file(self):
+        response = self.client.post(reverse('resize_image'), data={'height': 30, 'width': 10})
+        self.assertEqual(json.loads(response.content)['error'], 'Image file is missing.')
+
+    @override_settings(MAX_UPLOAD_PIXELS=1000)
+    def test_resize_too_many_pixels(self):
+        response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 30, 'width': 10})
+        self.assertEqual(json.loads(response.content)['error'], 'Image has too many pixels.')
+
     def test_resize_correct_input(self):
         response = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 30, 'width': 10})
 
         self.assertEqual(len(json.loads(response.content)['sample_image']), 30)
         self.assertEqual(len(json.loads(response.content)['sample_image'][0]), 10)
 
+    # Tests sample_palette
+
+    def test_sample_palette_non_post_request(self):
+        response = self.client.get(reverse('sample_palette'))
+        self.assertEqual(json.loads(response.content)['error'], 'POST request required.')
+
+    def test_sample_palette_wrong_number_of_colors(self):
+        response = self.client.post(reverse('sample_palette'), data={'img': self.test_img, 'colors': 0})
+        self.assertEqual(json.loads(response.content)['error'], 'Number of colors must be between 1 and 256.')
+
+        response = self.client.post(reverse('sample_palette'), data={'img': self.test_img, 'colors': 'many'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['error'], 'Number of colors must be between 1 and 256.')
+
+    def test_sample_palette_error_with_file(self):
+        img = open('pixelpictures/tests/manda.pdf', 'rb')
+        response = self.client.post(reverse('sample_palette'), data={'img': img, 'colors': 8})
+        self.assertEqual(json.loads(response.content)['error'], 'Not supported file format.')
+
+    def test_sample_palette_correct_input(self):
+        response = self.client.post(reverse('sample_palette'), data={'img': self.test_img, 'colors': 8})
+        palette = json.loads(response.content)['palette']
+
+        self.assertEqual(len(palette), 8)
+        for color in palette:
+            self.assertEqual(len(color), 3)
+            self.assertTrue(all(0 <= channel <= 255 for channel in color))
+
+    # Tests image_to_pattern
+
+    def test_image_to_pattern_non_post_request(self):
+        response = self.client.get(reverse('image_to_pattern'))
+        self.assertEqual(json.loads(response.content)['error'], 'POST request required.')
+
+    def test_image_to_pattern_empty_palette(self):
+        response = self.client.post(reverse('image_to_pattern'), data={'img': self.test_img, 'height': 30, 'width': 10, 'palette': '[]'})
+        self.assertEqual(json.loads(response.content)['error'], 'Palette cannot be empty.')
+
+    def test_image_to_pattern_wrong_palette(self):
+        response = self.client.post(reverse('image_to_pattern'), data={'img': self.test_img, 'height': 30, 'width': 10, 'palette': '[[0, 0'})
+        self.assertEqual(json.loads(response.content)['error'], 'Palette is not valid JSON.')
+
+        for palette in [[[0, 0]], [[0, 0, 256]], [[0, 0, 0], [0, 0, 0, 0]], [['a', 0, 0]], {'a': 1}]:
+            self.test_img.seek(0)
+            response = self.client.post(reverse('image_to_pattern'), data={'img': self.test_img, 'height': 30, 'width': 10, 'palette': json.dumps(palette)})
+            self.assertEqual(response.status_code, 400)
+
+    def test_image_to_pattern_negative_size(self):
+        palette = json.dumps(self.sample_palette)
+        response = self.client.post(reverse('image_to_pattern'), data={'img': self.test_img, 'height': -30, 'width': 10, 'palette': palette})
+        self.assertEqual(json.loads(response.content)['error'], 'Height and width cannot be negative.')
+
+    def test_image_to_pattern_correct_input(self):
+        palette = json.dumps(self.sample_palette)
+        response = self.client.post(reverse('image_to_pattern'), data={'img': self.test_img, 'height': 30, 'width': 10, 'palette': palette})
+        result = json.loads(response.content)
+
+        self.assertEqual(result['palette'], self.sample_palette)
+        self.assertEqual(len(result['pattern']), 30)
+        self.assertEqual(len(result['pattern'][0]), 10)
+
+        # Same result as /sample followed by /image_to_pixels, with a smaller response
+        self.test_img.seek(0)
+        sample = self.client.post(reverse('resize_image'), data={'img': self.test_img, 'height': 30, 'width': 10})
+        body = {'image': json.loads(sample.content)['sample_image'], 'palette': self.sample_palette}
+        pixels = self.client.post(reverse('image_to_pixels'), json.dumps(body), content_type="application/json")
+
+        pattern_image = [[result['palette'][index] for index in row] for row in result['pattern']]
+        self.assertEqual(pattern_image, json.loads(pixels.content)['pixels_image'])
+        self.assertLess(len(response.content) * 4, len(sample.content) + len(pixels.content))
+
     # Tests image_to_pixels
 
     def test_image_to_pixels_non_post_request(self):
@@ -277,4 +772,16 @@ class APITestCase(TestCase):
         }
         response = self.client.post(reverse('image_to_pixels'), json.dumps(body), content_type="application/json")
         self.assertEqual(len(json.loads(response.content)['pixels_image']), 2)
-        self.assertEqual(len(json.loads(response.content)['pixels_image'][0]), 3)
\ No newline at end of file
+        self.assertEqual(len(json.loads(response.content)['pixels_image'][0]), 3)
+
+    def test_image_to_pixels_wrong_palette(self):
+        response = self.client.post(reverse('image_to_pixels'), json.dumps({'image': self.sample_image}), content_type="application/json")
+        self.assertEqual(json.loads(response.content)['error'], 'Palette cannot be empty.')
+
+    def test_image_to_pixels_binary_grid(self):
+        body = encode_grid(self.sample_image, {'palette': self.sample_palette})
+        response = self.client.post(reverse('image_to_pixels'), body, content_type=GRID_CONTENT_TYPE, HTTP_ACCEPT=GRID_CONTENT_TYPE)
+        palette, indices, _ = decode_indexed(response.content)
+
+        json_response = self.client.post(reverse('image_to_pixels'), json.dumps({'image': self.sample_image, 'palette': self.sample_palette}), content_type="application/json")
+        self.assertEqual(palette[indices].tolist(), json.loads(json_response.content)['pixels_image'])
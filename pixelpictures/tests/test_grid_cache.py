@@ -0,0 +1,139 @@
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import os
+import io
+import json
+from django.conf import settings
+from django.core.management import call_command
+import tempfile
+from unittest.mock import patch
+
+from pixelpictures.models import User, Picture
+from pixelpictures.render import run_render_jobs, enqueue_render
+from pixelpictures.storage import remove_files
+from pixelpictures.views import open_picture_image
+from pixelpictures.grid_cache import cache_stream, open_cached, cache_path, cache_stats, evict, update_stats, cached_files, invalidate, flush_stats, STATS_FILE
+
+class GridCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_override = override_settings(GRID_CACHE_DIR=directory.name, GRID_CACHE_MAX_SIZE=100)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        # Hits and misses counted in memory are written to the cache of the test
+        flush_stats()
+        self.addCleanup(flush_stats)
+        self.user = User.objects.create_user(username='creator', email='creator@example.com', password='pssSre!1')
+
+    def test_download_cached(self):
+        picture = Picture.objects.create(image=[[[10, 20, 30], [40, 50, 60]]], user=self.user, public=True, timestamp=timezone.now())
+        enqueue_render(picture)
+        run_render_jobs()
+        query = {'key': picture.pk, 'size_cell': 10}
+
+        with override_settings(GRID_CACHE_MAX_SIZE=10 ** 6):
+            first = b''.join(self.client.get(reverse('download'), query).streaming_content)
+            # Grid is read from the cache, the picture is not drawn again
+            with patch('pixelpictures.views.open_picture_image', wraps=open_picture_image) as draw:
+                second = b''.join(self.client.get(reverse('download'), query).streaming_content)
+            draw.assert_not_called()
+        self.assertEqual(first, second)
+
+        stats = cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate'], stats['files']), (1, 1, 0.5, 1))
+        self.assertEqual(stats['size'], len(first))
+
+        # Grids are removed with the last picture using the pixels
+        with self.captureOnCommitCallbacks(execute=True):
+            picture.delete()
+        self.assertEqual(cache_stats()['files'], 0)
+        remove_files(picture.stored_image.content_hash)
+
+    def test_evict_least_recently_used(self):
+        for key in ['a', 'b', 'c']:
+            list(cache_stream([b'x' * 40], 'hash', key, 'png'))
+        # Oldest files are removed first, above 100 bytes
+        self.assertEqual(sorted(os.listdir(os.path.dirname(cache_path('hash', 'a', 'png')))), ['b.png', 'c.png'])
+
+        # Used files are kept
+        os.utime(cache_path('hash', 'b', 'png'), (1, 1))
+        os.utime(cache_path('hash', 'c', 'png'), (2, 2))
+        open_cached('hash', 'b', 'png').close()
+        list(cache_stream([b'x' * 40], 'hash', 'd', 'png'))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(cache_path('hash', 'a', 'png')))), ['b.png', 'd.png'])
+
+        evict(0)
+        self.assertEqual(cache_stats()['files'], 0)
+
+    def test_evict_only_above_max_size(self):
+        # The cache is scanned only when the counted size is above the maximum
+        with patch('pixelpictures.grid_cache.cached_files', wraps=cached_files) as scan:
+            list(cache_stream([b'x' * 40], 'hash', 'a', 'png'))
+            self.assertEqual(update_stats()['size'], 40)
+            list(cache_stream([b'x' * 40], 'hash', 'b', 'png'))
+            # Only when the stats file is made
+            self.assertEqual(scan.call_count, 1)
+            list(cache_stream([b'x' * 40], 'hash', 'c', 'png'))
+            self.assertEqual(scan.call_count, 2)
+        self.assertEqual(update_stats()['size'], 80)
+
+        # Removed grids are not counted anymore
+        invalidate('hash')
+        self.assertEqual(update_stats()['size'], 0)
+
+    def test_stats_shared(self):
+        # Counters are in the cache directory, every process reads the same ones
+        open_cached('hash', 'a', 'png')
+        list(cache_stream([b'x' * 40], 'hash', 'a', 'png'))
+        open_cached('hash', 'a', 'png').close()
+        with open(os.path.join(settings.GRID_CACHE_DIR, STATS_FILE)) as file:
+            self.assertEqual(json.load(file), {'hits': 0, 'misses': 0, 'size': 40})
+        # Hits and misses are written together
+        flush_stats()
+        with open(os.path.join(settings.GRID_CACHE_DIR, STATS_FILE)) as file:
+            self.assertEqual(json.load(file), {'hits': 1, 'misses': 1, 'size': 40})
+
+        call_command('grid_cache', stdout=io.StringIO())
+        output = io.StringIO()
+        call_command('grid_cache', stdout=output)
+        self.assertIn('Hits: 1, misses: 1, hit rate: 50.0%', output.getvalue())
+
+        # A damaged file is made again, with the size of the cached grids
+        with open(os.path.join(settings.GRID_CACHE_DIR, STATS_FILE), 'w') as file:
+            file.write('{"hits"')
+        self.assertEqual(update_stats(), {'hits': 0, 'misses': 0, 'size': 40})
+
+    def test_stats_batched(self):
+        # The stats file is locked once for many hits and misses
+        with patch('pixelpictures.grid_cache.update_stats', wraps=update_stats) as update:
+            for _ in range(99):
+                open_cached('hash', 'a', 'png')
+            update.assert_not_called()
+            open_cached('hash', 'a', 'png')
+            update.assert_called_once_with(misses=100)
+
+    @override_settings(GRID_CACHE_MAX_FILE_SIZE=10)
+    def test_too_big_not_cached(self):
+        # Grids too big are sent but not cached, writing stops at the maximum size
+        stream = cache_stream(iter([b'first', b'second', b'third']), 'hash', 'a', 'png')
+        directory = os.path.dirname(cache_path('hash', 'a', 'png'))
+        self.assertEqual(next(stream), b'first')
+        self.assertEqual(len(os.listdir(directory)), 1)
+        self.assertEqual(next(stream), b'second')
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(list(stream), [b'third'])
+        self.assertIsNone(open_cached('hash', 'a', 'png'))
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(update_stats()['size'], 0)
+
+    def test_interrupted_stream(self):
+        # Grids are cached only if they are completely written
+        stream = cache_stream(iter([b'first', b'second']), 'hash', 'a', 'png')
+        next(stream)
+        stream.close()
+        self.assertIsNone(open_cached('hash', 'a', 'png'))
+        self.assertEqual(os.listdir(os.path.dirname(cache_path('hash', 'a', 'png'))), [])
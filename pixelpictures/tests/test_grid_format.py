@@ -0,0 +1,86 @@
+import unittest
+import json
+import numpy as np
+
+from pixelpictures.grid_format import encode_grid, decode_grid, encode_indexed, decode_indexed, run_lengths, MAX_RUN, MAX_SIDE, HEADER, MAGIC, FLAG_RLE, compress_grid, decompress_grid
+
+# Unit testing grid_format functions
+class GridFormatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.noise = rng.integers(0, 256, (20, 30, 4)).astype(np.uint8)
+        self.flat = np.zeros((200, 300, 3), dtype=np.uint8)
+        self.flat[50:] = [255, 0, 0]
+
+    def test_run_lengths(self):
+        lengths, values = run_lengths(np.array([1, 1, 1, 2, 2, 1]))
+        self.assertEqual(lengths.tolist(), [3, 2, 1])
+        self.assertEqual(values.tolist(), [1, 2, 1])
+
+        # Long runs are split
+        lengths, values = run_lengths(np.zeros(2 * MAX_RUN + 10, dtype=np.uint8))
+        self.assertEqual(lengths.tolist(), [MAX_RUN, MAX_RUN, 10])
+        self.assertEqual(values.tolist(), [0, 0, 0])
+
+    def test_encode_decode_grid(self):
+        for image in [self.noise, self.flat]:
+            for rle in [None, True, False]:
+                decoded, metadata = decode_grid(encode_grid(image, rle=rle))
+                np.testing.assert_array_equal(decoded, image)
+                self.assertIsNone(metadata)
+
+    def test_encode_choose_smaller(self):
+        self.assertEqual(len(encode_grid(self.flat)), len(encode_grid(self.flat, rle=True)))
+        self.assertEqual(len(encode_grid(self.noise)), len(encode_grid(self.noise, rle=False)))
+        self.assertLess(len(encode_grid(self.flat)), 100)
+
+    def test_encode_indexed_metadata(self):
+        palette = [[0, 0, 0], [255, 255, 255], [1, 2, 3]]
+        indices = [[0, 1, 2], [2, 1, 0]]
+        decoded_palette, decoded_indices, metadata = decode_indexed(encode_indexed(palette, indices, {'tags': ['tag1']}))
+
+        self.assertEqual(decoded_palette.tolist(), palette)
+        self.assertEqual(decoded_indices.tolist(), indices)
+        self.assertEqual(metadata, {'tags': ['tag1']})
+
+    def test_many_colors(self):
+        # More than 256 colors need 2 bytes indices
+        image = np.random.default_rng(0).integers(0, 256, (40, 40, 3)).astype(np.uint8)
+        decoded, _ = decode_grid(encode_grid(image))
+        np.testing.assert_array_equal(decoded, image)
+
+    def test_decode_errors(self):
+        data = encode_indexed([[0, 0, 0]], [[0, 0]])
+        with self.assertRaises(ValueError):
+            decode_grid(b'not a grid')
+        with self.assertRaises(ValueError):
+            decode_grid(data[:-1])
+        with self.assertRaises(ValueError):
+            # Index out of palette
+            decode_grid(data[:-1] + b'\x01')
+
+    def test_size_limits(self):
+        # Run-length encoded grids claiming too many pixels are rejected before they are expanded
+        runs = (8096 * 8096 + MAX_RUN - 1) // MAX_RUN
+        lengths = np.full(runs, MAX_RUN, dtype='<u2')
+        lengths[-1] = 8096 * 8096 - MAX_RUN * (runs - 1)
+        bomb = HEADER.pack(MAGIC, FLAG_RLE, 3, 8096, 8096, 1, 1, runs, 0) + bytes(3) + lengths.tobytes() + bytes(runs)
+        with self.assertRaisesRegex(ValueError, 'more than 1000000 pixels'):
+            decode_grid(bomb, max_pixels=10 ** 6)
+        self.assertEqual(decode_grid(encode_grid(self.flat), max_pixels=200 * 300)[0].shape, (200, 300, 3))
+
+        with self.assertRaisesRegex(ValueError, 'more than 100 pixels'):
+            encode_grid(self.noise, max_pixels=100)
+        with self.assertRaisesRegex(ValueError, 'greater than'):
+            encode_indexed([[0, 0, 0]], np.zeros((1, MAX_SIDE + 1), dtype=np.uint8), max_pixels=10 ** 6)
+
+    def test_compress_grid(self):
+        for image in [self.noise, self.flat]:
+            np.testing.assert_array_equal(decompress_grid(compress_grid(image)), image)
+
+        # Stored pictures are much smaller than their JSON
+        image = np.zeros((64, 64, 3), dtype=np.uint8)
+        image[::2, ::3] = [12, 200, 34]
+        image[10:30, 5:50] = [255, 255, 255]
+        self.assertLess(10 * len(compress_grid(image)), len(json.dumps(image.tolist())))
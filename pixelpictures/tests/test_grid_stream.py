@@ -0,0 +1,69 @@
+import unittest
+import io
+import numpy as np
+from PIL import Image
+
+from pixelpictures.image_to_pixels import add_grid, grid_layout, grid_size, render_grid
+from pixelpictures.grid_stream import png_stream, plain_png_stream, pdf_stream, grid_tiles, PNG_MAX_SIDE
+
+# Unit testing grid_stream functions
+class GridStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cells = (np.random.default_rng(0).integers(0, 4, (37, 23, 3)) * 60).astype(np.uint8)
+        self.image = Image.fromarray(cells)
+        self.layout = grid_layout(self.image, start_row=5, dir_rows='bt', size_cell=13, step=2)
+
+    def test_render_grid_bands(self):
+        # Bands put together are the whole grid
+        expected = np.array(add_grid(self.image, start_row=5, dir_rows='bt', size_cell=13, step=2))
+        height = grid_size(self.layout)[1]
+        for band_height in [1, 17, 100]:
+            bands = [np.array(render_grid(self.layout, top, top + band_height)) for top in range(0, height, band_height)]
+            np.testing.assert_array_equal(np.vstack(bands), expected)
+
+    def test_png_stream(self):
+        expected = np.array(render_grid(self.layout))
+        for band_pixels in [1, 5000, 10 ** 7]:
+            png = Image.open(io.BytesIO(b''.join(png_stream(self.layout, band_pixels))))
+            np.testing.assert_array_equal(np.array(png), expected)
+
+    def test_plain_png_stream(self):
+        expected = np.array(self.image).repeat(13, axis=0).repeat(13, axis=1)
+        for band_pixels in [1, 5000, 10 ** 7]:
+            png = Image.open(io.BytesIO(b''.join(plain_png_stream(self.layout, band_pixels))))
+            np.testing.assert_array_equal(np.array(png), expected)
+
+    def test_png_stream_size(self):
+        # Sizes not valid for PNGs are rejected before anything is drawn
+        for size_cell in [0, PNG_MAX_SIDE // 23 + 1]:
+            with self.assertRaises(ValueError):
+                plain_png_stream(self.layout._replace(size_cell=size_cell))
+        with self.assertRaises(ValueError):
+            png_stream(self.layout._replace(size_cell=PNG_MAX_SIDE // 23))
+
+    def test_grid_tiles(self):
+        tiles = grid_tiles(self.layout, tile_rows=20, tile_cols=10)
+        self.assertEqual(len(tiles), 2 * 3)
+        self.assertEqual(tiles[4].cells.shape[:2], (17, 10))
+        np.testing.assert_array_equal(tiles[4].cells, self.layout.cells[20:, 10:20])
+
+        # Numbers go on from a page to the next ones
+        self.assertEqual(tiles[0].row_numbers[:3], [None, 40, None])
+        self.assertEqual(tiles[3].row_numbers[:3], [None, 20, None])
+        self.assertEqual(tiles[1].col_numbers[:3], [None, 12, None])
+
+    def test_pdf_stream(self):
+        pdf = b''.join(pdf_stream(self.layout, tile_rows=20, tile_cols=10))
+        self.assertTrue(pdf.startswith(b'%PDF-1.4'))
+        self.assertEqual(pdf.count(b'/Type /Page '), 6)
+
+        # Offsets of the cross-reference table point to the objects
+        xref_offset = int(pdf.rsplit(b'startxref\n', 1)[1].split()[0])
+        lines = pdf[xref_offset:].split(b'\n')
+        self.assertEqual(lines[0], b'xref')
+        count = int(lines[1].split()[1])
+        self.assertEqual(count, 2 + 3 * 6 + 1)
+        for number in range(1, count):
+            offset = int(lines[2 + number][:10])
+            self.assertTrue(pdf[offset:].startswith(f'{number} 0 obj'.encode()))
@@ -1,8 +1,12 @@
 import unittest
-from PIL import Image
+import os
+from PIL import Image, ImageDraw
 import numpy as np 
+from unittest.mock import patch
 
-from pixelpictures.image_to_pixels import distance_colors, get_color, resize, to_pixels
+from pixelpictures.image_to_pixels import distance_colors, get_color, resize, to_pixels, quantize, to_pixels_reference, nearest_colors, lut_nearest_colors, get_lut, lut_cache_info, \
+    unique_nearest_colors, estimate_unique_ratio, pack_colors, indexed_nearest_colors, build_palette_index, refine_candidates, \
+    median_cut, extract_palette, block_sums, area_resize, add_grid, grid_layout, grid_font, draw_number, GRID_FONT, GRID_FONT_SIZE
 
 # Unit testing image_to_pixels functions
 class ImageToPixelsTestCase(unittest.TestCase):
@@ -32,6 +36,17 @@ class ImageToPixelsTestCase(unittest.TestCase):
         self.assertEqual(resized.width, 15)
         self.assertEqual(resized.height, 10)
 
+    def test_resize_draft(self):
+        # JPEG image decoded at reduced scale
+        resized = resize(50, 40, self.image)
+        self.assertLess(self.image.width, 991)
+        self.assertEqual(resized.size, (50, 40))
+
+        # Other formats are converted after resizing, same result as converting before
+        image = self.image.convert("P", palette=Image.ADAPTIVE)
+        expected = resize(45, 40, image.convert("RGBA"))
+        np.testing.assert_array_equal(np.array(resize(45, 40, image)), np.array(expected))
+
     def test_to_pixels(self):
         resized = resize(20, 30, self.image)
         resized_arr = np.array(resized)
@@ -47,4 +62,214 @@ class ImageToPixelsTestCase(unittest.TestCase):
         
         # Check sizes:
         self.assertEqual(len(pixel_image), 30)
-        self.assertEqual(len(pixel_image[0]), 20)
\ No newline at end of file
+        self.assertEqual(len(pixel_image[0]), 20)
+
+    def test_to_pixels_same_as_reference(self):
+        # Lists of python ints, as received by the image_to_pixels view
+        resized = np.array(resize(20, 30, self.image)).tolist()
+        rng = np.random.default_rng(0)
+        colors = [tuple(color) for color in rng.integers(0, 256, (16, 3)).tolist()]
+
+        self.assertEqual(to_pixels(resized, colors), to_pixels_reference(resized, colors))
+
+    def test_to_pixels_ties(self):
+        # Equal colors in palette: first one is chosen, as in get_color
+        image = [[[10,10,10], [200,200,200]]]
+        colors = [[0,0,0], [255,255,255], [0,0,0]]
+        pixel_image = to_pixels(image, colors)
+
+        self.assertEqual(pixel_image, to_pixels_reference(image, colors))
+        self.assertIs(pixel_image[0][0], colors[0])
+
+    def test_nearest_colors_chunks(self):
+        resized = np.array(resize(20, 30, self.image))
+        colors = [(0,0,0), (255,255,255), (155,155,155), (200,30,30)]
+
+        # Chunks smaller than a row still have to process one row at a time
+        for chunk_size in [1, 100, 1000, 2 ** 20]:
+            np.testing.assert_array_equal(nearest_colors(resized, colors, chunk_size), nearest_colors(resized, colors))
+
+
+    def test_lut_nearest_colors(self):
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 256, (100, 100, 3))
+        palettes = [
+            [(0,0,0)],
+            [(0,0,0), (255,255,255), (0,0,0)],
+            rng.integers(0, 256, (32, 3)).tolist(),
+            # Close colors, many cells near decision boundaries
+            rng.integers(100, 110, (20, 3)).tolist()
+        ]
+        for colors in palettes:
+            np.testing.assert_array_equal(lut_nearest_colors(image, colors), nearest_colors(image, colors))
+            np.testing.assert_array_equal(lut_nearest_colors(image, colors, levels=64), nearest_colors(image, colors))
+
+    def test_lut_cache(self):
+        colors = [(1,2,3), (200,100,50), (30,30,200)]
+        misses = lut_cache_info().misses
+        get_lut(colors)
+        hits = lut_cache_info().hits
+        get_lut([list(color) for color in colors])
+
+        self.assertEqual(lut_cache_info().misses, misses + 1)
+        self.assertEqual(lut_cache_info().hits, hits + 1)
+
+
+    def test_unique_nearest_colors(self):
+        resized = np.array(resize(20, 30, self.image))
+        colors = [(0,0,0), (255,255,255), (155,155,155), (200,30,30)]
+
+        np.testing.assert_array_equal(unique_nearest_colors(resized, colors), nearest_colors(resized, colors))
+        np.testing.assert_array_equal(unique_nearest_colors(resized, colors, nearest_colors), nearest_colors(resized, colors))
+
+    def test_estimate_unique_ratio(self):
+        rng = np.random.default_rng(0)
+        # Small images: exact ratio
+        self.assertEqual(estimate_unique_ratio(pack_colors(np.array([[[0,0,0], [0,0,0], [1,2,3], [0,0,0]]]))), 0.5)
+
+        # Flat-color art: few colors in a big image
+        flat = rng.integers(0, 256, (5, 3))[rng.integers(0, 5, (300, 300))]
+        self.assertLess(estimate_unique_ratio(pack_colors(flat)), 0.001)
+
+        # Noise: almost every pixel has a different color
+        noise = rng.integers(0, 256, (300, 300, 3))
+        self.assertGreater(estimate_unique_ratio(pack_colors(noise)), 0.5)
+
+
+    def test_indexed_nearest_colors(self):
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 256, (100, 100, 3))
+        # Large palette, like bead catalogs
+        colors = rng.integers(0, 256, (300, 3)).tolist()
+
+        np.testing.assert_array_equal(indexed_nearest_colors(image, colors), nearest_colors(image, colors))
+        np.testing.assert_array_equal(lut_nearest_colors(image, colors), nearest_colors(image, colors))
+        self.assertEqual(to_pixels(image[:20, :20].tolist(), colors), to_pixels_reference(image[:20, :20].tolist(), colors))
+
+    def test_index_min_palette(self):
+        # Threshold of the palette index changes only the method, not the result
+        rng = np.random.default_rng(1)
+        few_colors = rng.integers(0, 4, (50, 50, 3)) * 80
+        noise = rng.integers(0, 256, (50, 50, 3))
+        colors = rng.integers(0, 256, (40, 3)).tolist()
+        for image in [few_colors, noise]:
+            for index_min_palette in [1, 40, 1000]:
+                np.testing.assert_array_equal(quantize(image, colors, index_min_palette), nearest_colors(image, colors))
+
+        with patch('pixelpictures.image_to_pixels.indexed_nearest_colors', wraps=indexed_nearest_colors) as indexed:
+            quantize(few_colors, colors, index_min_palette=41)
+            indexed.assert_not_called()
+            quantize(few_colors, colors, index_min_palette=40)
+            indexed.assert_called_once()
+
+    def test_palette_index(self):
+        rng = np.random.default_rng(0)
+        palette = rng.integers(0, 256, (100, 3))
+        index = build_palette_index(palette)
+
+        # Every cell has less candidates than the palette, sorted and padded with -1
+        self.assertLess(index.shape[-1], len(palette))
+        for candidates in index.reshape(-1, index.shape[-1]):
+            kept = candidates[candidates >= 0]
+            self.assertTrue((candidates[len(kept):] == -1).all())
+            self.assertTrue((np.diff(kept) > 0).all())
+
+        # Candidates refined from the index are the same as the ones refined from the whole palette
+        all_colors = np.arange(len(palette)).reshape(1, 1, 1, -1)
+        np.testing.assert_array_equal(refine_candidates(palette, index, 32), refine_candidates(palette, all_colors, 32))
+
+
+    def test_median_cut(self):
+        rng = np.random.default_rng(0)
+        # Two groups of colors of the same size: two colors in the palette, one for each group
+        pixels = np.concatenate([rng.integers(0, 10, (100, 3)), rng.integers(240, 250, (100, 3))])
+        palette = median_cut(pixels, 2)
+        self.assertEqual(sorted(palette.tolist(), key=sum)[0], pixels[:100].mean(axis=0).round().astype(int).tolist())
+
+        # Less colors than requested
+        self.assertEqual(median_cut(np.array([[1,2,3], [1,2,3], [4,5,6]]), 10).tolist(), [[1,2,3], [4,5,6]])
+
+    def test_extract_palette(self):
+        palette = extract_palette(self.image, 12)
+        self.assertEqual(len(palette), 12)
+
+        # Transparent pixels are ignored
+        transparent = Image.new("RGBA", (10, 10), (0, 0, 0, 0))
+        transparent.putpixel((1, 1), (10, 20, 30, 255))
+        self.assertEqual(extract_palette(transparent, 4), [[10, 20, 30]])
+
+
+    def test_block_sums(self):
+        arr = np.arange(6 * 8 * 3).reshape(6, 8, 3)
+
+        # Integer ratio
+        sums, counts = block_sums(arr, 3, 4)
+        np.testing.assert_array_equal(sums, arr.reshape(3, 2, 4, 2, 3).sum(axis=(1, 3)))
+        self.assertTrue((counts == 4).all())
+
+        # Non integer ratio: every pixel is in exactly one block
+        sums, counts = block_sums(arr, 4, 3)
+        self.assertEqual(sums.shape, (4, 3, 3))
+        np.testing.assert_array_equal(sums.sum(axis=(0, 1)), arr.sum(axis=(0, 1)))
+        self.assertEqual(counts.sum(), 6 * 8)
+
+    def test_resize_area(self):
+        resized = resize(20, 30, self.image, 'area')
+        self.assertEqual(resized.size, (20, 30))
+
+        # Transparent pixels do not change the color of a block
+        image = Image.new("RGBA", (4, 4), (0, 0, 0, 0))
+        image.paste((200, 100, 50, 255), (0, 0, 2, 2))
+        np.testing.assert_array_equal(np.array(area_resize(image, (2, 2)))[0, 0], [200, 100, 50, 255])
+        np.testing.assert_array_equal(np.array(area_resize(image, (1, 1)))[0, 0], [200, 100, 50, 64])
+
+    def test_add_grid_scale(self):
+        cells = np.random.default_rng(0).integers(0, 256, (6, 5, 3)).astype(np.uint8)
+        small = Image.fromarray(cells)
+        big = small.resize((5 * 18, 6 * 18), Image.NEAREST)
+
+        # Same grid from 1x and 18x sources
+        expected = np.array(add_grid(big, size_cell=20, scale=18))
+        np.testing.assert_array_equal(np.array(add_grid(small, size_cell=20)), expected)
+        self.assertEqual(expected.shape, (6 * 20 + 80, 5 * 20 + 80, 3))
+
+        # Palette mode source
+        palette_image = Image.fromarray(np.arange(30, dtype=np.uint8).reshape(6, 5), 'P')
+        palette_image.putpalette(cells.tobytes())
+        np.testing.assert_array_equal(np.array(add_grid(palette_image, size_cell=20)), expected)
+
+        # Font is loaded once
+        loaded = grid_font.cache_info().misses
+        add_grid(small, size_cell=20)
+        self.assertEqual(grid_font.cache_info().misses, loaded)
+
+    def test_add_grid_lines(self):
+        cells = np.array([[[10, 20, 30], [40, 50, 60], [70, 80, 90]], [[1, 2, 3], [4, 5, 6], [7, 8, 9]]], dtype=np.uint8)
+        grid = np.array(add_grid(Image.fromarray(cells), grid_color=(255, 0, 0), size_cell=5))
+        inner = grid[40:51, 40:56]
+
+        # Lines every 5 pixels, around the grid too, and cells upscaled between them
+        np.testing.assert_array_equal(inner[::5, :], np.broadcast_to([255, 0, 0], (3, 16, 3)))
+        np.testing.assert_array_equal(inner[:, ::5], np.broadcast_to([255, 0, 0], (11, 4, 3)))
+        np.testing.assert_array_equal(inner[1:5, 1:5], np.broadcast_to(cells[0, 0], (4, 4, 3)))
+        np.testing.assert_array_equal(inner[6:10, 11:15], np.broadcast_to(cells[1, 2], (4, 4, 3)))
+        self.assertTrue((grid[:39, :39] == 255).all())
+
+    def test_grid_numbers(self):
+        image = Image.new("RGB", (4, 3))
+        layout = grid_layout(image, start_row=5, start_col=3, dir_rows='bt', dir_cols='rl', step=2)
+        self.assertEqual(layout.row_numbers, [None, 6, None])
+        # Columns counted from right start from start_col
+        self.assertEqual(layout.col_numbers, [6, None, 4, None])
+        self.assertEqual(grid_layout(image, start_col=3).col_numbers, [3, 4, 5, 6])
+
+    @unittest.skipUnless(os.path.isfile(GRID_FONT), "Font of grids not installed.")
+    def test_draw_number(self):
+        # Numbers composed from the glyph atlas are the same as text drawn by pillow
+        for number in [7, 25, 130, -4]:
+            for anchor in ['rm', 'lm', 'ms', 'mt']:
+                expected = Image.new("RGB", (60, 60), (255, 255, 255))
+                ImageDraw.Draw(expected).text((30, 30), str(number), fill=(200, 10, 0), font=grid_font(GRID_FONT_SIZE), anchor=anchor)
+                image = Image.new("RGB", (60, 60), (255, 255, 255))
+                draw_number(image, number, (30, 30), anchor, (200, 10, 0))
+                np.testing.assert_array_equal(np.array(image), np.array(expected))
@@ -0,0 +1,122 @@
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import io
+import os
+import json
+import tempfile
+from PIL import Image
+
+from pixelpictures.models import User, Picture
+from pixelpictures.render import run_render_jobs, enqueue_render
+from pixelpictures.storage import picture_name, picture_storage, save_file, open_file, file_exists, S3Storage
+
+class NoSuchKey(Exception):
+    pass
+
+class LocalS3Client:
+    # Stand-in of a boto3 S3 client keeping objects in memory, with the methods used by S3Storage
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+        self.reads = 0
+
+    def put_object(self, Bucket, Key, Body, **params):
+        self.objects[(Bucket, Key)] = (Body.read(), params)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        client = self
+        class Body(io.RawIOBase):
+            # Counts reads, to check objects are streamed
+            def __init__(self, data):
+                self.stream = io.BytesIO(data)
+            def readable(self):
+                return True
+            def readinto(self, buffer):
+                client.reads += 1
+                return self.stream.readinto(buffer)
+        return {'Body': io.BufferedReader(Body(self.objects[(Bucket, Key)][0]), buffer_size=1024)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[(Bucket, Key)][0])}
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key} for key in keys[:MaxKeys]]} if keys else {}
+
+class StorageTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='creator', email='creator@example.com', password='pssSre!1')
+        self.s3 = LocalS3Client()
+        self.bucket_settings = override_settings(PICTURES_STORAGE={
+            'BACKEND': 'pixelpictures.storage.S3Storage',
+            'OPTIONS': {'bucket': 'pictures', 'client': self.s3, 'base_url': 'https://cdn.example.com/pictures/'},
+        })
+
+    def test_local_storage(self):
+        with tempfile.TemporaryDirectory() as location:
+            with override_settings(PICTURES_STORAGE={
+                'BACKEND': 'pixelpictures.storage.PictureFileSystemStorage',
+                'OPTIONS': {'location': location, 'base_url': '/pictures/'},
+            }):
+                # Same name is overwritten, no temporary files are left
+                save_file('a.png', b'first')
+                save_file('a.png', b'second')
+                self.assertEqual(os.listdir(location), ['a.png'])
+                with open_file('a.png') as file:
+                    self.assertEqual(file.read(), b'second')
+                self.assertEqual(picture_storage().url('a.png'), '/pictures/a.png')
+                with self.assertRaises(FileNotFoundError):
+                    open_file('b.png')
+
+    def test_bucket_storage(self):
+        with self.bucket_settings:
+            self.assertIsInstance(picture_storage(), S3Storage)
+            save_file('a.png', b'x' * 10000)
+            self.assertTrue(file_exists('a.png'))
+            self.assertFalse(file_exists('a'))
+            # Names are immutable, objects are cached forever
+            self.assertEqual(self.s3.objects[('pictures', 'a.png')][1]['CacheControl'], 'public, max-age=31536000, immutable')
+            self.assertEqual(self.s3.objects[('pictures', 'a.png')][1]['ContentType'], 'image/png')
+
+            # Read as a stream, in pieces
+            with open_file('a.png') as file:
+                chunks = list(file.chunks(chunk_size=1000))
+            self.assertEqual(b''.join(chunks), b'x' * 10000)
+            self.assertGreater(self.s3.reads, 1)
+            with self.assertRaises(FileNotFoundError):
+                open_file('b.png')
+
+    def test_bucket_pictures(self):
+        # Pictures are rendered to the bucket, pages link to it and files are removed with the pictures
+        with self.bucket_settings:
+            picture = Picture.objects.create(image=[[[10, 20, 30], [40, 50, 60]]], user=self.user, public=True,
+                                             timestamp=timezone.now())
+            self.client.login(username='creator', password='pssSre!1')
+            response = self.client.post(reverse('download'), json.dumps({
+                'key': picture.pk, 'start_row': 1, 'start_col': 1, 'dir_rows': 'tb', 'dir_cols': 'lr',
+                'grid_color': [0, 0, 0], 'size_cell': 10, 'step': 1,
+            }), content_type="application/json")
+            self.assertEqual(json.loads(response.content)['error'], 'Picture is not rendered yet.')
+
+            enqueue_render(picture)
+            run_render_jobs()
+            name = picture_name(picture.stored_image.content_hash)
+            self.assertEqual(Image.open(open_file(name)).size, (2, 1))
+
+            response = self.client.get(reverse('view_picture', args=[picture.pk]))
+            self.assertContains(response, f'https://cdn.example.com/pictures/{name}')
+
+            with self.captureOnCommitCallbacks(execute=True):
+                picture.delete()
+            self.assertEqual(self.s3.objects, {})
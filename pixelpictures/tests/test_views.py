@@ -1,12 +1,19 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.utils import timezone
+from django.db import connection
+from django.core.cache import cache
+import numpy as np
+from unittest.mock import patch
 
 from pixelpictures.models import User, Picture, Tag
+from pixelpictures.view_counter import count_view, flush_views, pending_views, _flush_on_timer
 
 class ViewsTestCase(TestCase):
 
     def setUp(self):
+        # Counts of pictures are cached
+        cache.clear()
         self.client = Client()
         self.creator = User.objects.create_user(username='creator', email='creator@example.com', password='pssSre!1')
         self.creator.save()
@@ -50,7 +57,11 @@ class ViewsTestCase(TestCase):
             pk=3
         )
         self.public_picture_with_tag.save()
-        Tag.objects.create(picture=self.public_picture_with_tag, tag='someTag')
+        self.public_picture_with_tag.tags.create(tag='sometag')
+
+    def tearDown(self):
+        # Views buffered by a test are written in its own transaction
+        flush_views()
 
     # Tests index
 
@@ -70,6 +81,16 @@ class ViewsTestCase(TestCase):
         self.assertEqual(response.context['search_value'], 'someTag')
         self.assertEqual(response.context['sort_value'], 'new')
 
+    def test_index_search_tags(self):
+        self.public_picture.tags.create(tag='bluesky')
+        self.public_picture.tags.create(tag='cat')
+        self.public_picture_with_tag.tags.add(Tag.objects.get(tag='cat'))
+
+        # Words are searched as prefixes of tags, ignoring case, all words must match
+        for search, pks in [('blue', [1]), ('CAT', [3, 1]), ('cat blue', [1]), ('some cat', [3]), ('sky', []), ('  ', [3, 1])]:
+            response = self.client.get(reverse('index'), {'search': search})
+            self.assertEqual([picture.pk for picture in response.context['pictures'].object_list], pks)
+
     def test_index_sort(self):
         self.client.get(reverse('view_picture', args=['1']))
         response = self.client.get(reverse('index') + '/?sort=views')
@@ -79,6 +100,75 @@ class ViewsTestCase(TestCase):
         self.assertEqual(response.context['search_value'], '')
         self.assertEqual(response.context['sort_value'], 'views')
 
+    def test_index_pagination(self):
+        for i in range(45):
+            Picture.objects.create(image=[[[i, i, i]]], user=self.creator, public=True, timestamp=timezone.now(), views=i % 4)
+
+        for sort, ordering in [('new', ('-timestamp', '-id')), ('views', ('-views', '-id'))]:
+            expected = list(Picture.objects.filter(public=True).order_by(*ordering))
+
+            # Forward until the last page
+            pages = []
+            url = reverse('index') + f'/?sort={sort}'
+            while url:
+                response = self.client.get(url)
+                page = response.context['pictures']
+                pages.append(page)
+                url = reverse('index') + f'/?sort={sort}&after={page.next_cursor}' if page.has_next else None
+            self.assertEqual([len(page.object_list) for page in pages], [20, 20, 7])
+            self.assertEqual([picture for page in pages for picture in page.object_list], expected)
+            self.assertFalse(pages[0].has_previous)
+
+            # Back from the last page
+            response = self.client.get(reverse('index') + f'/?sort={sort}&before={pages[-1].previous_cursor}')
+            self.assertEqual(response.context['pictures'].object_list, pages[1].object_list)
+            self.assertTrue(response.context['pictures'].has_previous)
+            self.assertEqual(response.context['count'], 47)
+
+    def test_index_not_valid_cursor(self):
+        response = self.client.get(reverse('index') + '/?after=notacursor')
+        self.assertQuerysetEqual(response.context['pictures'].object_list, Picture.objects.filter(pk__in=[1,3]).order_by('-pk'))
+
+    def test_index_count_cached(self):
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['count'], 2)
+
+        # Only the page is queried
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['count'], 2)
+
+    def test_index_does_not_load_pixels(self):
+        # Big picture, its pixels are larger than everything else in the page
+        big_picture = Picture.objects.create(
+            image=np.random.default_rng(0).integers(0, 256, (100, 100, 3)),
+            palette=[[0,0,0]] * 256,
+            user=self.creator,
+            public=True,
+            timestamp = timezone.now()
+        )
+
+        queries = []
+        def record(execute, sql, params, many, context):
+            queries.append((sql, params))
+            return execute(sql, params, many, context)
+
+        # Count of pictures and pictures of the page
+        with self.assertNumQueries(2), connection.execute_wrapper(record):
+            response = self.client.get(reverse('index'))
+        self.assertIn(big_picture, response.context['pictures'].object_list)
+
+        # Run the same queries again to measure what they fetch
+        fetched = 0
+        with connection.cursor() as cursor:
+            for sql, params in queries:
+                self.assertNotIn('"pixels"', sql)
+                self.assertNotIn('"palette"', sql)
+                cursor.execute(sql, params)
+                fetched += sum(len(str(value)) for row in cursor.fetchall() for value in row)
+        self.assertLess(fetched, 1000)
+        self.assertGreater(len(big_picture.pixels), 10000)
+
     # Tests create
 
     def test_create(self):
@@ -98,6 +188,7 @@ class ViewsTestCase(TestCase):
     def test_view_picture_anonymousUser(self):
         # Public picture
         response = self.client.get(reverse('view_picture', args=['1']))
+        flush_views()
         public_picture = Picture.objects.get(pk=1)
         self.assertEqual(public_picture.views, 1)
         self.assertTemplateUsed(response, 'pixelpictures/view_picture.html')
@@ -131,6 +222,7 @@ class ViewsTestCase(TestCase):
 
         # Public picture
         response = self.client.get(reverse('view_picture', args=['1']))
+        flush_views()
         public_picture = Picture.objects.get(pk=1)
         self.assertEqual(public_picture.views, 1)
         self.assertTemplateUsed(response, 'pixelpictures/view_picture.html')
@@ -142,6 +234,54 @@ class ViewsTestCase(TestCase):
         self.assertEqual(private_picture.views, 0)
         self.assertEqual(response.context, None)
 
+    @override_settings(VIEWS_FLUSH_THRESHOLD=3, VIEWS_FLUSH_INTERVAL=3600)
+    def test_view_counter_buffer(self):
+        flush_views()
+        count_view(1)
+        count_view(3)
+        self.assertEqual(pending_views(), {1: 1, 3: 1})
+        self.assertEqual(Picture.objects.get(pk=1).views, 0)
+
+        # Threshold reached, views are written in one UPDATE
+        with self.assertNumQueries(1):
+            count_view(1)
+        self.assertEqual(pending_views(), {})
+        self.assertEqual(Picture.objects.get(pk=1).views, 2)
+        self.assertEqual(Picture.objects.get(pk=3).views, 1)
+
+    @override_settings(VIEWS_FLUSH_THRESHOLD=100, VIEWS_FLUSH_INTERVAL=60)
+    def test_view_counter_timer(self):
+        # Views are written by a timer even if no other view is counted
+        flush_views()
+        with patch('pixelpictures.view_counter.threading.Timer') as timer:
+            count_view(1)
+            count_view(3)
+        timer.assert_called_once_with(60, _flush_on_timer)
+        timer.return_value.start.assert_called_once()
+
+        # The timer thread closes its database connections
+        with patch('pixelpictures.view_counter.connections') as connections:
+            _flush_on_timer()
+        connections.close_all.assert_called_once()
+        self.assertEqual(pending_views(), {})
+        self.assertEqual(Picture.objects.get(pk=3).views, 1)
+
+        # Flushes stop the timer
+        with patch('pixelpictures.view_counter.threading.Timer') as timer:
+            count_view(1)
+            flush_views()
+        timer.return_value.cancel.assert_called_once()
+
+    @override_settings(VIEWS_FLUSH_THRESHOLD=100, VIEWS_FLUSH_INTERVAL=3600)
+    def test_view_counter_does_not_save_picture(self):
+        Picture.objects.filter(pk=1).update(views=5)
+        self.client.get(reverse('view_picture', args=['1']))
+
+        # Sorting by views writes buffered views, without overwriting other views
+        response = self.client.get(reverse('index') + '/?sort=views')
+        self.assertEqual(Picture.objects.get(pk=1).views, 6)
+        self.assertEqual(response.context['pictures'].object_list[0].pk, 1)
+
     # Tests modify
 
     def test_modify_not_existing_picture(self):
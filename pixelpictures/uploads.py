@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler, SkipFile
+
+# Uploaded images are streamed to temporary files and rejected as soon as they are bigger than settings.MAX_UPLOAD_SIZE,
+# the rest of a rejected file is read and discarded. Names of the rejected fields are in request.too_big_uploads.
+
+class LimitedUploadHandler(TemporaryFileUploadHandler):
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.MAX_UPLOAD_SIZE:
+            if self.request is not None:
+                if not hasattr(self.request, 'too_big_uploads'):
+                    self.request.too_big_uploads = set()
+                self.request.too_big_uploads.add(self.field_name)
+            raise SkipFile()
+        return super().receive_data_chunk(raw_data, start)
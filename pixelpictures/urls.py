@@ -11,8 +11,11 @@ urlpatterns = [
     path("modify/<key>", views.modify_picture, name="modify_picture"),
     path("profile", views.user_pictures, name="user_pictures"),
     path("sample", views.resize_image, name="resize_image"),
+    path("palette", views.sample_palette, name="sample_palette"),
     path("save", views.save_image, name="save"),
     path("delete", views.delete_picture, name="delete_picture"),
+    path("render/<key>", views.picture_render_status, name="render_status"),
     path("image_to_pixels", views.image_to_pixels, name="image_to_pixels"),
+    path("pattern", views.image_to_pattern, name="image_to_pattern"),
     path("download", views.download_options, name="download")
 ]
\ No newline at end of file
@@ -0,0 +1,105 @@
+import atexit
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Case, When, Value
+
+from .models import Picture
+
+# Views are buffered in memory and written to the database in one UPDATE, instead of saving a picture at every view.
+# Every process has its own buffer, written by a timer at most VIEWS_FLUSH_INTERVAL seconds after the first view
+# and when the process exits, so views of idle or stopped processes are not lost.
+_pending = Counter()
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_timer = None
+
+# Pictures updated by a single UPDATE (keeps the number of parameters under SQLite limits)
+FLUSH_BATCH = 500
+
+def count_view(pk):
+    '''
+    Counts a view of the picture with primary key pk, views are written when the buffer is full or old enough.
+    '''
+
+    with _lock:
+        _pending[pk] += 1
+        due = (sum(_pending.values()) >= settings.VIEWS_FLUSH_THRESHOLD
+               or time.monotonic() - _last_flush >= settings.VIEWS_FLUSH_INTERVAL)
+        if not due:
+            _schedule_flush()
+
+    if due:
+        flush_views()
+
+def _schedule_flush():
+    # Starts the timer writing buffered views, if it is not running. Called with _lock held
+    global _timer
+    if _timer is None:
+        _timer = threading.Timer(settings.VIEWS_FLUSH_INTERVAL, _flush_on_timer)
+        _timer.daemon = True
+        _timer.start()
+
+def _flush_on_timer():
+    global _timer
+    with _lock:
+        _timer = None
+    try:
+        flush_views()
+    except Exception:
+        # Views are kept and the timer is started again by flush_views
+        pass
+    finally:
+        # Connections of the timer thread are not used again
+        connections.close_all()
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush_views()
+    except Exception:
+        pass
+
+def pending_views():
+    '''
+    Returns a dictionary with the views not yet written, by primary key of pictures.
+    '''
+
+    with _lock:
+        return dict(_pending)
+
+def flush_views():
+    '''
+    Adds the buffered views to the pictures with atomic UPDATEs (views = views + n).
+    Returns the number of views written.
+    '''
+
+    global _last_flush, _timer
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+
+    if not pending:
+        return 0
+
+    items = list(pending.items())
+    try:
+        for start in range(0, len(items), FLUSH_BATCH):
+            batch = items[start:start + FLUSH_BATCH]
+            increments = Case(*[When(pk=pk, then=Value(n)) for pk, n in batch])
+            Picture.objects.filter(pk__in=[pk for pk, _ in batch]).update(views=F('views') + increments)
+    except Exception:
+        # Views are kept for the next flush
+        with _lock:
+            _pending.update(pending)
+            _schedule_flush()
+        raise
+
+    return sum(pending.values())
@@ -1,59 +1,89 @@
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect, FileResponse
+from django.http import HttpResponse, HttpResponseRedirect, FileResponse, StreamingHttpResponse
 from django.http import JsonResponse
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.urls import reverse
-from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Q, Exists, OuterRef
 from django.utils import timezone
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
 
 import json
+import hashlib
 import numpy as np 
 from PIL import Image
-import os
 import io
 from base64 import b64encode
 
-from .image_to_pixels import resize, to_pixels, add_grid
+from .image_to_pixels import resize, to_pixels, add_grid, grid_layout, extract_palette, quantize, RESIZE_MODES, GRID_BORDER
+from .grid_stream import GRID_STREAMS
+from .grid_cache import open_cached, cache_stream
+from .grid_format import GRID_CONTENT_TYPE, encode_grid, encode_indexed, decode_grid, check_size
 
 
-from .models import User, Picture, Tag
+from .models import User, Picture, Tag, normalize_tag
+from .view_counter import count_view, flush_views
+from .pagination import keyset_page, cached_count, SORT_FIELDS
+from .render import enqueue_render, render_status
+from .storage import picture_name, open_file
 from .forms import RegisterUserForm
 
-# Where pictures are stored:
-PATH_PICTURES = "./pixelpictures/static/pixelpictures/pictures"
+# Greater than any character, used for prefix searches as ranges on indexes
+MAX_CHAR = '\U0010ffff'
+# Fields of Picture loaded only when the picture is drawn (lists and links use the stored png):
+PAYLOAD_FIELDS = ('pixels', 'palette')
+# Grids downloaded with GET are cached by browsers for this many seconds, then revalidated with their ETag
+GRID_MAX_AGE = 60
+# Part of ETags of grids, to be changed when grids are drawn differently
+GRID_VERSION = 1
+# Largest size of cells of grids, in pixels (sliders of pages go from 5 to 25)
+MAX_SIZE_CELL = 50
 
 def index(request):
     # Default values of search and sort:
-    search = ''
-    if request.GET.get("search"):
-        search = request.GET.get("search")
-        tags = Tag.objects.filter(tag__contains=search)
-        all_pictures = Picture.objects.filter(tags__in=tags, public=True).distinct()
-        
-    else:
-        all_pictures = Picture.objects.filter(public=True)
-
-    if request.GET.get("sort"):
-        sort = request.GET.get("sort")
-    else:
+    search = request.GET.get("search", '')
+    # public__in instead of public=True: SQLite uses indexes on public only for comparisons
+    all_pictures = Picture.objects.filter(public__in=[True])
+    if search:
+        all_pictures = all_pictures.filter(tags_search(search))
+    all_pictures = all_pictures.select_related('stored_image').defer(*PAYLOAD_FIELDS)
+
+    sort = request.GET.get("sort")
+    if sort not in SORT_FIELDS:
         sort = 'new'
 
     if sort == 'views':
-        all_pictures = all_pictures.order_by('-views')
-    else:
-        all_pictures = all_pictures.order_by('-timestamp')
+        # Buffered views of this process are written first
+        flush_views()
 
-    paginator = Paginator(all_pictures, 20)
-    page_number = request.GET.get('page')
-    page_pictures = paginator.get_page(page_number)
+    try:
+        page_pictures = keyset_page(all_pictures, SORT_FIELDS[sort], request.GET.get('after'), request.GET.get('before'))
+    except ValueError:
+        page_pictures = keyset_page(all_pictures, SORT_FIELDS[sort])
 
     return render(request, "pixelpictures/index.html", {
         "pictures": page_pictures,
+        "count": cached_count(all_pictures, f"public:{search}"),
         "search_value": search,
         "sort_value": sort
     })
 
+def tags_search(search):
+    '''
+    Returns a condition on pictures having, for every word of search, a tag starting with the word.
+    '''
+
+    condition = Q()
+    for word in search.split():
+        word = normalize_tag(word)
+        # Range instead of LIKE, so the unique index of tags is searched
+        tags = Tag.objects.filter(tag__gte=word, tag__lt=word + MAX_CHAR).values('pk')
+        # Ids of the pictures are found once, not for every picture
+        condition &= Q(pk__in=Tag.pictures.through.objects.filter(tag__in=tags).values('picture_id'))
+    return condition
+
 def login_view(request):
     if request.method == 'POST':
         username = request.POST['username']
@@ -92,18 +122,18 @@ def create(request):
 
 def view_picture(request, key):
     try:
-        picture = Picture.objects.get(pk=key)
+        picture = Picture.objects.select_related('user', 'stored_image').defer(*PAYLOAD_FIELDS).get(pk=key)
     except Picture.DoesNotExist:
         return HttpResponse("This picture does not exists.")
 
     if picture.user != request.user:
         if not picture.public:
             return HttpResponse("You do not have access to this picture.")
-        picture.views += 1
-        picture.save()
+        count_view(picture.pk)
 
     return render(request, "pixelpictures/view_picture.html", {
-        'picture': picture
+        'picture': picture,
+        'render': render_status(picture)
     })
 
 def modify_picture(request, key):
@@ -115,13 +145,10 @@ def modify_picture(request, key):
     if picture.user != request.user: 
         return HttpResponse("You cannot modify this picture.")
 
-    height = len(picture.image)
-    width = len(picture.image[0])
-
     return render(request, "pixelpictures/create.html", {
         'picture': picture,
-        'width': width,
-        'height': height
+        'width': picture.width,
+        'height': picture.height
     })
 
 def user_pictures(request):
@@ -129,8 +156,8 @@ def user_pictures(request):
         return HttpResponse("Login required.")
     
     user = request.user
-    private_pictures = Picture.objects.filter(user=user, public=False).order_by('-timestamp')
-    public_pictures = Picture.objects.filter(user=user, public=True).order_by('-timestamp')
+    private_pictures = Picture.objects.filter(user=user, public=False).select_related('stored_image').defer(*PAYLOAD_FIELDS).order_by('-timestamp')
+    public_pictures = Picture.objects.filter(user=user, public=True).select_related('stored_image').defer(*PAYLOAD_FIELDS).order_by('-timestamp')
 
     return render(request, "pixelpictures/user_pictures.html", {
         "private": private_pictures,
@@ -139,25 +166,67 @@ def user_pictures(request):
 
 # API
 
-def update_tags(picture, new_tags):
-    # picture is Picture instance, new_tags is a list of tags
-    current_tags = [row.tag for row in Tag.objects.filter(picture=picture)]
+def accepts_grid(request):
+    # Pixel grids are sent in binary format only if requested, JSON is the default
+    return GRID_CONTENT_TYPE in request.headers.get('Accept', '')
 
-    for current_tag in current_tags:
-        if current_tag not in new_tags:
-            Tag.objects.get(tag=current_tag, picture=picture).delete()
-    
-    for new_tag in new_tags:
-        if new_tag not in current_tags:
-            Tag.objects.create(picture=picture, tag=new_tag)
-        
+def read_image_data(request):
+    '''
+    Reads the body of a request containing an image, in JSON or in binary format (selected by Content-Type).
+    Returns np.array of the image (None if missing) and dictionary with the other data.
+    Raises ValueError if the body is not valid.
+    '''
+
+    if request.content_type == GRID_CONTENT_TYPE:
+        image_arr, data = decode_grid(request.body)
+        return image_arr, data or {}
+
+    data = json.loads(request.body)
+    image = data.pop('image', None)
+    if image is None:
+        return None, data
+
+    image_arr = np.array(image)
+    if image_arr.ndim != 3:
+        raise ValueError("Image must be a grid of colors.")
+    # Same limits of binary grids, so the image can be encoded
+    check_size(*image_arr.shape[:2])
+    return image_arr, data
+
+def update_tags(picture, new_tags):
+    '''
+    Sets the tags of picture to new_tags (list of tags), with a fixed number of queries for any number of tags.
+    Call inside the transaction saving the picture.
+    '''
+
+    Through = Tag.pictures.through
+    # Normalized tags without repetitions, in the given order
+    new_tags = [tag for tag in dict.fromkeys(normalize_tag(tag) for tag in new_tags) if tag]
+    current_tags = dict(Through.objects.filter(picture=picture).values_list('tag__tag', 'tag_id'))
+
+    removed = [tag_id for tag, tag_id in current_tags.items() if tag not in new_tags]
+    if removed:
+        Through.objects.filter(picture=picture, tag_id__in=removed).delete()
+        # Tags not used by any picture anymore, in one DELETE (they have no rows in Through to collect)
+        unused = Tag.objects.filter(pk__in=removed).exclude(Exists(Through.objects.filter(tag_id=OuterRef('pk'))))
+        unused._raw_delete(unused.db)
+
+    added = [tag for tag in new_tags if tag not in current_tags]
+    if added:
+        # Tags already used by other pictures are kept
+        Tag.objects.bulk_create([Tag(tag=tag) for tag in added], ignore_conflicts=True)
+        tag_ids = dict(Tag.objects.filter(tag__in=added).values_list('tag', 'pk'))
+        Through.objects.bulk_create([Through(picture=picture, tag_id=tag_ids[tag]) for tag in added], ignore_conflicts=True)
 
 def save_image(request):
     if request.method != 'POST' and request.method != 'PUT':
         return JsonResponse({"error": "POST or PUT request required"}, status=400)
 
-    data = json.loads(request.body)
-    new_image = data.get("image")
+    try:
+        image_arr, data = read_image_data(request)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
     public = data.get("public")
     tags = data.get("tags")
     palette = data.get("palette")
@@ -168,25 +237,24 @@ def save_image(request):
         if not request.user.is_authenticated: 
             return JsonResponse({"message": "You have to log in to save a picture."}, status=200)
 
-        picture = Picture.objects.create(
-            image = new_image,
-            user = request.user,
-            public = public,
-            palette = palette,
-            timestamp = new_timestamp
-        )
-        update_tags(picture, tags)
-        picture.save()
-
-        prev_timestamp = new_timestamp
+        with transaction.atomic():
+            picture = Picture.objects.create(
+                image = image_arr,
+                user = request.user,
+                public = public,
+                palette = palette,
+                timestamp = new_timestamp
+            )
+            update_tags(picture, tags)
+            job = enqueue_render(picture)
 
     elif request.method == 'PUT':
 
         key = data.get("key")
 
         try:
-            picture = Picture.objects.get(pk=key)
-            prev_timestamp = picture.timestamp
+            # Views are not loaded, so save does not overwrite views counted in the meantime (see view_counter.py)
+            picture = Picture.objects.select_related('stored_image').defer(*PAYLOAD_FIELDS, 'views').get(pk=key)
 
             # Only who created the picture can modify it
             if request.user != picture.user:
@@ -194,28 +262,32 @@ def save_image(request):
                     "error": "Cannot modify a picture not created by you."
                 }, status=400)
 
-            picture.image = new_image
+            picture.image = image_arr
             picture.public = public
             picture.palette = palette
             picture.timestamp = new_timestamp
-            update_tags(picture, tags)
-            picture.save()
+            with transaction.atomic():
+                picture.save()
+                update_tags(picture, tags)
+                job = enqueue_render(picture)
         except Picture.DoesNotExist:
             return JsonResponse({
                 "error": f"Picture with primary key {key} does not exists."
             }, status=400)
     
-    # Store picture or modified picture in pictures folder.
-    height = len(new_image)
-    width = len(new_image[0])
-    image = Image.fromarray(np.array(new_image).astype(np.uint8)).resize((width * 18, height * 18), resample=Image.NEAREST)
+    # The png of the picture is rendered in background, its status is returned by picture_render_status
+    return JsonResponse({"message": "Picture saved correctly.", "key": picture.pk, "render": job.status}, status=200)
 
-    if os.path.isfile(f"{PATH_PICTURES}/{picture.pk}_{prev_timestamp.strftime('%Y%m%d_%H%M%S')}.png"):
-        os.remove(f"{PATH_PICTURES}/{picture.pk}_{prev_timestamp.strftime('%Y%m%d_%H%M%S')}.png")
+def picture_render_status(request, key):
+    try:
+        picture = Picture.objects.select_related('stored_image').defer(*PAYLOAD_FIELDS).get(pk=key)
+    except Picture.DoesNotExist:
+        return JsonResponse({"error": "This picture does not exists."}, status=400)
 
-    image.save(f"{PATH_PICTURES}/{picture.pk}_{new_timestamp.strftime('%Y%m%d_%H%M%S')}.png")
+    if picture.user != request.user and not picture.public:
+        return JsonResponse({"error": "You do not have access to this picture."}, status=400)
 
-    return JsonResponse({"message": "Picture saved correctly.", "key": picture.pk}, status=200)
+    return JsonResponse({"render": render_status(picture)}, status=200)
     
 def delete_picture(request):
     if request.method != 'POST':
@@ -225,7 +297,7 @@ def delete_picture(request):
     key = data.get("key")
 
     try: 
-        picture = Picture.objects.get(pk=key)
+        picture = Picture.objects.select_related('stored_image').defer(*PAYLOAD_FIELDS).get(pk=key)
     except Picture.DoesNotExist:
         return JsonResponse({
                     "message": "This picture does not exists."
@@ -236,70 +308,303 @@ def delete_picture(request):
                     "message": "You cannot delete a picture that is not yours!"
                 }, status=400)
     
-    os.remove(f"{PATH_PICTURES}/{picture.pk}_{picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png")
+    # Files are removed with the stored image, if no other picture uses them
     picture.delete()
     return JsonResponse({
         "message": "Picture deleted successfully."
     }, status=200)
 
-def resize_image(request):
+def open_uploaded_image(request):
+    '''
+    Opens the image uploaded in field img of request, reading only its header.
+    Raises ValueError if it is missing, not supported or too big.
+    '''
 
-    if request.method == "POST":
+    # Files too big are rejected while they are uploaded (see uploads.py)
+    if 'img' in getattr(request, 'too_big_uploads', ()):
+        raise ValueError("Image file is too big.")
+
+    image_src = request.FILES.get('img')
+    if image_src is None:
+        raise ValueError("Image file is missing.")
+
+    try:
+        image = Image.open(image_src)
+    except:
+        raise ValueError("Not supported file format.")
+
+    if image.width * image.height > settings.MAX_UPLOAD_PIXELS:
+        raise ValueError("Image has too many pixels.")
 
-        image_src = request.FILES['img']
-        height = int(request.POST['height'])
-        width = int(request.POST['width'])
+    return image
 
-        if height <= 0 or width <= 0:
-            return JsonResponse({"error": "Height and width cannot be negative."}, status=400)
+def resized_upload(request):
+    '''
+    Opens the image uploaded in a POST request and resizes it using height, width and resample options of the request.
+    Returns np.array of the resized image, raises ValueError if options or image are not valid.
+    '''
+
+    try:
+        height = int(request.POST.get('height'))
+        width = int(request.POST.get('width'))
+    except (TypeError, ValueError):
+        raise ValueError("Height and width must be integers.")
+    mode = request.POST.get('resample', 'nearest')
+
+    if height <= 0 or width <= 0:
+        raise ValueError("Height and width cannot be negative.")
+
+    # Resized image is sent as a grid (see grid_format.py)
+    check_size(height, width)
+
+    if mode not in RESIZE_MODES:
+        raise ValueError(f"Resample mode must be one of: {', '.join(RESIZE_MODES)}.")
+
+    image = open_uploaded_image(request)
+
+    return np.array(resize(width, height, image, mode))
+
+def resize_image(request):
+
+    if request.method == "POST":
 
         try:
-            image = Image.open(image_src)
-        except: 
-            return JsonResponse({"error": "Not supported file format."}, status=400)
+            resized_image = resized_upload(request)
+        except ValueError as error:
+            return JsonResponse({"error": str(error)}, status=400)
 
-        resized_image = np.array(resize(width, height, image))
+        if accepts_grid(request):
+            return HttpResponse(encode_grid(resized_image), content_type=GRID_CONTENT_TYPE)
 
         return JsonResponse({"sample_image": resized_image.tolist()}, status=200)
 
     return HttpResponseRedirect(reverse('create'))
 
+def read_palette(palette):
+    '''
+    Checks a palette sent by a client: a non-empty list of colors with 3 or 4 ints between 0 and 255 (all with the same length).
+    Returns the palette, raises ValueError if it is not valid.
+    '''
+
+    if not isinstance(palette, list) or not palette:
+        raise ValueError("Palette cannot be empty.")
+    for color in palette:
+        if not isinstance(color, list) or len(color) not in (3, 4) or len(color) != len(palette[0]) \
+                or not all(type(value) is int and 0 <= value <= 255 for value in color):
+            raise ValueError("Colors of the palette must have 3 or 4 values between 0 and 255.")
+    return palette
+
+def image_to_pattern(request):
+    # Resizes the uploaded image and changes its colors to the ones in palette, in a single request.
+
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST request required."}, status=400)
+
+    try:
+        try:
+            palette = json.loads(request.POST.get('palette', '[]'))
+        except json.JSONDecodeError:
+            raise ValueError("Palette is not valid JSON.")
+        palette = read_palette(palette)
+        resized_image = resized_upload(request)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    # Only indices of palette are sent back
+    pattern = quantize(resized_image, palette, settings.INDEX_MIN_PALETTE)
+
+    if accepts_grid(request):
+        return HttpResponse(encode_indexed(palette, pattern), content_type=GRID_CONTENT_TYPE)
+
+    return JsonResponse({"palette": palette, "pattern": pattern.tolist()}, status=200)
+
+def sample_palette(request):
+
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST request required."}, status=400)
+
+    try:
+        n_colors = int(request.POST.get('colors', 16))
+    except ValueError:
+        n_colors = 0
+    if n_colors <= 0 or n_colors > 256:
+        return JsonResponse({"error": "Number of colors must be between 1 and 256."}, status=400)
+
+    try:
+        image = open_uploaded_image(request)
+        palette = extract_palette(image, n_colors)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    except:
+        return JsonResponse({"error": "Not supported file format."}, status=400)
+
+    return JsonResponse({"palette": palette}, status=200)
+
 def image_to_pixels(request):
 
     if request.method != 'POST':
         return JsonResponse({"error": "POST request required."}, status=400)
         
-    data = json.loads(request.body)
-    image = data.get('image')
-    palette = data.get('palette')
+    try:
+        image, data = read_image_data(request)
+        palette = read_palette(data.get('palette'))
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
 
-    pixels_image = to_pixels(image, palette)
+    if accepts_grid(request):
+        return HttpResponse(encode_indexed(palette, quantize(image, palette, settings.INDEX_MIN_PALETTE)), content_type=GRID_CONTENT_TYPE)
+
+    pixels_image = to_pixels(image, palette, settings.INDEX_MIN_PALETTE)
 
     return JsonResponse({"pixels_image": pixels_image}, status=200)
 
+def read_grid_options(data):
+    '''
+    Reads options of a grid (arguments of add_grid) from JSON data or a query string, where grid_color is "r,g,b".
+    Raises ValueError if they are not valid.
+    '''
+
+    grid_color = data.get('grid_color', (0, 0, 0))
+    if isinstance(grid_color, str):
+        grid_color = grid_color.split(',')
+    try:
+        options = {
+            'start_row': int(data.get('start_row', 1)),
+            'start_col': int(data.get('start_col', 1)),
+            'dir_rows': str(data.get('dir_rows', 'tb')),
+            'dir_cols': str(data.get('dir_cols', 'lr')),
+            'grid_color': tuple(int(value) for value in grid_color),
+            'size_cell': int(data.get('size_cell', 20)),
+            'step': int(data.get('step', 1)),
+        }
+    except (TypeError, ValueError):
+        raise ValueError("Options of the grid are not valid.")
+
+    if len(options['grid_color']) != 3 or not all(0 <= value <= 255 for value in options['grid_color']):
+        raise ValueError("Color of the grid must have 3 values between 0 and 255.")
+    if not 0 < options['size_cell'] <= MAX_SIZE_CELL:
+        raise ValueError(f"Size of cells must be between 1 and {MAX_SIZE_CELL}.")
+    return options
+
+def check_grid_size(picture, options):
+    # Raises ValueError if the grid of picture is bigger than settings.MAX_DOWNLOAD_PIXELS, before it is drawn
+    size_cell = options['size_cell']
+    pixels = (picture.width * size_cell + GRID_BORDER * 2) * (picture.height * size_cell + GRID_BORDER * 2)
+    if pixels > settings.MAX_DOWNLOAD_PIXELS:
+        raise ValueError("The grid is too big, choose smaller cells.")
+
+def grid_key(options, output_format):
+    # Name of a grid of a stored image, grids depend only on the pixels of the picture and on the options
+    key = json.dumps([GRID_VERSION, options, output_format])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def grid_etag(picture, key):
+    return f'"{hashlib.sha256((picture.stored_image.content_hash + key).encode()).hexdigest()[:32]}"'
+
+def grid_cache_headers(response, picture, etag):
+    # Grids of private pictures are cached only by browsers
+    response['ETag'] = etag
+    patch_cache_control(response, max_age=GRID_MAX_AGE, **{'public' if picture.public else 'private': True})
+    return response
+
+def open_picture_image(picture):
+    '''
+    Returns the stored png of picture as PIL.Image and its pixels for every cell.
+    Raises FileNotFoundError if it is not rendered yet.
+    '''
+
+    with open_file(picture_name(picture.stored_image.content_hash)) as file:
+        image = Image.open(file)
+        image.load()
+    # Pictures stored before 1x PNGs have 18 pixels for every cell
+    scale = image.width // picture.width if picture.width else 1
+    return image, scale
+
+def grid_file_response(request, picture, options, output_format):
+    '''
+    Returns the grid of picture as a file in output_format (see grid_stream.GRID_STREAMS), streamed while it is drawn
+    or read from the cache of grids (see grid_cache.py). Files sent to GET requests can be cached by browsers.
+    '''
+
+    name = picture.stored_image.content_hash
+    key = grid_key(options, output_format)
+    if request.method == 'GET':
+        etag = grid_etag(picture, key)
+        # Grids already downloaded are not drawn again
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return grid_cache_headers(not_modified, picture, etag)
+
+    stream, content_type, extension = GRID_STREAMS[output_format]
+    cached = open_cached(name, key, output_format)
+    if cached is not None:
+        response = FileResponse(cached, content_type=content_type)
+    else:
+        try:
+            image, scale = open_picture_image(picture)
+        except FileNotFoundError:
+            return JsonResponse({"error": "Picture is not rendered yet."}, status=400)
+        layout = grid_layout(image, **options, scale=scale)
+        try:
+            chunks = stream(layout)
+        except ValueError as error:
+            return JsonResponse({"error": str(error)}, status=400)
+        response = StreamingHttpResponse(cache_stream(chunks, name, key, output_format), content_type=content_type)
+
+    if request.method == 'GET':
+        response['Content-Disposition'] = f'inline; filename="{picture.pk}.{extension}"'
+        return grid_cache_headers(response, picture, etag)
+    response['Content-Disposition'] = f'attachment; filename="{picture.pk}.{extension}"'
+    return response
+
 def download_options(request): 
 
-    if request.method != 'POST':
-        return JsonResponse({"error": "POST request required."}, status=400)
+    # GET: grid as a file, cached by browsers, with options in the query string
+    # POST: options in JSON, preview sent in JSON unless a format is requested
+    if request.method == 'GET':
+        data = request.GET
+        output_format = data.get('format', 'png')
+    elif request.method == 'POST':
+        data = json.loads(request.body)
+        output_format = data.get('format')
+    else:
+        return JsonResponse({"error": "GET or POST request required."}, status=400)
 
-    data = json.loads(request.body)
     key = data.get('key')
-    start_row = int(data.get('start_row'))
-    start_col = int(data.get('start_col'))
-    dir_rows = data.get('dir_rows')
-    dir_cols = data.get('dir_cols')
-    grid_color = tuple(data.get('grid_color'))
-    size_cell = int(data.get('size_cell'))
-    step = int(data.get('step'))
+    try:
+        options = read_grid_options(data)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    # Big grids are downloaded as files streamed while they are drawn
+    if output_format is not None and output_format not in GRID_STREAMS:
+        return JsonResponse({"error": f"Format must be one of: {', '.join(GRID_STREAMS)}."}, status=400)
+
+    try:
+        picture = Picture.objects.select_related('stored_image').defer(*PAYLOAD_FIELDS).get(pk=key)
+    except (Picture.DoesNotExist, ValueError):
+        return JsonResponse({"error": "This picture does not exists."}, status=400)
+
+    # Checked before conditional requests, so private grids are not sent nor confirmed to others
+    if picture.user_id != request.user.pk and not picture.public:
+        return JsonResponse({"error": "You do not have access to this picture."}, status=400)
 
-    picture = Picture.objects.get(pk=key)
+    try:
+        check_grid_size(picture, options)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
 
-    image_with_grid = add_grid(Image.open(f"{PATH_PICTURES}/{picture.pk}_{picture.timestamp.strftime('%Y%m%d_%H%M%S')}.png"), start_row, start_col, dir_rows, dir_cols, grid_color, size_cell, step)
+    if output_format is not None:
+        return grid_file_response(request, picture, options, output_format)
+
+    try:
+        image, scale = open_picture_image(picture)
+    except FileNotFoundError:
+        return JsonResponse({"error": "Picture is not rendered yet."}, status=400)
+
+    image_with_grid = add_grid(image, **options, scale=scale)
     # Encode image data in base64 https://stackoverflow.com/a/70849754/21044513
     image_io = io.BytesIO()
     image_with_grid.save(image_io, 'PNG')
     dataurl = 'data:image/png;base64,' + b64encode(image_io.getvalue()).decode('ascii')
 
     return JsonResponse({'source': dataurl}, status=200)
-        
-